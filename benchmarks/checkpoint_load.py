@@ -0,0 +1,76 @@
+"""Compare loading a torch.save checkpoint with loading the memory-mapped checkpoint format.
+
+Saves the MNIST UNet with an Adam state in both formats, then loads each in fresh interpreters
+for inference (model weights only) and reports the load time and the growth of peak RSS.
+
+    python benchmarks/checkpoint_load.py --repeats 3
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+PROBE = """
+import os, sys, time, torch
+from xvfm.checkpoint import load_checkpoint
+
+def rss_mb():
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+
+before = rss_mb()
+start = time.perf_counter()
+if sys.argv[1].endswith(".pt"):
+    state_dict = torch.load(sys.argv[1], map_location="cpu")["model"]
+else:
+    state_dict = load_checkpoint(sys.argv[1])["model"]
+elapsed = time.perf_counter() - start
+print(elapsed, rss_mb() - before)
+"""
+
+
+def write_checkpoints(directory):
+    import torch
+    from xvfm.unet import UNetModel
+    from xvfm.checkpoint import save_checkpoint
+
+    model = UNetModel(dim=(1, 28, 28), num_channels=32, num_res_blocks=1, num_classes=10)
+    optimizer = torch.optim.Adam(model.parameters())
+    model(torch.randn(2, 1, 28, 28), torch.rand(2)).sum().backward()
+    optimizer.step()
+    torch.save({"model": model.state_dict(), "optimizer": optimizer.state_dict()}, f"{directory}/model.pt")
+    save_checkpoint(f"{directory}/model.ckpt", model.state_dict(), optimizer.state_dict())
+    save_checkpoint(f"{directory}/model_bf16.ckpt", model.state_dict(), dtype=torch.bfloat16)
+    return [f"{directory}/model.pt", f"{directory}/model.ckpt", f"{directory}/model_bf16.ckpt"]
+
+
+def measure(path, repeats):
+    times, rss = [], []
+    for _ in range(repeats):
+        seconds, mb = subprocess.run(
+            [sys.executable, "-c", PROBE, path], cwd=ROOT, capture_output=True, text=True, check=True
+        ).stdout.split()
+        times.append(float(seconds))
+        rss.append(float(mb))
+    return statistics.median(times), statistics.median(rss)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Checkpoint load benchmark')
+    parser.add_argument('--repeats', default=3, type=int, help="Fresh interpreters per format; the median is reported")
+    args = parser.parse_args()
+
+    sys.path.insert(0, ROOT)
+    with tempfile.TemporaryDirectory() as directory:
+        print(f"{'checkpoint':<16} {'seconds':>8} {'RSS +MB':>13}")
+        for path in write_checkpoints(directory):
+            seconds, mb = measure(path, args.repeats)
+            print(f"{os.path.basename(path):<16} {seconds:>8.4f} {mb:>13.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+"""Speed-up of torch.compile on the training loss for every dataset, loss and sigma structure.
+
+    python benchmarks/compile_speedup.py --steps 20 --out compile_speedup.json
+    python benchmarks/compile_speedup.py --datasets two_moons --losses Gaussian
+
+main.py --compile_benchmark reports the speed-up of the configuration being trained; this runs
+the same measurement (xvfm.compiled.time_loss_step on main.compute_loss, eager against
+CompiledLoss) over the whole grid. Batches are synthetic tensors of the dataset's shape, so no
+data needs to be downloaded. Compilation happens during the warm-up calls and is not timed.
+"""
+import argparse
+import json
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import torch
+
+from xvfm.compiled import CompiledLoss, time_loss_step
+
+DATASETS = ("two_moons", "mnist")
+LOSSES = ("MSE", "Gaussian")
+SIGMAS = ("fixed", "scalar", "vector")
+
+
+def measure(dataset, loss, sigma, batch_size, steps, warmup, device):
+    import main
+
+    args = main.get_args(["--dataset", dataset, "--loss_fn", loss, "--batch_size", str(batch_size)])
+    args.learn_sigma = sigma != "fixed"
+    args.learned_structure = "scalar" if sigma == "fixed" else sigma
+    torch.manual_seed(args.seed)
+    model = main.get_flow_model(args, device)
+    criterion = main.CRITERION_MAP[args.loss_fn]
+    x_1 = torch.randn(batch_size, *((1, 28, 28) if dataset == "mnist" else (2,)), device=device)
+
+    def loss_fn(x):
+        return main.compute_loss(model, criterion, x, device, args)
+
+    params = list(model.parameters())
+    eager = time_loss_step(loss_fn, x_1, params, num_steps=steps, warmup=warmup)
+    compiled = time_loss_step(CompiledLoss(loss_fn), x_1, params, num_steps=steps, warmup=warmup)
+    return {"eager_ms": 1e3 * eager, "compiled_ms": 1e3 * compiled, "speedup": eager / compiled}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='torch.compile speed-up of the training loss')
+    parser.add_argument('--datasets', nargs='+', default=list(DATASETS), choices=DATASETS, help="Datasets to measure")
+    parser.add_argument('--losses', nargs='+', default=list(LOSSES), choices=LOSSES, help="Loss functions to measure")
+    parser.add_argument('--sigmas', nargs='+', default=list(SIGMAS), choices=SIGMAS, help="Sigma structures ('fixed' for no learned sigma)")
+    parser.add_argument('--batch_size', default=256, type=int, help="Batch size of the two_moons configurations")
+    parser.add_argument('--mnist_batch_size', default=32, type=int, help="Batch size of the MNIST configurations")
+    parser.add_argument('--steps', default=20, type=int, help="Timed forward and backward passes per mode")
+    parser.add_argument('--warmup', default=3, type=int, help="Untimed passes per mode, which include compilation")
+    parser.add_argument('--device', default=None, type=str, help="Device to benchmark on (default: cuda if available)")
+    parser.add_argument('--out', default=None, type=str, help="Write the results to this JSON file")
+    args = parser.parse_args()
+
+    device = torch.device(args.device or ("cuda" if torch.cuda.is_available() else "cpu"))
+    batch_sizes = {"two_moons": args.batch_size, "mnist": args.mnist_batch_size}
+    results = {}
+    print(f"{'config':32s} {'eager':>10s} {'compiled':>10s} {'speedup':>8s}")
+    for dataset in args.datasets:
+        for loss in args.losses:
+            for sigma in args.sigmas:
+                name = f"{dataset}/{loss}/{sigma}"
+                r = results[name] = measure(dataset, loss, sigma, batch_sizes[dataset], args.steps, args.warmup, device)
+                print(f"{name:32s} {r['eager_ms']:8.2f}ms {r['compiled_ms']:8.2f}ms {r['speedup']:7.2f}x", flush=True)
+
+    if args.out is not None:
+        with open(args.out, "w") as f:
+            json.dump({"device": str(device), "torch": torch.__version__, "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,50 @@
+"""Measure how long it takes to import the sampling runtime and the training entry points.
+
+Each module is imported in a fresh interpreter so nothing is cached between measurements.
+
+    python benchmarks/import_time.py --repeats 5
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MODULES = ["torch", "xvfm.runtime", "xvfm.flow", "main"]
+HEAVY = ["wandb", "torchvision", "sklearn", "torchdyn", "ignite", "tqdm", "matplotlib", "pandas", "probtorch"]
+
+PROBE = """
+import sys, time
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+print(elapsed, ",".join(m for m in {heavy!r} if m in sys.modules))
+"""
+
+
+def measure(module, repeats):
+    times = []
+    for _ in range(repeats):
+        out = subprocess.run(
+            [sys.executable, "-c", PROBE.format(module=module, heavy=HEAVY)],
+            cwd=ROOT, capture_output=True, text=True, check=True,
+        ).stdout.split()
+        times.append(float(out[0]))
+    return statistics.median(times), out[1] if len(out) > 1 else "-"
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Import time benchmark')
+    parser.add_argument('--repeats', default=3, type=int, help="Fresh interpreters per module; the median is reported")
+    parser.add_argument('modules', nargs='*', default=MODULES, help="Modules to import")
+    args = parser.parse_args()
+
+    print(f"{'module':<16} {'seconds':>8}  heavy modules loaded")
+    for module in args.modules:
+        seconds, heavy = measure(module, args.repeats)
+        print(f"{module:<16} {seconds:>8.2f}  {heavy}")
+
+
+if __name__ == "__main__":
+    main()
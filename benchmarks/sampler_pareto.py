@@ -0,0 +1,182 @@
+"""Sample quality against compute for the samplers of FlowModel.generate on one checkpoint.
+
+    python benchmarks/sampler_pareto.py checkpoints/Gaussian_learned_scalar.pt --quality_bar 0.05
+
+Sweeps the fixed-step methods over step counts and time grids, and the adaptive solver over
+tolerances. For each setting it records the wall time, function evaluations (NFE) per sample
+and peak memory of one generate call, and the sample quality: a sliced Wasserstein distance to
+held-out two moons, or the FID against MNIST test images. The settings that no other setting
+beats on both cost (--cost) and quality form the Pareto frontier, printed as a table (marked
+with *) and plotted to --plot. With --quality_bar, the cheapest setting meeting it is reported.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import torch
+
+from xvfm import exporter
+from xvfm.flow import TIME_GRIDS
+from xvfm.memory import current_rss_mb, rss_peak_mb, reset_rss_peak
+from xvfm.metrics import sliced_wasserstein
+from xvfm.models import MLP
+from xvfm.runtime import load_vfm
+
+
+def get_settings(args):
+    settings = []
+    for method in args.methods:
+        if method == "adaptive":
+            # Only the end point is kept; the solver picks its own steps within the tolerance.
+            settings += [{"method": method, "steps": 2, "tol": tol, "time_grid": None} for tol in args.tolerances]
+        else:
+            settings += [
+                {"method": method, "steps": steps, "tol": None, "time_grid": grid}
+                for steps in args.steps for grid in args.time_grids
+            ]
+    return settings
+
+
+def get_quality_fn(model, args, device):
+    """Returns (metric name, fn(samples) -> distance to held-out data; lower is better)."""
+    if isinstance(model.variational_dist.posterior_mu_model, MLP):
+        from sklearn.datasets import make_moons
+
+        held_out = torch.tensor(make_moons(args.num_samples, random_state=args.seed + 1)[0], dtype=torch.float32)
+        generator = torch.Generator().manual_seed(args.seed)
+        return "sliced_wasserstein", lambda x: sliced_wasserstein(x, held_out, generator=generator.manual_seed(args.seed))
+
+    from data.utils import compute_fid, mnist_test_images
+
+    real_images = mnist_test_images(args.num_samples, device)
+    return "fid", lambda x: float(compute_fid(x.view(-1, 1, 28, 28).clip(-1, 1).to(device), device, real_images))
+
+
+def run(model, setting, num_samples, device, seed):
+    torch.manual_seed(seed)
+    kwargs = {"method": setting["method"], "steps": setting["steps"], "device": device}
+    if setting["tol"] is not None:
+        kwargs.update(atol=setting["tol"], rtol=setting["tol"])
+    if setting["time_grid"] is not None:
+        kwargs["time_grid"] = setting["time_grid"]
+
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+        torch.cuda.reset_peak_memory_stats(device)
+        base = torch.cuda.memory_allocated(device)
+    else:
+        reset_rss_peak()
+        base = current_rss_mb()
+    start = time.perf_counter()
+    trajectory = model.generate(num_samples=num_samples, **kwargs)
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+    seconds = time.perf_counter() - start
+    if device.type == "cuda":
+        peak = (torch.cuda.max_memory_allocated(device) - base) / 2**20
+    else:
+        peak = rss_peak_mb() - base
+
+    # The fixed-step solvers leave the final samples in the second to last slot.
+    samples = trajectory[-1] if setting["method"] == "adaptive" else trajectory[-2]
+    return samples.cpu(), {"seconds": seconds, "nfe": exporter.nfe_per_sample.value, "peak_mb": max(peak, 0.0)}
+
+
+def pareto_frontier(results, cost, metric):
+    """Indices of the results that are cheapest for their quality, in order of cost."""
+    frontier, best = [], float("inf")
+    for i in sorted(range(len(results)), key=lambda i: (results[i][cost], results[i][metric])):
+        if results[i][metric] < best:
+            frontier.append(i)
+            best = results[i][metric]
+    return frontier
+
+
+def label(result):
+    if result["method"] == "adaptive":
+        return f"adaptive tol={result['tol']:g}"
+    return f"{result['method']} {result['steps']} {result['time_grid']}"
+
+
+def plot(results, frontier, cost, metric, filename):
+    import matplotlib.pyplot as plt
+
+    fig, ax = plt.subplots(figsize=(7, 5))
+    for method in dict.fromkeys(r["method"] for r in results):
+        points = [r for r in results if r["method"] == method]
+        ax.scatter([r[cost] for r in points], [r[metric] for r in points], s=12, alpha=0.6, label=method)
+    front = [results[i] for i in frontier]
+    ax.step([r[cost] for r in front], [r[metric] for r in front], where="post", c="black", lw=1, label="Pareto frontier")
+    for r in front:
+        ax.annotate(label(r), (r[cost], r[metric]), fontsize=6, xytext=(3, 3), textcoords="offset points")
+    ax.set_xscale("log")
+    ax.set_xlabel({"nfe": "NFE per sample", "seconds": "Seconds per generate call"}[cost])
+    ax.set_ylabel(metric)
+    ax.legend()
+    fig.tight_layout()
+    fig.savefig(filename)
+    plt.close(fig)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Sampler quality versus compute benchmark')
+    parser.add_argument('checkpoint', type=str, help="Checkpoint, state dict or checkpoint directory of a trained VFM")
+    parser.add_argument('--num_samples', default=1024, type=int, help="Samples per setting, and held-out samples to compare against")
+    parser.add_argument('--methods', nargs='+', default=['euler', 'midpoint', 'adaptive'], choices=['euler', 'midpoint', 'adaptive'], help="generate methods to sweep")
+    parser.add_argument('--steps', nargs='+', default=[5, 10, 20, 50, 100, 200], type=int, help="Step counts of the fixed-step methods")
+    parser.add_argument('--time_grids', nargs='+', default=list(TIME_GRIDS), choices=list(TIME_GRIDS), help="Time grids of the fixed-step methods")
+    parser.add_argument('--tolerances', nargs='+', default=[1e-2, 1e-3, 1e-4, 1e-5], type=float, help="atol and rtol of the adaptive solver")
+    parser.add_argument('--cost', default='nfe', choices=['nfe', 'seconds'], help="Cost axis of the Pareto frontier")
+    parser.add_argument('--quality_bar', default=None, type=float, help="Report the cheapest setting with at most this distance")
+    parser.add_argument('--sigma', default=None, type=float, help="Interpolator sigma if the checkpoint does not record it")
+    parser.add_argument('--device', default='cpu', type=str, help="Device to sample on")
+    parser.add_argument('--seed', default=0, type=int, help="Seed of the prior samples, shared by all settings")
+    parser.add_argument('--out', default='sampler_pareto.json', type=str, help="Write all results to this JSON file")
+    parser.add_argument('--plot', default='sampler_pareto.png', type=str, help="Write the quality-versus-cost plot to this file")
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    model = load_vfm(args.checkpoint, device, args.sigma)
+    metric, quality = get_quality_fn(model, args, device)
+
+    # Warm up each method once, so that one-off costs such as importing the ODE solver are not timed.
+    for method in args.methods:
+        model.generate(num_samples=8, steps=3, device=device, method=method)
+
+    results = []
+    for setting in get_settings(args):
+        samples, stats = run(model, setting, args.num_samples, device, args.seed)
+        results.append({**setting, **stats, metric: quality(samples)})
+        r = results[-1]
+        print(f"{label(r):28s} {r['nfe']:7.0f} NFE {r['seconds']:9.3f} s {r['peak_mb']:8.1f} MB {metric} {r[metric]:.4f}", flush=True)
+
+    frontier = pareto_frontier(results, args.cost, metric)
+    print(f"\nPareto frontier ({args.cost} against {metric}):")
+    print(f"  {'setting':28s} {'NFE':>7s} {'seconds':>9s} {'peak MB':>8s} {metric:>10s}")
+    for r in (results[i] for i in frontier):
+        print(f"* {label(r):28s} {r['nfe']:7.0f} {r['seconds']:9.3f} {r['peak_mb']:8.1f} {r[metric]:10.4f}")
+
+    cheapest = None
+    if args.quality_bar is not None:
+        meeting = [results[i] for i in frontier if results[i][metric] <= args.quality_bar]
+        cheapest = meeting[0] if meeting else None
+        if cheapest is None:
+            print(f"No setting reaches {metric} <= {args.quality_bar}")
+        else:
+            print(f"Cheapest setting with {metric} <= {args.quality_bar}: {label(cheapest)}")
+
+    with open(args.out, "w") as f:
+        json.dump({
+            "checkpoint": args.checkpoint, "metric": metric, "cost": args.cost, "num_samples": args.num_samples,
+            "results": results, "frontier": frontier, "cheapest": cheapest,
+        }, f, indent=2)
+    plot(results, frontier, args.cost, metric, args.plot)
+
+
+if __name__ == "__main__":
+    main()
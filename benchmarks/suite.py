@@ -0,0 +1,288 @@
+"""Time, throughput and peak memory of the main VFM code paths, compared against a baseline.
+
+    python benchmarks/suite.py --out bench.json                    # run everything
+    python benchmarks/suite.py --filter generate unet --quick       # a subset, fewer repeats
+    python benchmarks/suite.py --baseline benchmarks/baseline.json  # fail on regressions
+    python benchmarks/suite.py --save_baseline benchmarks/baseline.json
+
+Cases cover main.py's train step (dataset x loss x sigma), the variational posterior's
+forward and log_prob, prior sampling, FlowModel.generate per method and step count, and the
+UNet forward and backward at several widths. Training batches are synthetic tensors of the
+dataset's shape, so no data needs to be downloaded. Each case reports the median seconds per
+call, items per second and the peak memory above the level before the case (CUDA allocator
+peak on GPU, resident set high-water mark on CPU). Against a baseline, a case regresses when
+its time or peak memory exceeds the baseline's by more than the threshold; the exit status
+is 1 if any case regressed. Baselines are only comparable on the same host and device.
+"""
+import argparse
+import json
+import os
+import platform
+import socket
+import statistics
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import torch
+
+from xvfm.memory import current_rss_mb, rss_peak_mb, reset_rss_peak
+
+DATASETS = ("two_moons", "mnist")
+LOSSES = ("MSE", "Gaussian")
+SIGMAS = ("fixed", "scalar", "vector")
+GENERATE_STEPS = (10, 100)
+UNET_WIDTHS = (32, 64, 128)  # GroupNorm needs multiples of 32
+
+
+def _sync(device):
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+
+
+def measure(fn, items, device, repeats, warmup):
+    """Median seconds per call of fn(), items per second and peak memory above the start (MB)."""
+    for _ in range(warmup):
+        fn()
+    _sync(device)
+    if device.type == "cuda":
+        torch.cuda.reset_peak_memory_stats(device)
+        base = torch.cuda.memory_allocated(device)
+    else:
+        reset_rss_peak()
+        base = current_rss_mb()
+
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        _sync(device)
+        times.append(time.perf_counter() - start)
+
+    if device.type == "cuda":
+        peak = (torch.cuda.max_memory_allocated(device) - base) / 2**20
+    else:
+        peak = rss_peak_mb() - base
+    seconds = statistics.median(times)
+    return {"seconds": seconds, "throughput": items / seconds, "peak_mb": max(peak, 0.0)}
+
+
+def get_args(dataset, sigma="scalar", loss="Gaussian", batch_size=256):
+    import main
+
+    args = main.get_args(["--dataset", dataset, "--loss_fn", loss, "--batch_size", str(batch_size)])
+    args.learn_sigma = sigma != "fixed"
+    args.learned_structure = "scalar" if sigma == "fixed" else sigma
+    return args
+
+
+def _batch(dataset, n, device):
+    return torch.randn(n, *((1, 28, 28) if dataset == "mnist" else (2,)), device=device)
+
+
+def train_step_cases(device, batch_sizes, selected):
+    import main
+
+    for dataset in DATASETS:
+        for loss in LOSSES:
+            for sigma in SIGMAS:
+                name = f"train_step/{dataset}/{loss}/{sigma}"
+                if not selected(name):
+                    continue
+                args = get_args(dataset, sigma, loss, batch_sizes[dataset])
+                torch.manual_seed(args.seed)
+                model = main.get_flow_model(args, device)
+                params = model.variational_dist.get_parameters()
+                optimizer = torch.optim.Adam(params, lr=args.lr)
+                loss_fn = main.get_loss_fn(model, main.CRITERION_MAP[args.loss_fn], device, args)
+                x_1 = _batch(dataset, args.batch_size, device)
+
+                def run(loss_fn=loss_fn, optimizer=optimizer, x_1=x_1, args=args, params=params):
+                    main.train_step(loss_fn, optimizer, x_1, args, params)
+
+                yield name, run, args.batch_size
+
+
+def variational_cases(device, batch_sizes, selected):
+    import main
+
+    for dataset in DATASETS:
+        for sigma in SIGMAS:
+            prefix = f"variational/{dataset}/{sigma}"
+            if not (selected(f"{prefix}/forward") or selected(f"{prefix}/log_prob")):
+                continue
+            args = get_args(dataset, sigma)
+            torch.manual_seed(args.seed)
+            model = main.get_flow_model(args, device)
+            dist = model.variational_dist
+            n = batch_sizes[dataset]
+            x_1 = _batch(dataset, n, device)
+            t, x_t = model.sample_t_and_x_t(x_1)
+            x_1 = x_1.view(n, -1)
+
+            @torch.no_grad()
+            def forward(dist=dist, x_t=x_t, t=t):
+                dist(x_t, t)
+
+            @torch.no_grad()
+            def log_prob(dist=dist, x_t=x_t, t=t, x_1=x_1):
+                dist(x_t, t).log_prob(x_1)
+
+            yield f"{prefix}/forward", forward, n
+            yield f"{prefix}/log_prob", log_prob, n
+
+
+def prior_cases(device, batch_sizes, selected):
+    from xvfm.prior import StandardGaussianPrior, MultiGaussianPrior
+
+    for name, prior in (("multi_gaussian", MultiGaussianPrior(2)), ("standard_gaussian_784", StandardGaussianPrior(28**2))):
+        n = 4096
+        yield f"prior/{name}", lambda prior=prior, n=n: prior.sample(n), n
+
+
+def generate_cases(device, batch_sizes, selected):
+    import main
+
+    for dataset in DATASETS:
+        methods = ("euler", "adaptive") if dataset == "two_moons" else ("euler",)
+        names = {
+            (method, steps): f"generate/{dataset}/{method}/{steps}" for method in methods for steps in GENERATE_STEPS
+        }
+        if not any(selected(name) for name in names.values()):
+            continue
+        args = get_args(dataset)
+        torch.manual_seed(args.seed)
+        model = main.get_flow_model(args, device).eval()
+        n = 1024 if dataset == "two_moons" else 16
+        for method in methods:
+            for steps in GENERATE_STEPS:
+                def run(model=model, n=n, steps=steps, method=method):
+                    model.generate(num_samples=n, steps=steps, device=device, method=method)
+
+                yield names[method, steps], run, n * steps
+
+
+def unet_cases(device, batch_sizes, selected):
+    from xvfm.unet import UNetModel
+
+    n = batch_sizes["mnist"]
+    for width in UNET_WIDTHS:
+        if not (selected(f"unet/{width}/forward") or selected(f"unet/{width}/backward")):
+            continue
+        torch.manual_seed(0)
+        model = UNetModel(dim=(1, 28, 28), num_channels=width, num_res_blocks=1).to(device)
+        x = torch.randn(n, 1, 28, 28, device=device)
+        t = torch.rand(n, device=device)
+
+        @torch.no_grad()
+        def forward(model=model, x=x, t=t):
+            model(x, t)
+
+        def backward(model=model, x=x, t=t):
+            model.zero_grad(set_to_none=True)
+            model(x, t).square().mean().backward()
+
+        yield f"unet/{width}/forward", forward, n
+        yield f"unet/{width}/backward", backward, n
+
+
+# Each group yields (name, fn, items) and only builds the models of cases selected(name) accepts.
+GROUPS = {
+    "train_step": train_step_cases,
+    "variational": variational_cases,
+    "prior": prior_cases,
+    "generate": generate_cases,
+    "unet": unet_cases,
+}
+
+
+def compare(results, baseline, threshold, memory_threshold):
+    """Cases whose time or peak memory grew beyond the thresholds relative to the baseline."""
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if base is None:
+            continue
+        time_ratio = result["seconds"] / base["seconds"]
+        # Peaks of a few MB are allocator noise; only compare them above 1 MB.
+        memory_ratio = result["peak_mb"] / base["peak_mb"] if base["peak_mb"] > 1 else 1.0
+        if time_ratio > 1 + threshold or memory_ratio > 1 + memory_threshold:
+            regressions.append((name, time_ratio, memory_ratio))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='VFM benchmark suite')
+    parser.add_argument('--filter', nargs='+', default=None, help="Only run cases whose name contains one of these strings")
+    parser.add_argument('--repeats', default=10, type=int, help="Timed calls per case; the median is reported")
+    parser.add_argument('--warmup', default=2, type=int, help="Untimed calls per case before timing")
+    parser.add_argument('--quick', action='store_true', help="Three repeats and one warm-up call per case")
+    parser.add_argument('--batch_size', default=256, type=int, help="Batch size of the two_moons cases")
+    parser.add_argument('--mnist_batch_size', default=32, type=int, help="Batch size of the MNIST and UNet cases")
+    parser.add_argument('--device', default=None, type=str, help="Device to benchmark on (default: cuda if available)")
+    parser.add_argument('--out', default=None, type=str, help="Write the results to this JSON file")
+    parser.add_argument('--baseline', default=None, type=str, help="Compare against the results in this JSON file")
+    parser.add_argument('--threshold', default=0.1, type=float, help="Allowed relative slowdown before a case counts as a regression")
+    parser.add_argument('--memory_threshold', default=0.2, type=float, help="Allowed relative peak memory growth before a case counts as a regression")
+    parser.add_argument('--save_baseline', default=None, type=str, help="Write the results to this file as the new baseline")
+    args = parser.parse_args()
+    if args.quick:
+        args.repeats, args.warmup = 3, 1
+
+    device = torch.device(args.device or ("cuda" if torch.cuda.is_available() else "cpu"))
+    batch_sizes = {"two_moons": args.batch_size, "mnist": args.mnist_batch_size}
+    baseline = None
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)["results"]
+
+    def selected(name):
+        return not args.filter or any(s in name for s in args.filter)
+
+    # Generators skip building the models of cases the filter excludes; pairs of cases that share
+    # a model may still yield an excluded case, so the filter is checked again here.
+    results = {}
+    for group, cases in GROUPS.items():
+        for name, fn, items in cases(device, batch_sizes, selected):
+            if not selected(name):
+                continue
+            results[name] = measure(fn, items, device, args.repeats, args.warmup)
+            r = results[name]
+            line = f"{name:45s} {r['seconds'] * 1e3:10.3f} ms {r['throughput']:14.1f} items/s {r['peak_mb']:9.1f} MB"
+            if baseline is not None and name in baseline:
+                line += f"  {r['seconds'] / baseline[name]['seconds']:6.2f}x"
+            print(line, flush=True)
+
+    report = {
+        "meta": {
+            "host": socket.gethostname(),
+            "device": str(device),
+            "torch": torch.__version__,
+            "python": platform.python_version(),
+            "threads": torch.get_num_threads(),
+            "repeats": args.repeats,
+            "batch_sizes": batch_sizes,
+            "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+        },
+        "results": results,
+    }
+    for path in (args.out, args.save_baseline):
+        if path is not None:
+            with open(path, "w") as f:
+                json.dump(report, f, indent=2)
+
+    if baseline is not None:
+        regressions = compare(results, baseline, args.threshold, args.memory_threshold)
+        for name, time_ratio, memory_ratio in regressions:
+            print(f"REGRESSION {name}: time {time_ratio:.2f}x, peak memory {memory_ratio:.2f}x")
+        missing = sorted(set(baseline) - set(results))
+        if missing and not args.filter:
+            print(f"Cases in the baseline that did not run: {', '.join(missing)}")
+        print(f"{len(regressions)} of {len(results)} cases regressed against {args.baseline}")
+        sys.exit(1 if regressions else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,13 @@
 import torch
-from sklearn.datasets import make_moons
+from torch.utils.data.distributed import DistributedSampler
 
-def generate_two_moons(n_samples=50000, batch_size=256):
-    train_dataset, _ = make_moons(n_samples=n_samples)
+def generate_two_moons(n_samples=50000, batch_size=256, num_replicas=1, rank=0, seed=None, num_workers=0):
+    from sklearn.datasets import make_moons
+
+    train_dataset, _ = make_moons(n_samples=n_samples, random_state=seed)
     train_dataset = torch.tensor(train_dataset, dtype=torch.float32)
-    train_loader =torch.utils.data.DataLoader(train_dataset, batch_size=batch_size)
-    return train_loader
\ No newline at end of file
+    sampler = None
+    if num_replicas > 1:
+        sampler = DistributedSampler(train_dataset, num_replicas=num_replicas, rank=rank, shuffle=False)
+    train_loader =torch.utils.data.DataLoader(train_dataset, batch_size=batch_size, sampler=sampler, num_workers=num_workers)
+    return train_loader
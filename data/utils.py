@@ -1,26 +1,63 @@
 import torch
-import ignite
-import matplotlib.pyplot as plt
 
-from fid import FIDNet
+from xvfm.profiling import phase
+
+def generate_samples(args, model, device, trajectory=True):
+    """The sampling trajectory (or only its final samples) that evaluate scores and plots.
+
+    With args.sample_bank set, samples are drawn with args.seed and kept in the bank, so an
+    unchanged model is integrated only once per sampler setting.
+    """
+    num_samples = 1024 if args.dataset == 'two_moons' else 100
+
+    def generate():
+        traj = model.generate(
+            num_samples=num_samples,
+            steps=args.integration_steps,
+            device=device,
+            method=args.int_method
+        )
+        return traj if trajectory else traj[-2]
+
+    if getattr(args, "sample_bank", None) is None:
+        return generate()
+
+    from xvfm.samplebank import SampleBank, model_digest
+
+    def generate_seeded():
+        # Leaves the caller's random state (e.g. the training stream) untouched.
+        with torch.random.fork_rng(devices=[device] if device.type == "cuda" else []):
+            torch.manual_seed(args.seed)
+            return generate()
+
+    bank = SampleBank(args.sample_bank, args.sample_bank_mb)
+    digest = model_digest(model)
+
+    def key(trajectory):
+        return bank.key(
+            digest, method=args.int_method, steps=args.integration_steps, time_grid="uniform",
+            seed=args.seed, num_samples=num_samples, trajectory=trajectory,
+        )
+
+    samples = bank.get_or_generate(key(trajectory), generate_seeded)
+    if trajectory and bank.get(key(False)) is None:
+        # Also keep the final samples on their own, the entry batch scoring looks up.
+        bank.put(key(False), samples[-2].contiguous())
+    return samples.to(device)
 
-from ignite.metrics import FID
-from torchvision.utils import make_grid
-from torchvision.datasets import MNIST
-from torchvision.transforms import Compose, Normalize, ToTensor, ToPILImage
 
 def evaluate(args, model, savedir, plot: bool, device=None, suffix: str = None):
+    """Plot samples of `model` and return the FID for MNIST; two_moons is only plotted, so
+    it returns None (and does nothing without `plot`)."""
+    import matplotlib.pyplot as plt
+
     if device is None:
         device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
-    traj = model.generate(
-        num_samples=1024 if args.dataset == 'two_moons' else 100, 
-        steps=args.integration_steps, 
-        device=device,
-        method=args.int_method
-    )
-
-    if args.dataset == 'two_moons' and plot is True:
+    if args.dataset == 'two_moons':
+        if not plot:
+            return None
+        traj = generate_samples(args, model, device)
         n = 2000
         traj = traj.cpu().numpy()
         plt.figure(figsize=(6, 6))
@@ -36,19 +73,12 @@ def evaluate(args, model, savedir, plot: bool, device=None, suffix: str = None):
         return None
 
     else:
-        real_dataset = MNIST(
-            root='data', train=False, download=True, 
-            transform=Compose([ToTensor(), Normalize((0.5,), (0.5,))])
-            )
-        real_loader = torch.utils.data.DataLoader(real_dataset, batch_size=100, shuffle=True)
-        real_images = next(iter(real_loader))[0].to(device)[:100]
-        generated_images = traj[-2, :100].view([-1, 1, 28, 28]).clip(-1, 1).to(device)
-
-        evaluator = FIDNet()
-        evaluator.load_state_dict(torch.load("checkpoints/fid_model.pt"))
-        m = FID(num_features=10, device=device, feature_extractor=evaluator)
-        m.update((real_images, generated_images))
-        fid = m.compute()
+        from torchvision.utils import make_grid
+        from torchvision.transforms import ToPILImage
+
+        samples = generate_samples(args, model, device, trajectory=False)
+        generated_images = samples[:100].view([-1, 1, 28, 28]).clip(-1, 1).to(device)
+        fid = compute_fid(generated_images, device)
 
         if plot:
             grid = make_grid(generated_images, value_range=(-1, 1), padding=0, nrow=10)
@@ -60,4 +90,39 @@ def evaluate(args, model, savedir, plot: bool, device=None, suffix: str = None):
             plt.savefig(filename)
             plt.close()
 
-        return fid
\ No newline at end of file
+        return fid
+
+
+def mnist_test_images(num_images, device=None):
+    from torchvision.datasets import MNIST
+    from torchvision.transforms import Compose, Normalize, ToTensor
+
+    real_dataset = MNIST(
+        root='data', train=False, download=True,
+        transform=Compose([ToTensor(), Normalize((0.5,), (0.5,))])
+        )
+    real_loader = torch.utils.data.DataLoader(real_dataset, batch_size=num_images, shuffle=True)
+    return next(iter(real_loader))[0].to(device)
+
+
+def load_fid_extractor(path="checkpoints/fid_model.pt"):
+    from fid import FIDNet
+
+    evaluator = FIDNet()
+    evaluator.load_state_dict(torch.load(path, map_location="cpu"))
+    return evaluator
+
+
+def compute_fid(generated_images, device=None, real_images=None):
+    """FID of [N, 1, 28, 28] images in [-1, 1] against as many MNIST test images, in the
+    feature space of the classifier in checkpoints/fid_model.pt."""
+    # FID needs ignite and torchvision, which two_moons runs never have to import.
+    from ignite.metrics import FID
+
+    if real_images is None:
+        real_images = mnist_test_images(generated_images.shape[0], device)
+    with phase("fid"):
+        evaluator = load_fid_extractor()
+        m = FID(num_features=10, device=device, feature_extractor=evaluator)
+        m.update((real_images, generated_images))
+        return m.compute()
@@ -0,0 +1,216 @@
+"""Score every trained VFM under checkpoints/ and results/ in one job.
+
+    python evaluate_checkpoints.py checkpoints results --workers 4 --out results/evaluation.csv
+
+Checkpoints are the periodic checkpoints and --save_model files of main.py (.pt) and checkpoint
+directories from xvfm.checkpoint; other .pt files (ensembles, FIDNet, samples) are skipped.
+The evaluator state is built once in the parent: for MNIST the FIDNet extractor and the feature
+statistics of the MNIST test set, for two_moons a held-out set of moons. Checkpoints are then
+scored in a process pool whose workers are pinned to disjoint cores (FID for MNIST, sliced
+Wasserstein distance for two_moons). By default the FID compares as many generated and test
+images as evaluate in main.py does, so the two are comparable. Generated samples are kept in the sample bank
+(xvfm.samplebank) under the model weights and sampler settings, so re-scoring an unchanged tree
+only recomputes the metrics. All scores go to one table, written as CSV and JSON.
+"""
+import os
+import csv
+import json
+import time
+import argparse
+import torch
+import torch.multiprocessing as mp
+
+from xvfm.runtime import MU_PREFIX, load_vfm, sample
+from xvfm.checkpoint import load_checkpoint, read_index
+from xvfm.metrics import sliced_wasserstein
+from xvfm.samplebank import SampleBank, model_digest
+
+SKIP = ("fid_model", "samples", "ensemble_member", "multihead")
+
+_worker = {}
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='Batch evaluation of trained VFM checkpoints')
+    parser.add_argument('roots', nargs='*', default=['checkpoints', 'results'], help="Directories searched for checkpoints")
+    parser.add_argument('--workers', default=2, type=int, help="Number of checkpoints scored concurrently")
+    parser.add_argument('--threads_per_worker', default=None, type=int, help="Cores pinned to each worker (default: cores / workers)")
+    parser.add_argument('--num_samples', default=None, type=int, help="Samples per checkpoint (default: 1024 for two_moons, 100 for MNIST, as in evaluate)")
+    parser.add_argument('--num_real', default=None, type=int, help="MNIST test images in the FID reference statistics (default: --num_samples, as in evaluate; other values give FIDs not comparable with main.py's)")
+    parser.add_argument('--integration_steps', default=100, type=int, help="Number of Euler integration steps")
+    parser.add_argument('--seed', default=42, type=int, help="Seed of the prior samples and the held-out data")
+    parser.add_argument('--sample_bank', default='results/sample_bank', type=str, help="Sample bank shared with main.py --sample_bank")
+    parser.add_argument('--sample_bank_mb', default=2048, type=int, help="Size limit of the sample bank; least recently used entries are evicted")
+    parser.add_argument('--no_cache', action='store_true', help="Regenerate samples even if they are in the sample bank")
+    parser.add_argument('--out', default='results/evaluation.csv', type=str, help="Results table (a .json copy is written alongside)")
+    return parser.parse_args()
+
+
+def get_dataset(path):
+    """'two_moons' or 'mnist' for a VFM checkpoint, None for anything else. Reads no weights."""
+    try:
+        if os.path.isdir(path):
+            shapes = {k: shape for k, (_, shape) in read_index(path).items()}
+        else:
+            checkpoint = torch.load(path, map_location="cpu", mmap=True)
+            state_dict = checkpoint.get("model", checkpoint) if isinstance(checkpoint, dict) else {}
+            shapes = {k: tuple(v.shape) for k, v in state_dict.items() if torch.is_tensor(v)}
+    except Exception:
+        return None
+    if MU_PREFIX + "net.0.weight" in shapes:
+        return "two_moons"
+    if any(k.startswith(MU_PREFIX) for k in shapes):
+        return "mnist"
+    return None
+
+
+def discover(roots):
+    checkpoints = []
+    for root in roots:
+        for dirpath, dirnames, filenames in os.walk(root):
+            if os.path.exists(os.path.join(dirpath, "model.safetensors")):
+                checkpoints.append(dirpath)
+                dirnames.clear()
+                continue
+            checkpoints += [
+                os.path.join(dirpath, f) for f in sorted(filenames)
+                if f.endswith(".pt") and not any(name in f for name in SKIP)
+            ]
+    found = []
+    for path in checkpoints:
+        dataset = get_dataset(path)
+        if dataset is not None:
+            found.append((path, dataset))
+    return found
+
+
+def fid_features(extractor, images, batch_size=500):
+    with torch.no_grad():
+        return torch.cat([extractor(images[i:i + batch_size]) for i in range(0, len(images), batch_size)]).double()
+
+
+def feature_statistics(features):
+    return features.mean(0), torch.cov(features.T)
+
+
+def get_references(datasets, args):
+    """Evaluator state shared by every worker, built once."""
+    references = {}
+    if "two_moons" in datasets:
+        from sklearn.datasets import make_moons
+
+        n = args.num_samples or 1024
+        references["two_moons"] = torch.tensor(make_moons(n, random_state=args.seed + 1)[0], dtype=torch.float32)
+    if "mnist" in datasets:
+        from data.utils import load_fid_extractor, mnist_test_images
+
+        extractor = load_fid_extractor().eval()
+        real_images = mnist_test_images(args.num_real or args.num_samples or 100)
+        references["mnist"] = (extractor.state_dict(), feature_statistics(fid_features(extractor, real_images)))
+    return references
+
+
+def init_worker(slots, threads, references, args):
+    slot = slots.get()
+    if hasattr(os, "sched_setaffinity"):
+        cores = sorted(os.sched_getaffinity(0))
+        os.sched_setaffinity(0, cores[slot * threads:(slot + 1) * threads] or cores)
+    torch.set_num_threads(threads)
+    if "mnist" in references:
+        from data.utils import load_fid_extractor
+
+        state_dict, statistics = references["mnist"]
+        extractor = load_fid_extractor()
+        extractor.load_state_dict(state_dict)
+        references = {**references, "mnist": (extractor.eval(), statistics)}
+    _worker.update(references=references, args=args)
+
+
+def score(samples, dataset, references, seed):
+    if dataset == "two_moons":
+        generator = torch.Generator().manual_seed(seed)
+        return "sliced_wasserstein", sliced_wasserstein(samples, references["two_moons"], generator=generator)
+
+    from ignite.metrics.gan.fid import fid_score
+
+    extractor, (mu, sigma) = references["mnist"]
+    images = samples.view(-1, 1, 28, 28).clip(-1, 1)
+    fake_mu, fake_sigma = feature_statistics(fid_features(extractor, images))
+    return "fid", fid_score(fake_mu, mu, fake_sigma, sigma)
+
+
+def evaluate_checkpoint(task):
+    path, dataset = task
+    args = _worker["args"]
+    num_samples = args.num_samples or (1024 if dataset == "two_moons" else 100)
+    config = os.path.basename(path).split(".")[0]
+    if config == "model":
+        # --save_model writes results/<dataset>/<config>/model.pt
+        config = os.path.basename(os.path.dirname(path))
+    result = {"checkpoint": path, "dataset": dataset, "config": config, "epoch": None}
+    start = time.time()
+    try:
+        model = load_vfm(path)
+        # The final-samples key of data.utils.generate_samples, so entries written by evaluate are reused.
+        bank = SampleBank(args.sample_bank, args.sample_bank_mb)
+        key = bank.key(
+            model_digest(model), method="euler", steps=args.integration_steps, time_grid="uniform",
+            seed=args.seed, num_samples=num_samples, trajectory=False,
+        )
+        samples = None if args.no_cache else bank.get(key)
+        cached = samples is not None
+        if not cached:
+            torch.manual_seed(args.seed)
+            samples = sample(model, num_samples, args.integration_steps)
+            bank.put(key, samples)
+        if os.path.isdir(path):
+            epoch = load_checkpoint(path).get("epoch")
+        else:
+            epoch = torch.load(path, map_location="cpu", mmap=True).get("epoch")
+        metric, value = score(samples, dataset, _worker["references"], args.seed)
+        result.update(epoch=epoch, metric=metric, score=value, cached=cached)
+    except Exception as e:
+        result.update(metric=None, score=None, cached=False, error=repr(e))
+    result["seconds"] = time.time() - start
+    return result
+
+
+def main():
+    args = get_args()
+    threads = args.threads_per_worker or max(1, (os.cpu_count() or 1) // args.workers)
+
+    tasks = discover(args.roots)
+    datasets = {dataset for _, dataset in tasks}
+    print(f"Scoring {len(tasks)} checkpoints on {args.workers} workers x {threads} threads")
+    references = get_references(datasets, args)
+
+    ctx = mp.get_context("spawn")
+    manager = ctx.Manager()
+    slots = manager.Queue()
+    for slot in range(args.workers):
+        slots.put(slot)
+
+    results = []
+    with ctx.Pool(args.workers, initializer=init_worker, initargs=(slots, threads, references, args)) as pool:
+        for result in pool.imap_unordered(evaluate_checkpoint, tasks):
+            print(f"Finished: {result}")
+            results.append(result)
+    manager.shutdown()
+
+    results.sort(key=lambda r: (r["dataset"], r["score"] is None, r["score"] or 0.0, r["checkpoint"]))
+    os.makedirs(os.path.dirname(args.out) or ".", exist_ok=True)
+    columns = ["checkpoint", "dataset", "config", "epoch", "metric", "score", "cached", "seconds", "error"]
+    with open(args.out, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=columns, restval="")
+        writer.writeheader()
+        writer.writerows(results)
+    with open(os.path.splitext(args.out)[0] + ".json", "w") as f:
+        json.dump(results, f, indent=2)
+
+    for r in results:
+        value = "error" if r["score"] is None else f"{r['score']:.4f}"
+        print(f"{r['dataset']:10s} {r['metric'] or '-':20s} {value:>10s}  {r['checkpoint']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,21 +1,30 @@
 import os
+import sys
+import time
 import torch
 import argparse
-import wandb
 
-from torchvision import datasets, transforms
-
-from tqdm import tqdm
+from torch.utils.data.distributed import DistributedSampler
 from pathlib import Path
 from xvfm.flow import VFM
 from xvfm.unet import UNetModel
 from data.utils import evaluate
 from xvfm.prior import StandardGaussianPrior, MultiGaussianPrior
 from xvfm.models import MLP
-from data.two_moons import generate_two_moons
 from xvfm.variational import GaussianVariationalDist
 from xvfm.interpolator import OTInterpolator
-from torchvision.transforms import Compose, Normalize, ToTensor, ToPILImage
+from xvfm.memory import find_microbatch
+from xvfm.compiled import CompiledLoss, time_loss_step
+from xvfm.metrics import MetricAccumulator
+from xvfm.checkpoint import save_checkpoint
+from xvfm.autotune import DEFAULT_PROFILE, apply_profile
+from xvfm.profiling import enable_phases, phase, phase_keys, timed, ProfilerWindow
+from xvfm.unet import logger
+from xvfm import exporter
+from xvfm.distributed import (
+    setup, cleanup, launch, get_rank, get_world_size, is_main_process,
+    broadcast_parameters, broadcast_object, allreduce_gradients, ShardedOptimizer
+)
 
 from xvfm.loss import SSMGaussian
 
@@ -27,7 +36,7 @@ CRITERION_MAP = {
 }
 
 
-def get_args():
+def get_args(argv=None):
     """Parse and return command-line arguments."""
     parser = argparse.ArgumentParser(description='Two Moon Experiment')
     parser.add_argument('--num_epochs', default=10, type=int, help="Number of training epochs")
@@ -36,7 +45,7 @@ def get_args():
     parser.add_argument('--loss_fn', default='Gaussian', type=str, help="Loss function for VFM: 'MSE', 'SSM', or 'Gaussian'")
     parser.add_argument('--learn_sigma', type=bool, default=True, help="Flag to learn sigma in VFM")
     parser.add_argument('--learned_structure', default='scalar', help="Flag to learn structure in VFM")
-    parser.add_argument('--int_method', default='euler', help="Integration method for trajectory plotting: 'euler', 'adaptive'")
+    parser.add_argument('--int_method', default='euler', help="Integration method for trajectory plotting: 'euler', 'midpoint', 'adaptive'")
     parser.add_argument('--integration_steps', default=100, type=int, help="Number of steps for integration in trajectory plotting")
     parser.add_argument('--sigma', default=0.1, type=float, help="Sigma parameter for flow model")
     parser.add_argument('--save_model', action='store_true', help="Flag to save the trained model")
@@ -46,7 +55,32 @@ def get_args():
     parser.add_argument('--checkpoint_interval', default=100, type=int, help="Interval to save checkpoints")
     parser.add_argument('--checkpoint_dir', default='checkpoints', type=str, help="Directory to save checkpoints")
     parser.add_argument('--results_dir', default='results', type=str, help="Directory to save results")
-    return parser.parse_args()
+    parser.add_argument('--world_size', default=1, type=int, help="Number of local data-parallel training processes")
+    parser.add_argument('--dist_backend', default='gloo', type=str, help="torch.distributed backend for multi-process training")
+    parser.add_argument('--bucket_cap_mb', default=25, type=int, help="Size of the gradient all-reduce buckets in MB")
+    parser.add_argument('--zero', action='store_true', help="Shard the optimizer state across data-parallel ranks")
+    parser.add_argument('--max_microbatch', default=0, type=int, help="Largest micro-batch per forward/backward; batches are accumulated up to --batch_size (0 disables)")
+    parser.add_argument('--auto_microbatch', action='store_true', help="Probe training steps to pick the largest micro-batch within the memory budget")
+    parser.add_argument('--compile', action='store_true', help="Compile the training loss with torch.compile")
+    parser.add_argument('--compile_benchmark', default=0, type=int, help="Time this many eager and compiled steps before training and report the speedup (benchmarks/compile_speedup.py covers every dataset and structure)")
+    parser.add_argument('--profile_phases', action='store_true', help="Time each training phase and log per-epoch totals")
+    parser.add_argument('--torch_profile', default=None, type=int, nargs=2, metavar=('START', 'END'), help="Record a torch.profiler Chrome trace for global steps [START, END)")
+    parser.add_argument('--trace_memory', action='store_true', help="Log the peak RSS (and CUDA allocator) memory of each training and sampling phase")
+    parser.add_argument('--memory_report', default=0, type=int, help="With --torch_profile, also profile allocations and report the top allocating call stacks of this depth")
+    parser.add_argument('--wandb_mode', default='online', choices=['online', 'offline', 'disabled', 'local'], help="wandb mode; 'local' skips wandb and writes a wandb-style run directory through the logger")
+    parser.add_argument('--log_queue_size', default=1024, type=int, help="Queue size of the background logger sinks (0 writes on the training thread)")
+    parser.add_argument('--memory_budget_mb', default=None, type=float, help="Memory budget for --auto_microbatch (default: 80%% of available memory)")
+    parser.add_argument('--checkpoint_format', default='torch', choices=['torch', 'mmap'], help="'mmap' writes checkpoint directories of memory-mapped tensor files (see xvfm/checkpoint.py)")
+    parser.add_argument('--num_threads', default=None, type=int, help="Intra-op threads (default: from the autotune profile, else torch's default)")
+    parser.add_argument('--num_interop_threads', default=None, type=int, help="Inter-op threads (default: from the autotune profile, else torch's default)")
+    parser.add_argument('--num_workers', default=None, type=int, help="DataLoader worker processes (default: from the autotune profile, else 0)")
+    parser.add_argument('--channels_last', default=None, action='store_const', const=True, help="Use the channels-last memory format for the UNet (default: from the autotune profile)")
+    parser.add_argument('--autotune_profile', default=DEFAULT_PROFILE, type=str, help="Profile written by python -m xvfm.autotune")
+    parser.add_argument('--sample_bank', default=None, type=str, help="Directory caching evaluation samples per model and sampler setting (samples then use --seed)")
+    parser.add_argument('--sample_bank_mb', default=2048, type=int, help="Size limit of the sample bank; least recently used entries are evicted")
+    parser.add_argument('--metrics_port', default=None, type=int, help="Serve live Prometheus metrics on 127.0.0.1 at this port (plus the rank)")
+    parser.add_argument('--export_dtype', default=None, choices=['float16', 'bfloat16'], help="Store the --save_model weights in this dtype ('mmap' format only)")
+    return parser.parse_args(argv)
 
 
 def get_model(args):
@@ -89,56 +123,233 @@ def get_directories(args):
         suffix = f"{args.loss_fn}"
     return os.path.join(os.getcwd(), f"{args.results_dir}/{args.dataset}/{suffix}")
 
-def main(args):
-
-    torch.manual_seed(args.seed)
-    savedir = get_directories(args)
-    Path(savedir).mkdir(parents=True, exist_ok=True)
-    Path(args.checkpoint_dir).mkdir(parents=True, exist_ok=True)
-
-    log = wandb.init(project="XVFM", config=vars(args))
-    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-
+def get_flow_model(args, device):
     flow_model = VFM(
         prior=StandardGaussianPrior(28**2) if args.dataset == 'mnist' else MultiGaussianPrior(2),
         variational_dist=GaussianVariationalDist(*get_model(args)),
         interpolator=OTInterpolator(sigma_min=args.sigma),
     ).to(device)
+    if args.channels_last and args.dataset == 'mnist':
+        flow_model.to(memory_format=torch.channels_last)
+    return flow_model
+
+
+def main(args, dataset=None, callback=None):
+    """Train a VFM. `dataset` replaces the loaded training set and callback(epoch, log) may stop
+    training early by returning False. Returns the last epoch's logged metrics."""
+
+    # Distributed ranks already split the host's cores between them in setup().
+    if get_world_size() == 1:
+        apply_profile(args, "train", path=args.autotune_profile)
+
+    # Each rank draws its own prior samples, times and noise; parameters are synced from rank 0 below.
+    torch.manual_seed(args.seed + get_rank())
+    savedir = get_directories(args)
+    Path(savedir).mkdir(parents=True, exist_ok=True)
+    Path(args.checkpoint_dir).mkdir(parents=True, exist_ok=True)
+
+    use_wandb = is_main_process() and args.wandb_mode != 'local'
+    log = None
+    if use_wandb:
+        import wandb
+
+        log = wandb.init(project="XVFM", config=vars(args), mode=args.wandb_mode)
+    format_strs = ["log", "columnar"] + (["wandb"] if args.wandb_mode == 'local' else [])
+    logger.configure(
+        dir=savedir,
+        format_strs=format_strs if is_main_process() else [],
+        comm=logger.TorchDistComm() if get_world_size() > 1 else None,
+        async_queue_size=args.log_queue_size or None,
+        config=vars(args),
+    )
+    enable_phases(args.profile_phases, memory=args.trace_memory)
+    metrics_server = exporter.start_server(args.metrics_port + get_rank()) if args.metrics_port is not None else None
+    if torch.cuda.is_available():
+        device = torch.device("cuda", get_rank() % torch.cuda.device_count())
+    else:
+        device = torch.device("cpu")
 
+    flow_model = get_flow_model(args, device)
     criterion = CRITERION_MAP[args.loss_fn]
     params = flow_model.variational_dist.get_parameters()
-    optimizer = torch.optim.Adam(params, lr=args.lr)
-    
-    print(f"Number of parameters: {sum([p.numel() for p in params])}")
-    print(f"Training parameters: {vars(args)}")
+    broadcast_parameters(flow_model.parameters())
+    if args.zero and get_world_size() > 1:
+        optimizer = ShardedOptimizer(params, torch.optim.Adam, lr=args.lr)
+    else:
+        optimizer = torch.optim.Adam(params, lr=args.lr)
 
-    dataloader = get_dataloader(args)
-    train(dataloader, flow_model, criterion, optimizer, device, savedir, args, log)
+    if is_main_process():
+        print(f"Number of parameters: {sum([p.numel() for p in params])}")
+        print(f"Training parameters: {vars(args)}")
 
-    wandb.finish()
+    dataloader = get_dataloader(args, dataset)
+    if args.auto_microbatch:
+        args.max_microbatch = choose_microbatch(dataloader, flow_model, criterion, optimizer, device, args)
+    if args.compile_benchmark > 0 and is_main_process():
+        report_compile_speedup(dataloader, flow_model, criterion, device, args)
 
-    if args.save_model:
-        torch.save(flow_model.state_dict(), f"{savedir}/model.pt")
+    epoch_log = train(dataloader, flow_model, criterion, optimizer, device, savedir, args, log, callback)
+    logger.get_current().close()
+    if metrics_server is not None:
+        exporter.stop_server(metrics_server)
 
+    if not is_main_process():
+        return epoch_log
 
-def get_dataloader(args):
-    if args.dataset == 'two_moons':
-        return generate_two_moons(256000, args.batch_size)
+    if log is not None:
+        log.finish()
+
+    if args.save_model and args.checkpoint_format == 'mmap':
+        dtype = getattr(torch, args.export_dtype) if args.export_dtype else None
+        save_checkpoint(f"{savedir}/model.ckpt", flow_model.state_dict(), dtype=dtype, args=vars(args))
+    elif args.save_model:
+        torch.save(flow_model.state_dict(), f"{savedir}/model.pt")
+    return epoch_log
+
+
+def choose_microbatch(train_loader, model, criterion, optimizer, device, args):
+    x_1 = next(iter(train_loader))
+    if isinstance(x_1, list):
+        x_1 = x_1[0]
+
+    def probe(n):
+        optimizer.zero_grad()
+        compute_loss(model, criterion, x_1[:n], device, args).backward()
+        optimizer.zero_grad()
+
+    microbatch, records = find_microbatch(probe, x_1.shape[0], device, budget_mb=args.memory_budget_mb)
+    if is_main_process():
+        for record in records:
+            print(f"Micro-batch probe: {record}")
+        print(f"Using micro-batch size {microbatch} for batch size {args.batch_size}")
+        if wandb_run() is not None:
+            wandb_run().config.update({"max_microbatch": microbatch}, allow_val_change=True)
+    return microbatch
+
+
+def wandb_run():
+    """The active wandb run, or None; never imports wandb, which only wandb sinks need."""
+    wandb = sys.modules.get("wandb")
+    return None if wandb is None else wandb.run
+
+
+def run_worker(rank, world_size, args):
+    setup(rank, world_size, backend=args.dist_backend)
+    try:
+        main(args)
+    finally:
+        cleanup()
+
+
+def get_dataloader(args, dataset=None):
+    num_workers = args.num_workers or 0
+    if dataset is not None:
+        return torch.utils.data.DataLoader(
+            dataset, batch_size=args.batch_size, shuffle=args.dataset == 'mnist', num_workers=num_workers
+        )
+    elif args.dataset == 'two_moons':
+        from data.two_moons import generate_two_moons
+
+        return generate_two_moons(
+            256000, args.batch_size, num_replicas=get_world_size(), rank=get_rank(), seed=args.seed,
+            num_workers=num_workers
+        )
     elif args.dataset == 'mnist':
+        from torchvision import datasets
+        from torchvision.transforms import Compose, Normalize, ToTensor
+
         data = datasets.MNIST(
             "data",
             train=True,
             download=True,
             transform=Compose([ToTensor(), Normalize((0.5,), (0.5,))])
         )   
-        return torch.utils.data.DataLoader(data, batch_size=args.batch_size, shuffle=True)
+        if get_world_size() > 1:
+            sampler = DistributedSampler(data, num_replicas=get_world_size(), rank=get_rank(), seed=args.seed)
+            return torch.utils.data.DataLoader(data, batch_size=args.batch_size, sampler=sampler, num_workers=num_workers)
+        return torch.utils.data.DataLoader(data, batch_size=args.batch_size, shuffle=True, num_workers=num_workers)
     else:
         raise ValueError("Invalid dataset argument")
 
 
-def train(train_loader, model, criterion, optimizer, device, savedir, args, wandb):
+def compute_loss(model, criterion, x_1, device, args):
+    t, x_t = model.sample_t_and_x_t(x_1)
+    t, x_t, x_1 = t.to(device), x_t.to(device), x_1.to(device)
+    with phase("forward"):
+        posterior = model.variational_dist(x_t, t)
+
+    if args.dataset == 'mnist':
+        x_1 = x_1.view(-1, 28*28)
+
+    with phase("loss"):
+        return criterion(posterior, x_1)
 
-    pbar = tqdm(total=args.num_epochs)
+
+def get_loss_fn(model, criterion, device, args):
+    def loss_fn(x_1):
+        return compute_loss(model, criterion, x_1, device, args)
+
+    if not args.compile:
+        return loss_fn
+    compiled = CompiledLoss(loss_fn)
+
+    def compiled_loss_fn(x_1):
+        # Phases inside the compiled region are not recorded, so time the whole loss as one.
+        with phase("forward_loss"):
+            return compiled(x_1)
+
+    return compiled_loss_fn
+
+
+def report_compile_speedup(train_loader, model, criterion, device, args):
+    x_1 = next(iter(train_loader))
+    if isinstance(x_1, list):
+        x_1 = x_1[0]
+    if args.max_microbatch > 0:
+        x_1 = x_1[:args.max_microbatch]
+
+    def loss_fn(x):
+        return compute_loss(model, criterion, x, device, args)
+
+    params = list(model.parameters())
+    eager = time_loss_step(loss_fn, x_1, params, num_steps=args.compile_benchmark)
+    compiled = time_loss_step(CompiledLoss(loss_fn), x_1, params, num_steps=args.compile_benchmark)
+    structure = args.learned_structure if args.learn_sigma else "fixed"
+    print(
+        f"Step time {args.dataset}/{args.loss_fn}/{structure}: eager {1e3 * eager:.2f} ms, "
+        f"compiled {1e3 * compiled:.2f} ms, speedup {eager / compiled:.2f}x"
+    )
+    if wandb_run() is not None:
+        wandb_run().summary.update({"eager_step_ms": 1e3 * eager, "compiled_step_ms": 1e3 * compiled, "compile_speedup": eager / compiled})
+
+
+def train_step(loss_fn, optimizer, x_1, args, params):
+    """One optimiser step on x_1, accumulating gradients over micro-batches of at most
+    args.max_microbatch samples. Returns the detached batch loss."""
+    optimizer.zero_grad()
+
+    chunks = x_1.split(args.max_microbatch) if args.max_microbatch > 0 else (x_1,)
+    total = 0.
+    for chunk in chunks:
+        # Criteria average over the batch, so weighting by chunk size recovers the full-batch loss.
+        loss = loss_fn(chunk) * (chunk.shape[0] / x_1.shape[0])
+        with phase("backward"):
+            loss.backward()
+        total = total + loss.detach()
+
+    with phase("optimizer"):
+        if not isinstance(optimizer, ShardedOptimizer):
+            allreduce_gradients(params, bucket_cap_mb=args.bucket_cap_mb)
+        optimizer.step()
+    return total
+
+
+def train(train_loader, model, criterion, optimizer, device, savedir, args, wandb, callback=None):
+    from tqdm import tqdm
+
+    pbar = tqdm(total=args.num_epochs, disable=not is_main_process())
+    params = model.variational_dist.get_parameters()
+    loss_fn = get_loss_fn(model, criterion, device, args)
     plotting = True
     if args.loss_fn == 'Gaussian' and args.learn_sigma:
         suffix = f"{args.loss_fn}_learned_{args.learned_structure}"
@@ -147,45 +358,98 @@ def train(train_loader, model, criterion, optimizer, device, savedir, args, wand
     else:
         suffix = f"{args.loss_fn}"
 
+    profiler = None
+    if args.torch_profile is not None:
+        start, end = args.torch_profile
+        profiler = ProfilerWindow(
+            start, end, f"{savedir}/trace_rank{get_rank()}_{start}_{end}.json", memory_report=args.memory_report
+        )
+    step = 0
+    metrics = MetricAccumulator()
+    epoch_log = {}
+
     for epoch in range(args.num_epochs):
-        for x_1 in train_loader:
+        if isinstance(train_loader.sampler, DistributedSampler):
+            train_loader.sampler.set_epoch(epoch)
+
+        for x_1 in timed(train_loader, "data"):
+            if profiler is not None:
+                profiler.step(step)
             if isinstance(x_1, list):
                 x_1 = x_1[0]
 
-            optimizer.zero_grad()
-
-            t, x_t = model.sample_t_and_x_t(x_1)
-            t, x_t, x_1 = t.to(device), x_t.to(device), x_1.to(device)
-            posterior = model.variational_dist(x_t, t)
-
-            if args.dataset == 'mnist':
-                x_1 = x_1.view(-1, 28*28)
-
-            loss = criterion(posterior, x_1)
-            loss.backward()
-            optimizer.step()
+            step_start = time.perf_counter()
+            with phase("step"):
+                loss = train_step(loss_fn, optimizer, x_1, args, params)
+            exporter.record_train_step(x_1.shape[0], time.perf_counter() - step_start)
+            metrics.update(n=x_1.shape[0], loss=loss)
+            step += 1
 
         if args.log_interval > 0 and (epoch + 1) % args.log_interval == 0:
             plotting = True
 
-        if args.checkpoint_interval > 0 and (epoch + 1) % args.checkpoint_interval == 0:
-            torch.save({
-                "model": model.state_dict(),
-                "optimizer": optimizer.state_dict(),
-                "epoch": epoch,
-                "loss": loss.item()
-                }, 
-                f"{args.checkpoint_dir}/{suffix}.pt")
-
-        score = evaluate(args, model, savedir, plotting, device, epoch+1)
-        wandb.log({"loss": loss.item(), "fid": score})
+        checkpoint_due = args.checkpoint_interval > 0 and (epoch + 1) % args.checkpoint_interval == 0
+        # A sharded optimizer gathers its state collectively, so every rank has to ask for it.
+        optimizer_state = optimizer.state_dict() if checkpoint_due else None
+
+        epoch_metrics = metrics.compute()
+        metrics.reset()
+
+        # Every rank enters the phases so that all ranks log the same keys.
+        checkpoint_start = time.perf_counter()
+        with phase("checkpoint"):
+            if checkpoint_due and is_main_process() and args.checkpoint_format == 'mmap':
+                save_checkpoint(
+                    f"{args.checkpoint_dir}/{suffix}.ckpt", model.state_dict(), optimizer_state,
+                    epoch=epoch, loss=epoch_metrics["loss"], args=vars(args)
+                )
+            elif checkpoint_due and is_main_process():
+                torch.save({
+                    "model": model.state_dict(),
+                    "optimizer": optimizer_state,
+                    "epoch": epoch,
+                    "loss": epoch_metrics["loss"],
+                    "args": vars(args),
+                    }, 
+                    f"{args.checkpoint_dir}/{suffix}.pt")
+        if checkpoint_due:
+            exporter.checkpoint_seconds.observe(time.perf_counter() - checkpoint_start)
+
+        eval_start = time.perf_counter()
+        with phase("eval"):
+            score = evaluate(args, model, savedir, plotting, device, epoch+1) if is_main_process() else None
+        exporter.eval_seconds.observe(time.perf_counter() - eval_start)
+        # Only rank 0 enters the phases inside evaluation; the other ranks log its keys as 0.
+        eval_keys = phase_keys("eval") if is_main_process() else []
+        score, eval_keys = broadcast_object((score, eval_keys))
+        for key in eval_keys:
+            if key not in logger.getkvs():
+                logger.logkv(key, 0)
+
+        logger.logkvs({"epoch": epoch + 1, **epoch_metrics})
+        if score is not None:
+            logger.logkv("fid", score)
+        # Averages over ranks with a single all-reduce when distributed.
+        epoch_log = logger.dumpkvs()
+        if wandb is not None:
+            wandb.log(epoch_log)
         plotting = False
         pbar.update(1)
 
+        if callback is not None and callback(epoch + 1, epoch_log) is False:
+            break
+
+    if profiler is not None:
+        profiler.close()
     pbar.close()
-    evaluate(args, model, savedir, device)
+    if is_main_process():
+        evaluate(args, model, savedir, True, device)
+    return epoch_log
 
 
 if __name__ == "__main__":
     args = get_args()
-    main(args)
\ No newline at end of file
+    if args.world_size > 1:
+        launch(run_worker, args.world_size, args)
+    else:
+        main(args)
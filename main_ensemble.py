@@ -0,0 +1,129 @@
+import os
+import time
+import argparse
+import torch
+import matplotlib.pyplot as plt
+
+from pathlib import Path
+from tqdm import tqdm
+from xvfm.flow import VFM
+from xvfm.ensemble import Ensemble
+from xvfm.metrics import MetricAccumulator
+from xvfm.prior import StandardGaussianPrior, MultiGaussianPrior
+from xvfm.variational import GaussianVariationalDist
+from xvfm.interpolator import OTInterpolator
+from xvfm.unet import logger
+from xvfm import exporter
+from main import CRITERION_MAP, get_args as get_main_args, get_model, get_directories, get_dataloader
+
+
+def get_args():
+    """Ensemble arguments; everything else is parsed as in main.py."""
+    parser = argparse.ArgumentParser(description='Ensemble VFM Experiment', allow_abbrev=False)
+    parser.add_argument('--num_members', default=8, type=int, help="Number of models trained together")
+    parser.add_argument('--lrs', nargs='+', default=None, type=float, help="Per-member learning rates, cycled over the members (default: --lr)")
+    ensemble_args, rest = parser.parse_known_args()
+    args = get_main_args(rest)
+    args.num_members = ensemble_args.num_members
+    args.lrs = ensemble_args.lrs or [args.lr]
+    return args
+
+
+def get_members(args, device):
+    """Members differ in initialisation (seed + i) and learning rate; they share the architecture."""
+    members = []
+    for i in range(args.num_members):
+        torch.manual_seed(args.seed + i)
+        members.append(VFM(
+            prior=StandardGaussianPrior(28**2) if args.dataset == 'mnist' else MultiGaussianPrior(2),
+            variational_dist=GaussianVariationalDist(*get_model(args)),
+            interpolator=OTInterpolator(sigma_min=args.sigma),
+        ).to(device))
+    return members
+
+
+def plot_members(trajectory, filename):
+    num_members = trajectory.shape[1]
+    fig, axes = plt.subplots(1, num_members, figsize=(3 * num_members, 3), squeeze=False)
+    for ax, samples in zip(axes[0], trajectory[-2].cpu().numpy()):
+        ax.scatter(samples[:, 0], samples[:, 1], s=1, alpha=0.5, c="blue")
+        ax.set_xticks([])
+        ax.set_yticks([])
+    fig.savefig(filename)
+    plt.close(fig)
+
+
+def main():
+    args = get_args()
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    # The config suffix of main.py's checkpoints, so runs of different configs do not collide.
+    config = f"{args.dataset}_{os.path.basename(get_directories(args))}"
+    savedir = get_directories(args) + "_ensemble"
+    Path(savedir).mkdir(parents=True, exist_ok=True)
+    Path(args.checkpoint_dir).mkdir(parents=True, exist_ok=True)
+    logger.configure(dir=savedir, format_strs=["log", "columnar"], config=vars(args))
+    metrics_server = exporter.start_server(args.metrics_port) if args.metrics_port is not None else None
+
+    members = get_members(args, device)
+    ensemble = Ensemble(members)
+    lrs = [args.lrs[i % len(args.lrs)] for i in range(len(members))]
+    optimizers = [
+        torch.optim.Adam(m.variational_dist.get_parameters(), lr=lr) for m, lr in zip(members, lrs)
+    ]
+    criterion = CRITERION_MAP[args.loss_fn]
+    dataloader = get_dataloader(args)
+    print(f"Training {len(members)} members with learning rates {lrs}")
+
+    torch.manual_seed(args.seed)
+    metrics = MetricAccumulator()
+    for epoch in tqdm(range(args.num_epochs)):
+        for x_1 in dataloader:
+            if isinstance(x_1, list):
+                x_1 = x_1[0]
+            x_1 = x_1.to(device)
+
+            step_start = time.perf_counter()
+            for optimizer in optimizers:
+                optimizer.zero_grad()
+            # Members are independent, so the gradient of the sum is each member's own gradient.
+            losses = ensemble.loss(criterion, x_1)
+            losses.sum().backward()
+            for optimizer in optimizers:
+                optimizer.step()
+            exporter.record_train_step(x_1.shape[0] * len(members), time.perf_counter() - step_start)
+            metrics.update(n=x_1.shape[0], **{f"loss_{i}": loss for i, loss in enumerate(losses)})
+
+        logger.logkvs({"epoch": epoch + 1, **metrics.compute()})
+        logger.dumpkvs()
+        metrics.reset()
+
+        if args.checkpoint_interval > 0 and (epoch + 1) % args.checkpoint_interval == 0:
+            for i, (member, optimizer) in enumerate(zip(members, optimizers)):
+                torch.save({
+                    "model": member.state_dict(),
+                    "optimizer": optimizer.state_dict(),
+                    "epoch": epoch,
+                    "lr": lrs[i],
+                    },
+                    f"{args.checkpoint_dir}/{config}_ensemble_member{i}.pt")
+
+        if args.dataset == 'two_moons' and args.log_interval > 0 and (epoch + 1) % args.log_interval == 0:
+            trajectory = ensemble.generate(num_samples=1024, steps=args.integration_steps, device=device)
+            plot_members(trajectory, f"{savedir}/iter_{epoch + 1}.png")
+
+    trajectory = ensemble.generate(
+        num_samples=1024 if args.dataset == 'two_moons' else 100, steps=args.integration_steps, device=device
+    )
+    torch.save(trajectory[-2].cpu(), f"{savedir}/samples.pt")
+    if args.dataset == 'two_moons':
+        plot_members(trajectory, f"{savedir}/final.png")
+    if args.save_model:
+        for i, member in enumerate(members):
+            torch.save(member.state_dict(), f"{savedir}/model_member{i}.pt")
+    logger.get_current().close()
+    if metrics_server is not None:
+        exporter.stop_server(metrics_server)
+
+
+if __name__ == "__main__":
+    main()
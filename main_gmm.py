@@ -5,6 +5,10 @@ import argparse
 from xvfm.gmm.resampler import Resampler
 from xvfm.gmm.objectives import apg_objective, rws_objective
 from xvfm.gmm.apg_training import train, init_apg_models, init_rws_models
+from xvfm.autotune import load_settings, set_threads
+from xvfm.profiling import enable_phases, ProfilerWindow
+from xvfm.unet import logger
+from xvfm import exporter
 
 def main():
     parser = argparse.ArgumentParser('GMM Experiment')
@@ -21,10 +25,32 @@ def main():
     parser.add_argument('--num_clusters', default=3, type=int)
     parser.add_argument('--data_dim', default=2, type=int)
     parser.add_argument('--num_hidden', default=32, type=int)
+    parser.add_argument('--results_dir', default='results', type=str, help="Directory to save the metrics log and profiler traces")
+    parser.add_argument('--profile_phases', action='store_true', help="Time each training phase and log per-epoch totals")
+    parser.add_argument('--torch_profile', default=None, type=int, nargs=2, metavar=('START', 'END'), help="Record a torch.profiler Chrome trace for global steps [START, END)")
+    parser.add_argument('--metrics_port', default=None, type=int, help="Serve live Prometheus metrics on 127.0.0.1 at this port")
 
     args = parser.parse_args()
 
+    # Autotune only times VFM configs, so the GMM loop takes the thread counts of the host's
+    # default entry (python -m xvfm.autotune --set_default), if any.
+    tuned = load_settings('train', 'default')
+    set_threads(tuned.get('num_threads'), tuned.get('num_interop_threads'))
+
     sample_size = int(args.budget / args.num_sweeps)
+    if args.num_sweeps == 1:
+        model_version = 'rws-gmm-num_samples=%s' % (sample_size)
+    else:
+        model_version = 'apg-gmm-block=%s-num_sweeps=%s-num_samples=%s' % (args.block_strategy, args.num_sweeps, sample_size)
+    savedir = f"{args.results_dir}/gmm/{model_version}"
+    logger.configure(dir=savedir, format_strs=["log", "columnar"], config=vars(args))
+    enable_phases(args.profile_phases)
+    metrics_server = exporter.start_server(args.metrics_port) if args.metrics_port is not None else None
+    profiler = None
+    if args.torch_profile is not None:
+        start, end = args.torch_profile
+        profiler = ProfilerWindow(start, end, f"{savedir}/trace_{start}_{end}.json")
+
     CUDA = torch.cuda.is_available()
     device = torch.device('cuda:%d' % args.device)
     
@@ -34,7 +60,6 @@ def main():
     print('Start training for gmm clustering task..')
 
     if args.num_sweeps == 1: ## rws method
-        model_version = 'rws-gmm-num_samples=%s' % (sample_size)
         print('version='+ model_version)
         models, optimizer = init_rws_models(
             args.num_clusters, 
@@ -57,12 +82,11 @@ def main():
             args.batch_size, 
             CUDA, 
             device,
-            model_version
+            model_version,
+            profiler=profiler
             )
         
     elif args.num_sweeps > 1: # apg sampler
-        model_version = 'apg-gmm-block=%s-num_sweeps=%s-num_samples=%s' % (args.block_strategy, args.num_sweeps, sample_size)
-
         print('version=' + model_version)
 
         models, optimizer = init_apg_models(
@@ -94,11 +118,15 @@ def main():
             num_sweeps=args.num_sweeps, 
             block=args.block_strategy, 
             resampler=resampler,
-            model_version=model_version
+            model_version=model_version,
+            profiler=profiler
             )
         
     else:
         raise ValueError
+    logger.get_current().close()
+    if metrics_server is not None:
+        exporter.stop_server(metrics_server)
     
 
 if __name__ == "__main__":
@@ -0,0 +1,111 @@
+import time
+import argparse
+import torch
+
+from pathlib import Path
+from tqdm import tqdm
+from xvfm.models import MLP
+from xvfm.multihead import MultiHeadVFM, VARIANTS
+from xvfm.metrics import MetricAccumulator
+from xvfm.prior import StandardGaussianPrior, MultiGaussianPrior
+from xvfm.interpolator import OTInterpolator
+from xvfm.unet import logger
+from xvfm import exporter
+from data.utils import evaluate
+from main import CRITERION_MAP, get_args as get_main_args, get_model, get_dataloader
+
+
+def get_args():
+    """Multi-head arguments; everything else is parsed as in main.py."""
+    parser = argparse.ArgumentParser(description='Multi-head VFM Experiment', allow_abbrev=False)
+    parser.add_argument('--variants', nargs='+', default=["MSE", "Gaussian_fixed", "Gaussian_learned_scalar", "Gaussian_learned_vector"], choices=list(VARIANTS), help="Loss and sigma variants trained together")
+    parser.add_argument('--separate_means', action='store_true', help="Keep a copy of the mean network per variant instead of sharing one")
+    multihead_args, rest = parser.parse_known_args()
+    args = get_main_args(rest)
+    args.variants = multihead_args.variants
+    args.separate_means = multihead_args.separate_means
+    return args
+
+
+def get_sigma_head(args, structure):
+    if structure is None:
+        return None
+    dim = 28**2 if args.dataset == 'mnist' else 2
+    return MLP(dim=0, out_dim={"scalar": 1, "vector": dim, "matrix": dim**2}[structure])
+
+
+def main():
+    args = get_args()
+    torch.manual_seed(args.seed)
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    savedirs = {
+        name: f"{args.results_dir}/{args.dataset}/{name}_multihead" for name in args.variants
+    }
+    for savedir in savedirs.values():
+        Path(savedir).mkdir(parents=True, exist_ok=True)
+    Path(args.checkpoint_dir).mkdir(parents=True, exist_ok=True)
+    logdir = f"{args.results_dir}/{args.dataset}/multihead"
+    logger.configure(dir=logdir, format_strs=["log", "columnar"], config=vars(args))
+    metrics_server = exporter.start_server(args.metrics_port) if args.metrics_port is not None else None
+
+    heads = {
+        name: (CRITERION_MAP[VARIANTS[name][0]], get_sigma_head(args, VARIANTS[name][1]))
+        for name in args.variants
+    }
+    args.learn_sigma = False
+    model = MultiHeadVFM(
+        prior=StandardGaussianPrior(28**2) if args.dataset == 'mnist' else MultiGaussianPrior(2),
+        mean_model=get_model(args)[0],
+        interpolator=OTInterpolator(sigma_min=args.sigma),
+        heads=heads,
+        separate_means=args.separate_means,
+    ).to(device)
+    optimizer = torch.optim.Adam(model.parameters(), lr=args.lr)
+    print(f"Number of parameters: {sum([p.numel() for p in model.parameters()])}")
+    print(f"Training parameters: {vars(args)}")
+
+    dataloader = get_dataloader(args)
+    metrics = MetricAccumulator()
+    for epoch in tqdm(range(args.num_epochs)):
+        for x_1 in dataloader:
+            if isinstance(x_1, list):
+                x_1 = x_1[0]
+            x_1 = x_1.to(device)
+
+            step_start = time.perf_counter()
+            optimizer.zero_grad()
+            losses = model.losses(x_1)
+            sum(losses.values()).backward()
+            optimizer.step()
+            exporter.record_train_step(x_1.shape[0], time.perf_counter() - step_start)
+            metrics.update(n=x_1.shape[0], **{f"loss/{name}": loss for name, loss in losses.items()})
+
+        plotting = args.log_interval > 0 and (epoch + 1) % args.log_interval == 0
+        logger.logkvs({"epoch": epoch + 1, **metrics.compute()})
+        metrics.reset()
+        if plotting:
+            for name, variant in model.variants.items():
+                score = evaluate(args, variant, savedirs[name], True, device, epoch + 1)
+                if score is not None:
+                    logger.logkv(f"fid/{name}", score)
+        logger.dumpkvs()
+
+        if args.checkpoint_interval > 0 and (epoch + 1) % args.checkpoint_interval == 0:
+            torch.save({
+                "model": model.state_dict(),
+                "optimizer": optimizer.state_dict(),
+                "epoch": epoch,
+                },
+                f"{args.checkpoint_dir}/{args.dataset}_multihead_{'-'.join(args.variants)}.pt")
+
+    for name, variant in model.variants.items():
+        evaluate(args, variant, savedirs[name], True, device)
+        if args.save_model:
+            torch.save(variant.state_dict(), f"{savedirs[name]}/model.pt")
+    logger.get_current().close()
+    if metrics_server is not None:
+        exporter.stop_server(metrics_server)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,249 @@
+"""Reflow a trained VFM on its own couplings, and optionally distil it to few-step sampling.
+
+    python main_reflow.py --teacher checkpoints/Gaussian_learned_scalar.pt --dataset two_moons \
+        --num_pairs 200000 --num_epochs 10 --distill_steps 2
+
+1. The teacher integrates --num_pairs prior samples x_0 with --teacher_steps Euler steps to
+   samples x_1. The pairs are written to tensor file shards under --pair_dir and read back
+   memory-mapped, so the bank can be larger than memory. Shards that already exist for the
+   same teacher weights and settings are reused, so an interrupted run resumes where it stopped.
+2. A student, initialised from the teacher (or from scratch with --from_scratch), is trained
+   with the VFM loss of main.py on the coupled pairs instead of independent prior samples.
+   The teacher couples each x_0 with one x_1, so the posterior the student learns is sharp and
+   its paths are straight, and coarse Euler steps lose little.
+3. With --distill_steps K (1 to 4), a copy of the reflowed student is fine-tuned so that K
+   Euler steps over the uniform time grid land on the teacher's x_1.
+
+Teacher and students are then scored at each of --eval_nfe velocity evaluations, using
+generate(steps=nfe + 1): FID for MNIST, sliced Wasserstein distance to
+held-out moons for two_moons. The table is printed and written to reflow_report.json. The
+students are saved as <teacher>_reflow.pt and <teacher>_distill<K>.pt in --checkpoint_dir, in
+main.py's checkpoint format. Sample from a K-step student with xvfm.runtime --steps K+1.
+"""
+import os
+import copy
+import json
+import time
+import argparse
+import torch
+
+from pathlib import Path
+from tqdm import tqdm
+from xvfm.models import MLP
+from xvfm.metrics import MetricAccumulator, sliced_wasserstein
+from xvfm.checkpoint import TensorFile, save_tensors
+from xvfm.samplebank import model_digest
+from xvfm.runtime import load_vfm
+from xvfm.unet import logger
+from xvfm import exporter
+from main import CRITERION_MAP, get_args as get_main_args
+
+
+def get_args():
+    """Reflow arguments; everything else is parsed as in main.py."""
+    parser = argparse.ArgumentParser(description='Reflow and few-step distillation of a trained VFM', allow_abbrev=False)
+    parser.add_argument('--teacher', required=True, type=str, help="Checkpoint, state dict or checkpoint directory of the trained VFM")
+    parser.add_argument('--num_pairs', default=100000, type=int, help="Number of (x_0, x_1) pairs generated by the teacher")
+    parser.add_argument('--shard_size', default=10000, type=int, help="Pairs per shard file")
+    parser.add_argument('--generation_batch', default=1000, type=int, help="Pairs integrated at once by the teacher")
+    parser.add_argument('--teacher_steps', default=None, type=int, help="Euler steps of the teacher (default: --integration_steps)")
+    parser.add_argument('--pair_dir', default=None, type=str, help="Directory of the pair shards (default: <results_dir>/<dataset>/<teacher>_reflow/pairs)")
+    parser.add_argument('--from_scratch', action='store_true', help="Train the student from a fresh initialisation instead of the teacher's weights")
+    parser.add_argument('--distill_steps', default=0, type=int, choices=[0, 1, 2, 3, 4], help="Also distil the reflowed student to this many Euler steps (0 disables)")
+    parser.add_argument('--distill_epochs', default=None, type=int, help="Epochs of few-step distillation (default: --num_epochs)")
+    parser.add_argument('--eval_nfe', nargs='+', default=[1, 2, 4, 8, 16, 32, 99], type=int, help="Velocity evaluations per sample at which every model is scored")
+    parser.add_argument('--eval_samples', default=None, type=int, help="Samples per score (default: 1024 for two_moons, 100 for MNIST, as in evaluate)")
+    reflow_args, rest = parser.parse_known_args()
+    args = get_main_args(rest)
+    for k, v in vars(reflow_args).items():
+        setattr(args, k, v)
+    args.teacher_steps = args.teacher_steps or args.integration_steps
+    args.distill_epochs = args.distill_epochs or args.num_epochs
+    return args
+
+
+def generate_pairs(teacher, args, device):
+    """Paths of the pair shards, generating the ones that are missing or stale."""
+    Path(args.pair_dir).mkdir(parents=True, exist_ok=True)
+    settings = {"teacher": model_digest(teacher), "steps": str(args.teacher_steps)}
+    paths = []
+    for shard, start in enumerate(range(0, args.num_pairs, args.shard_size)):
+        n = min(args.shard_size, args.num_pairs - start)
+        path = os.path.join(args.pair_dir, f"pairs_{shard:05d}.safetensors")
+        paths.append(path)
+        if os.path.exists(path):
+            existing = TensorFile(path)
+            if all(existing.metadata.get(k) == v for k, v in settings.items()) and existing.index["x_0"]["shape"][0] == n:
+                continue
+
+        # Seeded per shard, so a resumed run generates the same pairs as an uninterrupted one.
+        torch.manual_seed(args.seed + shard)
+        x_0, x_1 = [], []
+        with torch.inference_mode():
+            for i in range(0, n, args.generation_batch):
+                trajectory = teacher.generate(min(args.generation_batch, n - i), args.teacher_steps, device)
+                x_0.append(trajectory[0].cpu())
+                x_1.append(trajectory[-2].cpu())
+        save_tensors(path, {"x_0": torch.cat(x_0), "x_1": torch.cat(x_1)}, settings)
+        print(f"Wrote {n} pairs to {path}", flush=True)
+    return paths
+
+
+def iterate_pairs(shards, batch_size, generator):
+    """Shuffled (x_0, x_1) batches from memory-mapped shards.
+
+    Shards are visited in random order and rows are shuffled within each shard; every shard
+    holds independent draws, so this is as good as a global shuffle and only touches one shard
+    at a time.
+    """
+    for shard in torch.randperm(len(shards), generator=generator).tolist():
+        x_0, x_1 = shards[shard]["x_0"], shards[shard]["x_1"]
+        order = torch.randperm(len(x_0), generator=generator)
+        for i in range(0, len(order), batch_size):
+            index = order[i:i + batch_size]
+            yield x_0[index], x_1[index]
+
+
+def reflow_loss(model, criterion, x_0, x_1):
+    """The VFM loss of main.compute_loss on the straight path from the teacher's x_0 to its x_1.
+
+    The sampler's velocity (OTInterpolator.compute_v_t) is x_1 - x_0 along this path when the
+    posterior mean is x_1 - sigma_min * x_0, so that is the target rather than x_1 itself; the
+    interpolator's noisy path only agrees with the sampler on average over independent couplings.
+    """
+    t = model.interpolator.sample_t(x_1.shape[0]).to(x_1.device)
+    s = t.view(-1, *([1] * (x_1.dim() - 1)))
+    x_t = s * x_1 + (1 - s) * x_0
+    posterior = model.variational_dist(x_t, t)
+    target = x_1 - model.interpolator.sigma_min * x_0
+    return criterion(posterior, target.view(x_1.shape[0], -1))
+
+
+def few_step_loss(model, x_0, x_1, steps):
+    """Squared error of `steps` Euler steps from x_0 over the uniform grid, as generate takes them."""
+    time_steps = torch.linspace(0, 1, steps + 1, device=x_0.device)
+    x = x_0
+    for k in range(steps):
+        t = time_steps[k].expand(x.shape[0], 1)
+        x = x + model.velocity_field(x, t) * (time_steps[k + 1] - time_steps[k])
+    return (x - x_1).flatten(1).square().sum(1).mean()
+
+
+def train(model, loss_fn, shards, num_epochs, args, device, stage, checkpoint):
+    params = model.variational_dist.get_parameters()
+    optimizer = torch.optim.Adam(params, lr=args.lr)
+    generator = torch.Generator().manual_seed(args.seed)
+    metrics = MetricAccumulator()
+    model.train()
+    for epoch in tqdm(range(num_epochs), desc=stage):
+        for x_0, x_1 in iterate_pairs(shards, args.batch_size, generator):
+            x_0, x_1 = x_0.to(device), x_1.to(device)
+            step_start = time.perf_counter()
+            optimizer.zero_grad()
+            loss = loss_fn(model, x_0, x_1)
+            loss.backward()
+            optimizer.step()
+            exporter.record_train_step(x_1.shape[0], time.perf_counter() - step_start)
+            metrics.update(n=x_1.shape[0], loss=loss.detach())
+
+        epoch_metrics = metrics.compute()
+        metrics.reset()
+        logger.logkvs({"stage": stage, "epoch": epoch + 1, **epoch_metrics})
+        logger.dumpkvs()
+        if (args.checkpoint_interval > 0 and (epoch + 1) % args.checkpoint_interval == 0) or epoch + 1 == num_epochs:
+            torch.save({
+                "model": model.state_dict(),
+                "optimizer": optimizer.state_dict(),
+                "epoch": epoch,
+                "loss": epoch_metrics["loss"],
+                "args": vars(args),
+                },
+                checkpoint)
+    return model.eval()
+
+
+def get_quality_fn(args, device):
+    """Returns (metric name, fn(samples) -> distance to held-out data; lower is better)."""
+    if args.dataset == 'two_moons':
+        from sklearn.datasets import make_moons
+
+        held_out = torch.tensor(make_moons(args.eval_samples, random_state=args.seed + 1)[0], dtype=torch.float32)
+        generator = torch.Generator()
+        return "sliced_wasserstein", lambda x: sliced_wasserstein(x.cpu(), held_out, generator=generator.manual_seed(args.seed))
+
+    from data.utils import compute_fid, mnist_test_images
+
+    real_images = mnist_test_images(args.eval_samples, device)
+    return "fid", lambda x: float(compute_fid(x.view(-1, 1, 28, 28).clip(-1, 1).to(device), device, real_images))
+
+
+def score(models, args, device):
+    metric, quality = get_quality_fn(args, device)
+    rows = []
+    for nfe in args.eval_nfe:
+        row = {"nfe": nfe}
+        for name, model in models.items():
+            # The same prior samples for every model and step count.
+            torch.manual_seed(args.seed)
+            start = time.perf_counter()
+            with torch.inference_mode():
+                samples = model.generate(args.eval_samples, nfe + 1, device)[-2]
+            row[f"{name}_seconds"] = time.perf_counter() - start
+            row[name] = quality(samples)
+        rows.append(row)
+        print(f"NFE {nfe:4d}  " + "  ".join(f"{name} {row[name]:.4f}" for name in models), flush=True)
+    return metric, rows
+
+
+def main():
+    args = get_args()
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    teacher = load_vfm(args.teacher, device)
+    # The architecture and sigma come from the teacher, not from the command line.
+    args.dataset = 'two_moons' if isinstance(teacher.variational_dist.posterior_mu_model, MLP) else 'mnist'
+    args.sigma = teacher.interpolator.sigma_min
+    args.eval_samples = args.eval_samples or (1024 if args.dataset == 'two_moons' else 100)
+    name = os.path.basename(args.teacher.rstrip("/")).split(".")[0]
+    savedir = f"{args.results_dir}/{args.dataset}/{name}_reflow"
+    args.pair_dir = args.pair_dir or f"{savedir}/pairs"
+    Path(savedir).mkdir(parents=True, exist_ok=True)
+    Path(args.checkpoint_dir).mkdir(parents=True, exist_ok=True)
+    logger.configure(dir=savedir, format_strs=["log", "columnar"], config=vars(args))
+    metrics_server = exporter.start_server(args.metrics_port) if args.metrics_port is not None else None
+    print(f"Reflow parameters: {vars(args)}")
+
+    shards = [TensorFile(path) for path in generate_pairs(teacher, args, device)]
+
+    torch.manual_seed(args.seed)
+    student = copy.deepcopy(teacher)
+    if args.from_scratch:
+        for module in student.modules():
+            if hasattr(module, "reset_parameters"):
+                module.reset_parameters()
+    criterion = CRITERION_MAP[args.loss_fn]
+    models = {"teacher": teacher}
+    models["reflow"] = train(
+        student, lambda model, x_0, x_1: reflow_loss(model, criterion, x_0, x_1), shards,
+        args.num_epochs, args, device, "reflow", f"{args.checkpoint_dir}/{name}_reflow.pt",
+    )
+    if args.distill_steps > 0:
+        models[f"distill{args.distill_steps}"] = train(
+            copy.deepcopy(student), lambda model, x_0, x_1: few_step_loss(model, x_0, x_1, args.distill_steps), shards,
+            args.distill_epochs, args, device, "distill", f"{args.checkpoint_dir}/{name}_distill{args.distill_steps}.pt",
+        )
+
+    metric, rows = score(models, args, device)
+    with open(f"{savedir}/reflow_report.json", "w") as f:
+        json.dump({"teacher": args.teacher, "metric": metric, "num_pairs": args.num_pairs, "results": rows}, f, indent=2)
+
+    print(f"\n{metric} per NFE (generate with the uniform time grid):")
+    print(f"{'NFE':>5s} " + " ".join(f"{name:>12s}" for name in models))
+    for row in rows:
+        print(f"{row['nfe']:5d} " + " ".join(f"{row[name]:12.4f}" for name in models))
+    logger.get_current().close()
+    if metrics_server is not None:
+        exporter.stop_server(metrics_server)
+
+
+if __name__ == "__main__":
+    main()
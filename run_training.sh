@@ -28,4 +28,9 @@ done
 #   --log_interval 100 \
 #   --loss_fn "Gaussian" \
 #   --dataset "mnist" \
-  # --learned_structure "scalar"
\ No newline at end of file
+  # --learned_structure "scalar"
+
+# Single-node alternative: run the grid concurrently with early stopping of poor configurations.
+# python sweep.py --dataset mnist --num_epochs 1000 --workers 2 \
+#   --grid loss_fn=Gaussian learned_structure=vector,scalar \
+#   --metric loss --min_epochs 10 --reduction_factor 3 -- --log_interval 100
@@ -0,0 +1,195 @@
+"""Run a grid of main.py configurations concurrently on one node, stopping poor runs early.
+
+Replaces the one-job-per-configuration loop in run_training.sh, e.g.
+
+    python sweep.py --dataset mnist --num_epochs 1000 --workers 4 \
+        --grid loss_fn=Gaussian learned_structure=scalar,vector \
+        --metric loss --min_epochs 10 --reduction_factor 3 -- --log_interval 100
+
+Trials run in a process pool whose workers are pinned to disjoint cores. The training set is
+preprocessed once and shared with every worker through shared memory. Early stopping follows
+asynchronous successive halving (ASHA): rungs sit at min_epochs * reduction_factor**k epochs,
+and a trial reaching a rung continues only while its metric is in the top 1/reduction_factor
+of all results recorded at that rung so far. Arguments after `--` go to every main.py run.
+"""
+import os
+import json
+import time
+import argparse
+import itertools
+import torch
+import torch.multiprocessing as mp
+
+from torchvision import datasets
+from sklearn.datasets import make_moons
+from torch.utils.data import TensorDataset
+
+import main as vfm
+
+
+_worker = {}
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='Local ASHA sweep over main.py')
+    parser.add_argument('--dataset', default='mnist', type=str, help="Dataset shared by all trials")
+    parser.add_argument('--grid', nargs='+', default=[], help="Swept main.py arguments as name=value1,value2,...")
+    parser.add_argument('--num_epochs', default=1000, type=int, help="Maximum epochs per trial")
+    parser.add_argument('--workers', default=2, type=int, help="Number of concurrent trials")
+    parser.add_argument('--threads_per_worker', default=None, type=int, help="Cores pinned to each worker (default: cores / workers)")
+    parser.add_argument('--metric', default='loss', type=str, help="Logged metric that decides early stopping")
+    parser.add_argument('--mode', default='min', choices=['min', 'max'], help="Whether lower or higher metric values are better")
+    parser.add_argument('--min_epochs', default=10, type=int, help="Epoch of the first rung")
+    parser.add_argument('--reduction_factor', default=3, type=int, help="Keep the top 1/reduction_factor of trials at each rung")
+    parser.add_argument('--seed', default=42, type=int, help="Seed used to build the shared dataset")
+    parser.add_argument('--sweep_dir', default='results/sweep', type=str, help="Directory for per-trial outputs and the results table")
+    parser.add_argument('main_args', nargs=argparse.REMAINDER, help="Arguments after -- are passed to main.py")
+    args = parser.parse_args()
+    if args.main_args[:1] == ['--']:
+        args.main_args = args.main_args[1:]
+    return args
+
+
+def load_shared_dataset(dataset, seed):
+    """Preprocess the training set once, in shared memory, as main.get_dataloader would load it."""
+    if dataset == 'two_moons':
+        points = torch.tensor(make_moons(n_samples=256000, random_state=seed)[0], dtype=torch.float32)
+        tensors = (points,)
+    elif dataset == 'mnist':
+        data = datasets.MNIST("data", train=True, download=True)
+        # Same values as Compose([ToTensor(), Normalize((0.5,), (0.5,))])
+        images = data.data.float().div(255).sub(0.5).div(0.5).unsqueeze(1)
+        tensors = (images, data.targets)
+    else:
+        raise ValueError("Invalid dataset argument")
+    return TensorDataset(*[t.share_memory_() for t in tensors])
+
+
+def get_trials(args):
+    names, values = [], []
+    for spec in args.grid:
+        name, options = spec.split('=', 1)
+        names.append(name)
+        values.append(options.split(','))
+
+    trials = []
+    for i, combination in enumerate(itertools.product(*values)):
+        overrides = dict(zip(names, combination))
+        trial_dir = os.path.join(args.sweep_dir, f"trial_{i:03d}")
+        argv = list(args.main_args) + [
+            '--dataset', args.dataset,
+            '--num_epochs', str(args.num_epochs),
+            '--results_dir', trial_dir,
+            '--checkpoint_dir', os.path.join(trial_dir, 'checkpoints'),
+            '--wandb_mode', 'local',
+            # Pool workers are daemonic and cannot start DataLoader workers; pin every setting the
+            # autotune profile would otherwise fill in so trials match the slot they run in.
+            '--num_threads', str(args.threads),
+            '--num_interop_threads', '1',
+            '--num_workers', '0',
+        ]
+        for name, value in overrides.items():
+            argv += [f'--{name}', value]
+        trials.append((i, overrides, argv))
+    return trials
+
+
+def get_rungs(args):
+    rungs, epoch = [], args.min_epochs
+    while epoch < args.num_epochs:
+        rungs.append(epoch)
+        epoch *= args.reduction_factor
+    return rungs
+
+
+def init_worker(dataset, slots, rung_results, lock, threads, sweep):
+    slot = slots.get()
+    if hasattr(os, "sched_setaffinity"):
+        cores = sorted(os.sched_getaffinity(0))
+        os.sched_setaffinity(0, cores[slot * threads:(slot + 1) * threads] or cores)
+    torch.set_num_threads(threads)
+    _worker.update(dataset=dataset, rung_results=rung_results, lock=lock, sweep=sweep)
+
+
+def promote(rung_results, lock, rung, value, reduction_factor, mode):
+    """Record `value` at `rung` and say whether it is in the top 1/reduction_factor so far."""
+    with lock:
+        results = rung_results.get(rung, []) + [value]
+        rung_results[rung] = results
+    ranked = sorted(results, reverse=mode == 'max')
+    threshold = ranked[max(1, len(results) // reduction_factor) - 1]
+    return value <= threshold if mode == 'min' else value >= threshold
+
+
+def run_trial(trial):
+    trial_id, overrides, argv = trial
+    sweep = _worker['sweep']
+    status = {'epochs': 0, 'stopped': False}
+
+    def callback(epoch, log):
+        status['epochs'] = epoch
+        if epoch not in sweep['rungs'] or sweep['metric'] not in log:
+            return True
+        keep = promote(
+            _worker['rung_results'], _worker['lock'], epoch, log[sweep['metric']],
+            sweep['reduction_factor'], sweep['mode']
+        )
+        status['stopped'] = not keep
+        return keep
+
+    start = time.time()
+    log = vfm.main(vfm.get_args(argv), dataset=_worker['dataset'], callback=callback)
+    return {
+        'trial': trial_id,
+        **overrides,
+        'epochs': status['epochs'],
+        'stopped_early': status['stopped'],
+        sweep['metric']: log.get(sweep['metric']),
+        'seconds': time.time() - start,
+    }
+
+
+def main():
+    args = get_args()
+    os.makedirs(args.sweep_dir, exist_ok=True)
+    args.threads = args.threads_per_worker or max(1, (os.cpu_count() or 1) // args.workers)
+
+    trials = get_trials(args)
+    sweep = {
+        'rungs': get_rungs(args),
+        'metric': args.metric,
+        'mode': args.mode,
+        'reduction_factor': args.reduction_factor,
+    }
+    print(f"Running {len(trials)} trials on {args.workers} workers x {args.threads} threads, rungs at epochs {sweep['rungs']}")
+
+    dataset = load_shared_dataset(args.dataset, args.seed)
+    ctx = mp.get_context("spawn")
+    manager = ctx.Manager()
+    slots = manager.Queue()
+    for slot in range(args.workers):
+        slots.put(slot)
+
+    results = []
+    initargs = (dataset, slots, manager.dict(), manager.Lock(), args.threads, sweep)
+    with ctx.Pool(args.workers, initializer=init_worker, initargs=initargs) as pool:
+        for result in pool.imap_unordered(run_trial, trials):
+            print(f"Finished: {result}")
+            results.append(result)
+    manager.shutdown()
+
+    def sort_key(result):
+        value = result[args.metric]
+        if value is None:
+            return float('inf')
+        return value if args.mode == 'min' else -value
+
+    results.sort(key=lambda r: (r['stopped_early'], sort_key(r)))
+    with open(os.path.join(args.sweep_dir, 'sweep_results.json'), 'w') as f:
+        json.dump(results, f, indent=2)
+    for result in results:
+        print(result)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,192 @@
+"""Tune threading, data loading, memory format and sampling batch size per host and model.
+
+    python -m xvfm.autotune --dataset mnist --learned_structure vector --batch_size 256
+
+Each candidate configuration runs in a fresh interpreter, since the number of inter-op threads
+can only be set before any parallel work, and times a few training steps and sampling steps.
+One setting is tuned at a time (threads, then inter-op threads, then DataLoader workers, then
+channels-last), keeping the best value of each. The result is written to a JSON profile keyed
+by host name and model config; main.py, main_gmm.py and xvfm.runtime apply it on start-up.
+Arguments this module does not know are passed to main.get_args for the trials.
+"""
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+import warnings
+import torch
+
+DEFAULT_PROFILE = "autotune.json"
+TRAIN_SETTINGS = ("num_threads", "num_interop_threads", "num_workers", "channels_last")
+SAMPLE_SETTINGS = ("num_threads", "num_interop_threads", "channels_last", "batch_size")
+
+
+def model_key(dataset, learn_sigma=True, learned_structure="scalar"):
+    return f"{dataset}/{learned_structure if learn_sigma else 'fixed'}"
+
+
+def load_settings(kind, key, path=DEFAULT_PROFILE):
+    """Tuned settings of `kind` ('train' or 'sample') for this host and model key.
+
+    Falls back to the host's 'default' entry, and to {} without a profile.
+    """
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        host = json.load(f).get(socket.gethostname(), {})
+    return host.get(key, host.get("default", {})).get(kind, {})
+
+
+def set_threads(num_threads=None, num_interop_threads=None):
+    if num_threads:
+        torch.set_num_threads(num_threads)
+    if num_interop_threads and torch.get_num_interop_threads() != num_interop_threads:
+        try:
+            torch.set_num_interop_threads(num_interop_threads)
+        except RuntimeError as e:
+            warnings.warn(f"Cannot set the number of inter-op threads after parallel work has started: {e}")
+
+
+def apply_profile(args, kind="train", key=None, path=None):
+    """Fill settings left unset (None) on `args` from the profile and apply the thread counts."""
+    if key is None:
+        key = model_key(args.dataset, args.learn_sigma, args.learned_structure)
+    settings = load_settings(kind, key, path or DEFAULT_PROFILE)
+    for name, value in settings.items():
+        if getattr(args, name, None) is None:
+            setattr(args, name, value)
+    set_threads(getattr(args, "num_threads", None), getattr(args, "num_interop_threads", None))
+    return settings
+
+
+def _candidates(limit):
+    values, n = [], 1
+    while n < limit:
+        values.append(n)
+        n *= 2
+    return values + [limit]
+
+
+def run_trial(config, main_argv, steps, sample_steps, sample_sizes):
+    """Time training and sampling steps under `config`; runs in its own interpreter."""
+    set_threads(config["num_threads"], config["num_interop_threads"])
+    import main
+
+    args = main.get_args(main_argv)
+    args.num_workers = config["num_workers"]
+    torch.manual_seed(args.seed)
+    device = torch.device("cpu")
+    model = main.get_flow_model(args, device)
+    if config["channels_last"]:
+        model.to(memory_format=torch.channels_last)
+    criterion = main.CRITERION_MAP[args.loss_fn]
+    optimizer = torch.optim.Adam(model.variational_dist.get_parameters(), lr=args.lr)
+
+    batches = iter(main.get_dataloader(args))
+    for i in range(steps + 2):
+        if i == 2:
+            start = time.perf_counter()
+        x_1 = next(batches)
+        if isinstance(x_1, list):
+            x_1 = x_1[0]
+        optimizer.zero_grad()
+        main.compute_loss(model, criterion, x_1, device, args).backward()
+        optimizer.step()
+    train_seconds = (time.perf_counter() - start) / steps
+
+    sample_rates = {}
+    for n in sample_sizes:
+        model.generate(num_samples=n, steps=2, device=device)
+        start = time.perf_counter()
+        model.generate(num_samples=n, steps=sample_steps + 1, device=device)
+        sample_rates[n] = n * sample_steps / (time.perf_counter() - start)
+    return {"train_step_seconds": train_seconds, "sample_steps_per_second": sample_rates}
+
+
+def _coordinate_search(space, measure, score):
+    config = {name: values[0] for name, values in space.items()}
+    for name, values in space.items():
+        if len(values) > 1:
+            config[name] = min(values, key=lambda v: score(measure({**config, name: v})))
+    return config
+
+
+def tune(main_argv, args):
+    cpus = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count()
+    dataset = args.dataset
+    space = {
+        "num_threads": _candidates(cpus),
+        "num_interop_threads": [1, 2, 4],
+        "num_workers": [0, 2, 4],
+        "channels_last": [False, True] if dataset == "mnist" else [False],
+    }
+    trials = {}
+
+    def measure(config):
+        key = json.dumps(config, sort_keys=True)
+        if key not in trials:
+            out = subprocess.run(
+                [sys.executable, "-m", "xvfm.autotune", "--trial", key, "--steps", str(args.steps),
+                 "--sample_steps", str(args.sample_steps), "--sample_sizes", *map(str, args.sample_sizes),
+                 "--", *main_argv],
+                capture_output=True, text=True, check=True,
+            ).stdout
+            trials[key] = json.loads(out.strip().splitlines()[-1])
+            print(f"{config}: {trials[key]}")
+        return trials[key]
+
+    train = _coordinate_search(space, measure, lambda r: r["train_step_seconds"])
+    sample_space = {**space, "num_workers": [0]}
+    sample = _coordinate_search(sample_space, measure, lambda r: -max(r["sample_steps_per_second"].values()))
+    rates = measure(sample)["sample_steps_per_second"]
+    sample["batch_size"] = int(max(rates, key=rates.get))
+    del sample["num_workers"]
+    return {"train": train, "sample": sample, "cpus": cpus, "trials": len(trials)}
+
+
+def save_profile(result, key, path=DEFAULT_PROFILE, default=False):
+    profile = {}
+    if os.path.exists(path):
+        with open(path) as f:
+            profile = json.load(f)
+    host = profile.setdefault(socket.gethostname(), {})
+    host[key] = result
+    if default:
+        host["default"] = result
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(profile, f, indent=2)
+    os.replace(tmp, path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Autotune training and sampling settings', allow_abbrev=False)
+    parser.add_argument('--profile', default=DEFAULT_PROFILE, type=str, help="Profile file to update")
+    parser.add_argument('--steps', default=10, type=int, help="Timed training steps per trial")
+    parser.add_argument('--sample_steps', default=10, type=int, help="Timed integration steps per sampling trial")
+    parser.add_argument('--sample_sizes', nargs='+', default=[256, 1024, 4096], type=int, help="Sampling batch sizes to try")
+    parser.add_argument('--set_default', action='store_true', help="Also use the result for model configs without their own entry")
+    parser.add_argument('--trial', default=None, type=str, help=argparse.SUPPRESS)
+    args, main_argv = parser.parse_known_args()
+    if main_argv[:1] == ['--']:
+        main_argv = main_argv[1:]
+
+    if args.trial is not None:
+        print(json.dumps(run_trial(json.loads(args.trial), main_argv, args.steps, args.sample_steps, args.sample_sizes)))
+        return
+
+    import main as vfm
+
+    main_args = vfm.get_args(main_argv)
+    args.dataset = main_args.dataset
+    key = model_key(main_args.dataset, main_args.learn_sigma, main_args.learned_structure)
+    result = tune(main_argv, args)
+    save_profile(result, key, args.profile, args.set_default)
+    print(f"Tuned {key} on {socket.gethostname()}: {result}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,197 @@
+"""Checkpoints as directories of memory-mapped tensor files.
+
+A checkpoint `<name>.ckpt/` holds
+
+    model.safetensors      model state dict
+    optimizer.safetensors  optimizer state tensors, with the rest of the state in its metadata
+    meta.json              epoch, loss, training arguments, ...
+
+The tensor files use the safetensors layout: an 8-byte little-endian header length, a JSON
+header indexing every tensor by name with its dtype, shape and byte offsets, then the raw bytes.
+Loading maps the file copy-on-write and builds each tensor as a view of the mapping, so nothing
+is read from disk until a tensor is touched and only the requested tensors are ever touched.
+
+    python -m xvfm.checkpoint convert checkpoints/Gaussian_learned_scalar.pt model.ckpt --dtype bfloat16
+    python -m xvfm.checkpoint index model.ckpt
+"""
+import argparse
+import json
+import math
+import mmap
+import os
+import struct
+import torch
+
+from collections.abc import Mapping
+
+DTYPES = {
+    torch.float64: "F64",
+    torch.float32: "F32",
+    torch.float16: "F16",
+    torch.bfloat16: "BF16",
+    torch.int64: "I64",
+    torch.int32: "I32",
+    torch.int16: "I16",
+    torch.int8: "I8",
+    torch.uint8: "U8",
+    torch.bool: "BOOL",
+}
+DTYPE_NAMES = {name: dtype for dtype, name in DTYPES.items()}
+
+
+def save_tensors(filename, tensors, metadata=None):
+    """Write a flat {name: tensor} dict. Tensors are laid out by decreasing element size so
+    every tensor starts at an offset aligned to its dtype."""
+    tensors = {k: v.detach().cpu().contiguous() for k, v in tensors.items()}
+    names = sorted(tensors, key=lambda k: (-tensors[k].element_size(), k))
+    header, offset = {}, 0
+    for name in names:
+        t = tensors[name]
+        size = t.numel() * t.element_size()
+        header[name] = {"dtype": DTYPES[t.dtype], "shape": list(t.shape), "data_offsets": [offset, offset + size]}
+        offset += size
+    if metadata:
+        header["__metadata__"] = {k: str(v) for k, v in metadata.items()}
+    header = json.dumps(header, separators=(",", ":")).encode()
+    header += b" " * (-len(header) % 8)
+
+    tmp = filename + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(struct.pack("<Q", len(header)))
+        f.write(header)
+        for name in names:
+            if tensors[name].numel() > 0:
+                f.write(tensors[name].reshape(-1).view(torch.uint8).numpy().data)
+    os.replace(tmp, filename)
+
+
+class TensorFile(Mapping):
+    """Read-only mapping over a tensor file; each lookup returns a zero-copy view of the file."""
+
+    def __init__(self, filename):
+        with open(filename, "rb") as f:
+            header_size, = struct.unpack("<Q", f.read(8))
+            self.index = json.loads(f.read(header_size))
+            self.metadata = self.index.pop("__metadata__", {})
+            self.data_start = 8 + header_size
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+
+    def __getitem__(self, name):
+        entry = self.index[name]
+        dtype = DTYPE_NAMES[entry["dtype"]]
+        start, end = entry["data_offsets"]
+        if start == end:
+            return torch.empty(entry["shape"], dtype=dtype)
+        flat = torch.frombuffer(
+            self._mmap, dtype=dtype, count=math.prod(entry["shape"]), offset=self.data_start + start
+        )
+        return flat.view(entry["shape"])
+
+    def __iter__(self):
+        return iter(self.index)
+
+    def __len__(self):
+        return len(self.index)
+
+
+def _flatten_optimizer(state_dict):
+    tensors, scalars = {}, {}
+    for i, state in state_dict["state"].items():
+        for k, v in state.items():
+            if torch.is_tensor(v):
+                tensors[f"state.{i}.{k}"] = v
+            else:
+                scalars[f"{i}.{k}"] = v
+    rest = {k: v for k, v in state_dict.items() if k != "state"}
+    return tensors, {"scalars": scalars, **rest}
+
+
+def _unflatten_optimizer(tensors, rest):
+    rest = dict(rest)
+    state = {}
+    for name in tensors:
+        _, i, k = name.split(".", 2)
+        state.setdefault(int(i), {})[k] = tensors[name]
+    for name, v in rest.pop("scalars").items():
+        i, k = name.split(".", 1)
+        state.setdefault(int(i), {})[k] = v
+    return {"state": state, **rest}
+
+
+def _cast(state_dict, dtype):
+    if dtype is None:
+        return state_dict
+    return {k: v.to(dtype) if v.is_floating_point() else v for k, v in state_dict.items()}
+
+
+def save_checkpoint(path, model, optimizer=None, dtype=None, **meta):
+    """Save a model state dict, an optional optimizer state dict and JSON-serialisable `meta`.
+
+    With `dtype` (e.g. torch.bfloat16) floating point weights are stored in that dtype, which
+    makes an inference-only export when no optimizer is given.
+    """
+    os.makedirs(path, exist_ok=True)
+    save_tensors(os.path.join(path, "model.safetensors"), _cast(model, dtype))
+    if optimizer is not None:
+        tensors, rest = _flatten_optimizer(optimizer)
+        save_tensors(os.path.join(path, "optimizer.safetensors"), tensors, {"optimizer": json.dumps(rest)})
+    with open(os.path.join(path, "meta.json"), "w") as f:
+        json.dump(meta, f)
+
+
+def export_inference(path, model, dtype=torch.bfloat16, **meta):
+    save_checkpoint(path, model, dtype=dtype, **meta)
+
+
+def load_checkpoint(path, optimizer=False, names=None, dtype=None):
+    """Load a checkpoint directory as {"model": state_dict, "optimizer": ..., **meta}.
+
+    Model tensors are views of the memory-mapped file unless `dtype` asks for a cast; `names`
+    restricts which of them are returned. The optimizer state is only read if `optimizer`.
+    """
+    with open(os.path.join(path, "meta.json")) as f:
+        checkpoint = json.load(f)
+    weights = TensorFile(os.path.join(path, "model.safetensors"))
+    checkpoint["model"] = _cast({k: weights[k] for k in (names or weights)}, dtype)
+    if optimizer:
+        state = TensorFile(os.path.join(path, "optimizer.safetensors"))
+        checkpoint["optimizer"] = _unflatten_optimizer(
+            {k: state[k] for k in state}, json.loads(state.metadata["optimizer"])
+        )
+    return checkpoint
+
+
+def read_index(path):
+    """Names, dtypes and shapes of the model tensors, without mapping any data."""
+    weights = TensorFile(os.path.join(path, "model.safetensors"))
+    return {k: (v["dtype"], v["shape"]) for k, v in weights.index.items()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Convert and inspect checkpoints')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    convert = subparsers.add_parser('convert', help="Convert a torch.save checkpoint or state dict")
+    convert.add_argument('source', type=str, help="File written by torch.save")
+    convert.add_argument('target', type=str, help="Checkpoint directory to write")
+    convert.add_argument('--dtype', default=None, choices=['float32', 'float16', 'bfloat16'], help="Store weights in this dtype")
+    convert.add_argument('--no_optimizer', action='store_true', help="Drop the optimizer state (inference-only export)")
+    index = subparsers.add_parser('index', help="Print the tensors of a checkpoint directory")
+    index.add_argument('path', type=str, help="Checkpoint directory")
+    args = parser.parse_args()
+
+    if args.command == 'convert':
+        checkpoint = torch.load(args.source, map_location="cpu")
+        if "model" not in checkpoint:
+            checkpoint = {"model": checkpoint}
+        model = checkpoint.pop("model")
+        optimizer = None if args.no_optimizer else checkpoint.pop("optimizer", None)
+        checkpoint.pop("optimizer", None)
+        dtype = getattr(torch, args.dtype) if args.dtype else None
+        save_checkpoint(args.target, model, optimizer, dtype=dtype, **checkpoint)
+    else:
+        for name, (dtype, shape) in read_index(args.path).items():
+            print(f"{name:<60} {dtype:<5} {shape}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+import time
+import warnings
+import torch
+
+
+def _compile_errors():
+    """Exceptions that mean torch.compile could not handle a function, as opposed to errors
+    the function raises itself (shape bugs, out of memory), which must propagate."""
+    from torch._dynamo import exc
+
+    return (exc.BackendCompilerFailed, exc.Unsupported, exc.InternalTorchDynamoError)
+
+
+class CompiledLoss:
+    """Wraps a loss function x_1 -> loss with torch.compile using static shapes.
+
+    One graph is compiled per input shape bucket, so a run compiles at most twice: once for the
+    full batch and once for the final partial batch (or micro-batch). Ops dynamo cannot trace
+    are split out as graph breaks and run eagerly; if compilation of a bucket fails outright,
+    that bucket falls back to the eager function for the rest of the run.
+    """
+
+    def __init__(self, fn, mode=None):
+        self.fn = fn
+        self.mode = mode
+        self.cache = {}
+
+    def __call__(self, x_1):
+        key = (tuple(x_1.shape), x_1.dtype)
+        if key not in self.cache:
+            self.cache[key] = torch.compile(self.fn, dynamic=False, mode=self.mode)
+        compiled = self.cache[key]
+        if compiled is self.fn:
+            return self.fn(x_1)
+        try:
+            return compiled(x_1)
+        except _compile_errors() as e:
+            warnings.warn(f"Compiling the loss for input {key} failed, using eager mode: {e}")
+            self.cache[key] = self.fn
+            return self.fn(x_1)
+
+
+def time_loss_step(loss_fn, x_1, params, num_steps=20, warmup=3):
+    """Mean wall time of a forward and backward pass of loss_fn(x_1), excluding warmup."""
+    for i in range(warmup + num_steps):
+        if i == warmup:
+            if x_1.is_cuda:
+                torch.cuda.synchronize()
+            start = time.perf_counter()
+        loss_fn(x_1).backward()
+        for p in params:
+            p.grad = None
+    if x_1.is_cuda:
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / num_steps
+
+
+class VelocityGraph(torch.nn.Module):
+    """The velocity field of a VFM as a single module of (x_t, t): the posterior mean network
+    followed by the interpolator, without building the posterior distribution."""
+
+    def __init__(self, model):
+        super().__init__()
+        self.variational_dist = model.variational_dist
+        self.interpolator = model.interpolator
+
+    def forward(self, x_t, t):
+        mu = self.variational_dist.mean(x_t, t).view_as(x_t)
+        return self.interpolator.compute_v_t(mu, x_t, t.view(-1, *([1] * (x_t.dim() - 1))))
+
+
+class CompiledVelocity:
+    """Ahead-of-time graphs of a model's velocity field, one per batch-size bucket.
+
+    backend='script' traces the velocity into a frozen TorchScript graph, which runs without
+    the Python interpreter; backend='export' uses torch.export. Batches are zero-padded to the
+    next power of two (at least `min_bucket`), so sampling with varying batch sizes builds only
+    a few graphs. The weights are captured when a graph is built, so build a new
+    CompiledVelocity after the weights change. Calls that need gradients, and buckets whose
+    graph fails to build, use the eager velocity field instead.
+    """
+
+    def __init__(self, model, backend="script", min_bucket=64):
+        self.model = model
+        self.graph = VelocityGraph(model)
+        self.backend = backend
+        self.min_bucket = min_bucket
+        self.cache = {}
+
+    def bucket(self, n):
+        return max(self.min_bucket, 1 << (n - 1).bit_length())
+
+    def build(self, x_t, t):
+        training = self.graph.training
+        self.graph.eval()
+        try:
+            with torch.no_grad(), warnings.catch_warnings():
+                # Tracing warns about shape-dependent Python control flow; shapes are fixed per bucket.
+                warnings.simplefilter("ignore")
+                if self.backend == "export":
+                    return torch.export.export(self.graph, (x_t, t)).module()
+                return torch.jit.freeze(torch.jit.trace(self.graph, (x_t, t)))
+        finally:
+            self.graph.train(training)
+
+    def __call__(self, x_t, t):
+        if torch.is_grad_enabled() and (x_t.requires_grad or any(p.requires_grad for p in self.model.parameters())):
+            return self.model.velocity_field(x_t, t)
+        n = x_t.shape[0]
+        size = self.bucket(n)
+        t = t.reshape(-1, 1).expand(n, 1)
+        if size > n:
+            x_t = torch.cat([x_t, x_t.new_zeros(size - n, *x_t.shape[1:])])
+            t = torch.cat([t, t.new_zeros(size - n, 1)])
+        key = (tuple(x_t.shape), x_t.dtype, x_t.device)
+        if key not in self.cache:
+            try:
+                self.cache[key] = self.build(x_t, t.contiguous())
+            except Exception as e:
+                warnings.warn(f"Exporting the velocity for input {key} failed, using eager mode: {e}")
+                self.cache[key] = None
+        graph = self.cache[key]
+        if graph is None:
+            return self.model.velocity_field(x_t[:n], t[:n])
+        return graph(x_t, t.contiguous())[:n]
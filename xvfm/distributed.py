@@ -0,0 +1,204 @@
+import os
+import socket
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+from xvfm.unet.fp16_util import get_param_groups_and_shapes, param_grad_or_zeros, zero_master_grads
+from torch._utils import _flatten_dense_tensors, _unflatten_dense_tensors
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def is_main_process():
+    return get_rank() == 0
+
+
+def barrier():
+    if is_distributed():
+        dist.barrier()
+
+
+def setup(rank, world_size, backend="gloo"):
+    """Join the local process group and split the host's cores between ranks."""
+    os.environ.setdefault("MASTER_ADDR", "127.0.0.1")
+    os.environ.setdefault("MASTER_PORT", "29500")
+    # Exported so that code which only inspects the environment (e.g. the logger) sees the rank.
+    os.environ["RANK"], os.environ["WORLD_SIZE"] = str(rank), str(world_size)
+    os.environ["LOCAL_RANK"], os.environ["LOCAL_WORLD_SIZE"] = str(rank), str(world_size)
+    dist.init_process_group(backend, rank=rank, world_size=world_size)
+    torch.set_num_threads(max(1, (os.cpu_count() or 1) // world_size))
+
+
+def cleanup():
+    if is_distributed():
+        dist.destroy_process_group()
+
+
+def launch(fn, world_size, *args):
+    """Spawn `world_size` local processes, each running fn(rank, world_size, *args)."""
+    os.environ.setdefault("MASTER_ADDR", "127.0.0.1")
+    if "MASTER_PORT" not in os.environ:
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+            s.bind(("", 0))
+            os.environ["MASTER_PORT"] = str(s.getsockname()[1])
+    mp.spawn(fn, args=(world_size, *args), nprocs=world_size, join=True)
+
+
+def broadcast_object(obj, src=0):
+    """Return `src`'s value of a picklable object on every rank."""
+    if not is_distributed():
+        return obj
+    objects = [obj]
+    dist.broadcast_object_list(objects, src=src)
+    return objects[0]
+
+
+def broadcast_parameters(params, src=0):
+    """Make every rank start from the parameters held by `src`."""
+    if not is_distributed():
+        return
+    with torch.no_grad():
+        for p in params:
+            dist.broadcast(p.data, src=src)
+
+
+def allreduce_gradients(params, bucket_cap_mb=25):
+    """Average gradients across ranks, one flat all-reduce per bucket of at most `bucket_cap_mb`.
+
+    Parameters without a gradient contribute zeros so that every rank issues the same collectives.
+    """
+    world_size = get_world_size()
+    if world_size == 1:
+        return
+    params = [p for p in params if p.requires_grad]
+    for bucket in _buckets(params, bucket_cap_mb * 1024 * 1024):
+        grads = [param_grad_or_zeros(p) for p in bucket]
+        flat = _flatten_dense_tensors(grads)
+        dist.all_reduce(flat)
+        flat.div_(world_size)
+        for p, synced in zip(bucket, _unflatten_dense_tensors(flat, grads)):
+            if p.grad is None:
+                p.grad = synced.clone()
+            else:
+                p.grad.copy_(synced)
+
+
+def _buckets(params, cap_bytes):
+    bucket, size = [], 0
+    for p in params:
+        nbytes = p.numel() * p.element_size()
+        if bucket and (size + nbytes > cap_bytes or p.dtype != bucket[0].dtype):
+            yield bucket
+            bucket, size = [], 0
+        bucket.append(p)
+        size += nbytes
+    if bucket:
+        yield bucket
+
+
+class ShardedOptimizer:
+    """ZeRO-style optimizer: each rank holds the fp32 master copy and optimizer state for one
+    contiguous slice of the flattened parameters.
+
+    Gradients are reduce-scattered onto the owning rank, the wrapped optimizer updates the local
+    slice only, and the updated slices are all-gathered back into the model parameters. The
+    optimizer calls are collectives and must be made on every rank. Backends without
+    reduce-scatter (gloo) fall back to an all-reduce followed by a slice, which still shards the
+    optimizer state but not the gradient traffic.
+    """
+
+    def __init__(self, params, optimizer_cls=torch.optim.Adam, **kwargs):
+        self.rank, self.world_size = get_rank(), get_world_size()
+        named_params = [(str(i), p) for i, p in enumerate(params) if p.requires_grad]
+        self.groups = []
+        for param_group, _ in get_param_groups_and_shapes(named_params):
+            group = [p for (_, p) in param_group]
+            if not group:
+                continue
+            flat = _flatten_dense_tensors([p.detach().float() for p in group])
+            shard_size = -(-flat.numel() // self.world_size)
+            flat = _pad(flat, shard_size * self.world_size)
+            shard = torch.nn.Parameter(flat[self.rank * shard_size:(self.rank + 1) * shard_size].clone())
+            self.groups.append((group, shard))
+        self.optimizer = optimizer_cls([shard for _, shard in self.groups], **kwargs)
+
+    @property
+    def param_groups(self):
+        return self.optimizer.param_groups
+
+    def zero_grad(self):
+        zero_master_grads([p for group, _ in self.groups for p in group])
+
+    def step(self):
+        for group, shard in self.groups:
+            flat = _flatten_dense_tensors([param_grad_or_zeros(p).float() for p in group])
+            shard.grad = self._reduce_scatter(_pad(flat, shard.numel() * self.world_size)) / self.world_size
+        self.optimizer.step()
+        with torch.no_grad():
+            for group, shard in self.groups:
+                flat = self._all_gather(shard.detach())
+                for p, new in zip(group, _unflatten_dense_tensors(flat[:sum(p.numel() for p in group)], group)):
+                    p.copy_(new)
+
+    def state_dict(self):
+        """Gather the full optimizer state; a collective, so call it on every rank.
+
+        Sharded state tensors are saved without the padding of this world size, so the state
+        loads under any world size.
+        """
+        state_dict = self.optimizer.state_dict()
+        state_dict["state"] = {i: dict(state) for i, state in state_dict["state"].items()}
+        for i, (group, shard) in enumerate(self.groups):
+            numel = sum(p.numel() for p in group)
+            for k, v in state_dict["state"].get(i, {}).items():
+                if torch.is_tensor(v) and v.shape == shard.shape:
+                    state_dict["state"][i][k] = self._all_gather(v)[:numel]
+        state_dict["world_size"] = self.world_size
+        return state_dict
+
+    def load_state_dict(self, state_dict):
+        state_dict = {k: v for k, v in state_dict.items() if k != "world_size"}
+        state_dict["state"] = {i: dict(state) for i, state in state_dict["state"].items()}
+        for i, (group, shard) in enumerate(self.groups):
+            n, numel = shard.numel(), sum(p.numel() for p in group)
+            for k, v in state_dict["state"].get(i, {}).items():
+                if torch.is_tensor(v) and v.dim() == 1 and v.numel() >= numel:
+                    # Drop any padding of the saving world size, then pad for this one.
+                    v = _pad(v[:numel], n * self.world_size)
+                    state_dict["state"][i][k] = v[self.rank * n:(self.rank + 1) * n].clone()
+        self.optimizer.load_state_dict(state_dict)
+
+    def _reduce_scatter(self, flat):
+        shard_size = flat.numel() // self.world_size
+        if self.world_size == 1:
+            return flat
+        if dist.get_backend() != "gloo":
+            shard = torch.empty(shard_size, dtype=flat.dtype, device=flat.device)
+            dist.reduce_scatter_tensor(shard, flat)
+            return shard
+        dist.all_reduce(flat)
+        return flat[self.rank * shard_size:(self.rank + 1) * shard_size].clone()
+
+    def _all_gather(self, shard):
+        if self.world_size == 1:
+            return shard.clone()
+        shards = [torch.empty_like(shard) for _ in range(self.world_size)]
+        dist.all_gather(shards, shard.contiguous())
+        return torch.cat(shards)
+
+
+def _pad(flat, numel):
+    if flat.numel() == numel:
+        return flat
+    return torch.cat([flat, flat.new_zeros(numel - flat.numel())])
@@ -0,0 +1,96 @@
+import copy
+import torch
+
+from contextlib import contextmanager
+from torch.func import functional_call, vmap
+
+
+@contextmanager
+def _no_distribution_validation():
+    # Argument validation branches on tensor values, which vmap cannot trace.
+    default = torch.distributions.Distribution._validate_args
+    torch.distributions.Distribution.set_default_validate_args(False)
+    try:
+        yield
+    finally:
+        torch.distributions.Distribution.set_default_validate_args(default)
+
+
+class Ensemble:
+    """Trains M flow models of the same architecture with one vmapped forward and backward.
+
+    Members keep their own parameters, so each can have its own optimizer and checkpoint.
+    Every step stacks the member parameters along a new leading dimension and evaluates a
+    stateless copy of the variational distribution over that dimension with vmap; gradients
+    flow back through the stack into each member. Members share the prior and interpolator
+    of the first member, and the time, noise and prior samples of a step differ per member.
+    """
+
+    def __init__(self, members):
+        self.members = list(members)
+        self.base = copy.deepcopy(self.members[0].variational_dist).to("meta")
+        dists = [m.variational_dist for m in self.members]
+        self.param_names = [name for name, _ in dists[0].named_parameters()]
+        self.buffer_names = [name for name, _ in dists[0].named_buffers()]
+        self.params = [dict(d.named_parameters()) for d in dists]
+        self.buffers = [dict(d.named_buffers()) for d in dists]
+
+    def __len__(self):
+        return len(self.members)
+
+    def stacked_state(self):
+        params = {k: torch.stack([p[k] for p in self.params]) for k in self.param_names}
+        buffers = {k: torch.stack([b[k] for b in self.buffers]) for k in self.buffer_names}
+        return params, buffers
+
+    def sample_t_and_x_t(self, x_1):
+        """Per-member times and interpolants for a shared batch, shaped [M, B, ...]."""
+        num_members, batch_size = len(self), x_1.shape[0]
+        t, x_t = self.members[0].sample_t_and_x_t(x_1.repeat(num_members, *([1] * (x_1.dim() - 1))))
+        return t.view(num_members, batch_size, *t.shape[1:]), x_t.view(num_members, batch_size, *x_t.shape[1:])
+
+    def loss(self, criterion, x_1):
+        """Per-member losses criterion(posterior_m, x_1) as a tensor of shape [M]."""
+        t, x_t = self.sample_t_and_x_t(x_1)
+        x_1 = x_1.view(x_1.shape[0], -1)
+
+        def member_loss(params, buffers, t, x_t):
+            posterior = functional_call(self.base, (params, buffers), (x_t, t))
+            return criterion(posterior, x_1)
+
+        with _no_distribution_validation():
+            return vmap(member_loss, randomness="different")(*self.stacked_state(), t, x_t)
+
+    def velocity_field(self, x_t, t):
+        """Velocities of all members for inputs x_t of shape [M, N, ...] and t of shape [N, 1]."""
+        def member_mean(params, buffers, x_t):
+            return functional_call(self.base, (params, buffers), (x_t, t)).mean
+
+        with _no_distribution_validation():
+            mu = vmap(member_mean)(*self.stacked_state(), x_t).view_as(x_t)
+        return self.members[0].interpolator.compute_v_t(mu, x_t, t.view(1, -1, *([1] * (x_t.dim() - 2))))
+
+    @torch.no_grad()
+    def generate(self, num_samples=100, steps=100, device=None):
+        """Euler trajectories of every member at once, shaped [steps + 1, M, num_samples, ...].
+
+        Matches FlowModel.generate(method='euler') member by member.
+        """
+        if device is None:
+            device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+
+        num_members = len(self)
+        xt = self.members[0].prior.sample(num_members * num_samples).to(device)
+        shape = (1, 28, 28) if xt.shape[1] > 2 else xt.shape[1:]
+        xt = xt.view(num_members, num_samples, *shape)
+
+        trajectory = torch.zeros((steps + 1, *xt.shape), device=device)
+        trajectory[0] = xt
+        time_steps = torch.linspace(0, 1, steps, device=device).unsqueeze(1)
+
+        for k in range(steps - 1):
+            t = time_steps[k].expand(num_samples, 1)
+            xt = xt + self.velocity_field(xt, t) * (time_steps[k + 1] - time_steps[k])
+            trajectory[k + 1] = xt
+
+        return trajectory
@@ -0,0 +1,206 @@
+"""Live training and sampling metrics in the Prometheus text format, served over HTTP.
+
+Metrics are module-level and always updated (an update is a lock and an add); they are only
+exposed once start_server() is called, e.g. via main.py --metrics_port 9100, after which
+any Prometheus-compatible scraper can read http://127.0.0.1:9100/metrics.
+"""
+import math
+import threading
+import time
+
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+_registry = []
+_lock = threading.Lock()
+
+
+def _format_value(value):
+    if math.isnan(value):
+        return "NaN"
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value))
+
+
+class Counter:
+    def __init__(self, name, documentation):
+        self.name = name
+        self.documentation = documentation
+        self.value = 0.0
+        _registry.append(self)
+
+    def inc(self, amount=1):
+        with _lock:
+            self.value += amount
+
+    def render(self):
+        return [f"# TYPE {self.name} counter", f"{self.name} {_format_value(self.value)}"]
+
+
+class Gauge:
+    """A value that is set directly, or computed at scrape time by set_function(fn)."""
+
+    def __init__(self, name, documentation):
+        self.name = name
+        self.documentation = documentation
+        self.value = 0.0
+        self.function = None
+        _registry.append(self)
+
+    def set(self, value):
+        self.value = value
+
+    def set_function(self, function):
+        self.function = function
+
+    def render(self):
+        value = self.function() if self.function is not None else self.value
+        return [f"# TYPE {self.name} gauge", f"{self.name} {_format_value(value)}"]
+
+
+class Summary:
+    """Count and sum of all observations, and quantiles over the most recent `window` of them."""
+
+    def __init__(self, name, documentation, quantiles=(0.5, 0.9, 0.99), window=1024):
+        self.name = name
+        self.documentation = documentation
+        self.quantiles = quantiles
+        self.recent = deque(maxlen=window)
+        self.count = 0
+        self.sum = 0.0
+        _registry.append(self)
+
+    def observe(self, value):
+        with _lock:
+            self.recent.append(value)
+            self.count += 1
+            self.sum += value
+
+    def render(self):
+        lines = [f"# TYPE {self.name} summary"]
+        ordered = sorted(self.recent)
+        for q in self.quantiles:
+            value = ordered[min(len(ordered) - 1, int(q * len(ordered)))] if ordered else float("nan")
+            lines.append(f'{self.name}{{quantile="{q}"}} {_format_value(value)}')
+        lines.append(f"{self.name}_sum {_format_value(self.sum)}")
+        lines.append(f"{self.name}_count {self.count}")
+        return lines
+
+
+class Histogram:
+    """Cumulative counts of observations at or below each bucket bound, with their sum and count."""
+
+    def __init__(self, name, documentation, buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = tuple(buckets) + (float("inf"),)
+        self.counts = [0] * len(self.buckets)
+        self.count = 0
+        self.sum = 0.0
+        _registry.append(self)
+
+    def observe(self, value):
+        with _lock:
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    self.counts[i] += 1
+            self.count += 1
+            self.sum += value
+
+    def render(self):
+        lines = [f"# TYPE {self.name} histogram"]
+        for bound, count in zip(self.buckets, self.counts):
+            lines.append(f'{self.name}_bucket{{le="{_format_value(bound)}"}} {count}')
+        lines.append(f"{self.name}_sum {_format_value(self.sum)}")
+        lines.append(f"{self.name}_count {self.count}")
+        return lines
+
+
+def render():
+    lines = []
+    with _lock:
+        for metric in _registry:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+train_steps = Counter("xvfm_train_steps_total", "Optimizer steps taken")
+train_samples = Counter("xvfm_train_samples_total", "Training examples processed")
+train_steps_per_second = Gauge("xvfm_train_steps_per_second", "Recent optimizer steps per second, including data loading")
+train_samples_per_second = Gauge("xvfm_train_samples_per_second", "Recent training examples per second, including data loading")
+train_step_seconds = Summary("xvfm_train_step_seconds", "Latency of one forward, backward and optimizer step")
+eval_seconds = Summary("xvfm_eval_seconds", "Duration of an evaluation")
+checkpoint_seconds = Summary("xvfm_checkpoint_seconds", "Duration of writing a checkpoint")
+generated_samples = Counter("xvfm_generated_samples_total", "Samples drawn by FlowModel.generate")
+generate_seconds = Summary("xvfm_generate_seconds", "Duration of a FlowModel.generate call")
+nfe_per_sample = Gauge("xvfm_nfe_per_sample", "Velocity field evaluations per sample in the last generate call")
+logger_queue_depth = Gauge("xvfm_logger_queue_depth", "Records waiting in the background logger sinks")
+sampling_requests = Counter("xvfm_sampling_requests_total", "Requests completed by the sampling service")
+sampling_request_seconds = Histogram("xvfm_sampling_request_seconds", "Latency of a sampling service request, from arrival to its last samples")
+sampling_queue_seconds = Histogram("xvfm_sampling_queue_seconds", "Time a sampling service request waits before its first rows join the batch")
+sampling_first_chunk_seconds = Histogram("xvfm_sampling_first_chunk_seconds", "Time from the arrival of a sampling service request to its first streamed samples")
+sampling_batch_rows = Summary("xvfm_sampling_batch_rows", "Rows integrated per velocity evaluation of the sampling service")
+sampling_active_rows = Gauge("xvfm_sampling_active_rows", "Rows being integrated by the sampling service")
+sampling_queued_rows = Gauge("xvfm_sampling_queued_rows", "Rows waiting to join the sampling service batch")
+
+_last_step = None
+_interval = None
+
+
+def record_train_step(batch_size, seconds, smoothing=0.9):
+    """Count a training step of `batch_size` examples that took `seconds`.
+
+    The throughput gauges use a moving average of the wall time between steps, so they also
+    account for time spent outside the step, such as data loading.
+    """
+    global _last_step, _interval
+    now = time.perf_counter()
+    train_steps.inc()
+    train_samples.inc(batch_size)
+    train_step_seconds.observe(seconds)
+    if _last_step is not None:
+        interval = now - _last_step
+        _interval = interval if _interval is None else smoothing * _interval + (1 - smoothing) * interval
+        train_steps_per_second.set(1 / _interval)
+        train_samples_per_second.set(batch_size / _interval)
+    _last_step = now
+
+
+def record_generate(num_samples, seconds, nfe):
+    generated_samples.inc(num_samples)
+    generate_seconds.observe(seconds)
+    nfe_per_sample.set(nfe)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_server(port, host="127.0.0.1"):
+    """Serve the metrics from a daemon thread; returns the server (stop it with stop_server())."""
+    from xvfm.unet import logger
+
+    logger_queue_depth.set_function(lambda: sum(fmt.queue.qsize() for fmt in list(logger._async_formats)))
+    server = ThreadingHTTPServer((host, port), _Handler)
+    threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
+    return server
+
+
+def stop_server(server):
+    """Stop a server from start_server() and close its listening socket."""
+    server.shutdown()
+    server.server_close()
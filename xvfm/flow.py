@@ -1,11 +1,32 @@
+import time
 import torch
 
 from abc import ABC, abstractmethod
 from xvfm.prior import Prior
-from torchdyn.core import NeuralODE
+from xvfm.profiling import phase
+from xvfm.exporter import record_generate
 from xvfm.variational import VariationalDist
 from xvfm.interpolator import Interpolator
 
+# Time grids for the fixed-step solvers, as maps of uniformly spaced points in [0, 1]. Each
+# step goes from one grid time to the next, so every grid ends at t=1.
+TIME_GRIDS = {
+    'uniform': lambda s: s,
+    'early': lambda s: s ** 2,
+    'late': lambda s: 1 - (1 - s) ** 2,
+    'cosine': lambda s: (1 - torch.cos(torch.pi * s)) / 2,
+}
+
+
+def _posterior_mean(variational_dist, x_t, t):
+    # The velocity only needs the posterior mean; building the full Gaussian (with its
+    # covariance factorisation) costs more than the mean network itself.
+    if hasattr(variational_dist, "mean"):
+        mu = variational_dist.mean(x_t, t)
+    else:
+        mu = variational_dist(x_t, t).mean
+    return mu.view(-1, *x_t.shape[1:]).to(x_t.device)
+
 
 class FlowModel(torch.nn.Module, ABC):
     def __init__(
@@ -25,12 +46,33 @@ class FlowModel(torch.nn.Module, ABC):
 
     def sample_t_and_x_t(self, x_1):
         num_samples = x_1.shape[0]
-        t = self.interpolator.sample_t(num_samples).to(x_1.device)
-        x_0 = self.prior.sample(num_samples).view(-1, *x_1.shape[1:]).to(x_1.device)
-        x_t = self.interpolator.sample_x_t(x_0, x_1, t).to(x_1.device)
+        with phase("prior"):
+            t = self.interpolator.sample_t(num_samples).to(x_1.device)
+            x_0 = self.prior.sample(num_samples).view(-1, *x_1.shape[1:]).to(x_1.device)
+        with phase("interpolation"):
+            x_t = self.interpolator.sample_x_t(x_0, x_1, t).to(x_1.device)
         return t, x_t
 
-    def generate(self, num_samples=100, steps=100, device=None, method='euler'):
+    def compile_velocity(self, backend='script', min_bucket=64):
+        """Use ahead-of-time graphs of the velocity field in generate (see CompiledVelocity).
+
+        The graphs capture the current weights; call again after the weights change, or with
+        backend=None to go back to the eager velocity field.
+        """
+        from xvfm.compiled import CompiledVelocity
+
+        # Kept out of the module tree so it is neither saved nor moved with the model.
+        self.__dict__["_compiled_velocity"] = CompiledVelocity(self, backend, min_bucket) if backend else None
+
+    def generate(self, num_samples=100, steps=100, device=None, method='euler', time_grid='uniform', atol=1e-4, rtol=1e-4):
+        """Integrate prior samples from t=0 towards t=1.
+
+        'euler' and 'midpoint' take steps - 1 fixed steps over `time_grid` (see TIME_GRIDS) and
+        leave the final samples in trajectory[-2]; 'adaptive' runs dopri5 with tolerances
+        atol/rtol and returns the solution at `steps` uniform times, ending in trajectory[-1].
+        """
+        start = time.perf_counter()
+        velocity_field = self.__dict__.get("_compiled_velocity") or self.velocity_field
         if device is None:
             device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
 
@@ -40,27 +82,38 @@ class FlowModel(torch.nn.Module, ABC):
         else:
             xt = xt.to(device)
 
-        if method == 'euler':
+        if method in ('euler', 'midpoint'):
             with torch.no_grad():
-                delta_t = 1.0 / steps
-                trajectory = torch.zeros((steps + 1, *xt.shape), device=device)
+                with phase("trajectory"):
+                    trajectory = torch.zeros((steps + 1, *xt.shape), device=device)
                 trajectory[0] = xt
-                time_steps = torch.linspace(0, 1, steps, device=device).unsqueeze(1)
+                time_steps = TIME_GRIDS[time_grid](torch.linspace(0, 1, steps, device=device)).unsqueeze(1)
 
-                for k in range(steps - 1):
-                    t = time_steps[k].expand(xt.shape[0], 1)
-                    v_t = self.velocity_field(xt, t)
-                    xt = xt + v_t * delta_t
-                    trajectory[k + 1] = xt
+                with phase("integration"):
+                    for k in range(steps - 1):
+                        t = time_steps[k].expand(xt.shape[0], 1)
+                        delta_t = time_steps[k + 1] - time_steps[k]
+                        v_t = velocity_field(xt, t)
+                        if method == 'midpoint':
+                            v_t = velocity_field(xt + v_t * delta_t / 2, t + delta_t / 2)
+                        xt = xt + v_t * delta_t
+                        trajectory[k + 1] = xt
 
+                nfe = (steps - 1) * (2 if method == 'midpoint' else 1)
+                record_generate(num_samples, time.perf_counter() - start, nfe=nfe)
                 return trajectory
             
         elif method == 'adaptive':    
-            v_t = Velocity(self.variational_dist, self.interpolator)
-            node = NeuralODE(v_t, solver="dopri5", sensitivity="adjoint", atol=1e-4, rtol=1e-4)
+            # torchdyn pulls in pytorch_lightning; only import it when an ODE solver is needed.
+            from torchdyn.core import NeuralODE
+
+            v_t = Velocity(self.variational_dist, self.interpolator, self.__dict__.get("_compiled_velocity"))
+            node = NeuralODE(v_t, solver="dopri5", sensitivity="adjoint", atol=atol, rtol=rtol)
             t = torch.linspace(0, 1, steps, device=device)
             with torch.no_grad():
-                return node.trajectory(xt, t_span=t)
+                trajectory = node.trajectory(xt, t_span=t)
+            record_generate(num_samples, time.perf_counter() - start, nfe=v_t.nfe)
+            return trajectory
             
         else:
             raise ValueError("Invalid method argument")
@@ -78,16 +131,24 @@ class VFM(FlowModel):
         self.learn_sigma = learn_sigma
 
     def velocity_field(self, x_t, t):
-        mu = self.variational_dist(x_t, t).mean.view(-1, *x_t.shape[1:]).to(x_t.device)
+        mu = _posterior_mean(self.variational_dist, x_t, t)
         return self.interpolator.compute_v_t(mu, x_t, t.view(-1, *([1] * (x_t.dim() - 1))))
     
 
 class Velocity(torch.nn.Module):
-    def __init__(self, variational_dist, interpolator):
+    def __init__(self, variational_dist, interpolator, compiled=None):
         super(Velocity, self).__init__()
         self.variational_dist = variational_dist
         self.interpolator = interpolator
+        self.compiled = compiled
+        self.nfe = 0
 
     def forward(self, t, x_t, args=None):
-        mu = self.variational_dist(x_t, t).mean.view(-1, *x_t.shape[1:]).to(x_t.device)
+        self.nfe += 1
+        if t.numel() == 1:
+            # The ODE solver passes a single time; the models expect the Euler loop's (N, 1) layout.
+            t = t.reshape(1, 1).expand(x_t.shape[0], 1)
+        if self.compiled is not None:
+            return self.compiled(x_t, t)
+        mu = _posterior_mean(self.variational_dist, x_t, t)
         return self.interpolator.compute_v_t(mu, x_t, t.view(-1, *([1] * (x_t.dim() - 1))))
\ No newline at end of file
@@ -8,60 +8,62 @@ from xvfm.gmm.models import Enc_rws_eta, Enc_apg_eta, Enc_apg_z, Generative
 from xvfm.gmm.kls_gmm import kls_eta
 from xvfm.gmm.resampler import Resampler
 from xvfm.gmm.objectives import apg_objective, rws_objective
-from xvfm.gmm.apg_training import train, init_apg_models, init_rws_models
+from xvfm.metrics import MetricAccumulator
+from xvfm.profiling import phase
+from xvfm.unet import logger
+from xvfm import exporter
 
 
-def train(objective, optimizer, models, data, assignments, num_epochs, sample_size, batch_size, CUDA, device, model_version, **kwargs):
+def train(objective, optimizer, models, data, assignments, num_epochs, sample_size, batch_size, CUDA, device, model_version, profiler=None, **kwargs):
     """
-    training function for apg samplers
+    training function for apg samplers; `profiler` is an optional xvfm.profiling.ProfilerWindow
     """
     result_flags = {'loss_required' : True, 'ess_required' : True, 'mode_required' : False, 'density_required': True}
     num_batches = int((data.shape[0] / batch_size))
+    step = 0
     for epoch in range(num_epochs):
         time_start = time.time()
-        metrics = {'ess': 0.0, 'density' : 0.0, 'inc_kl' : 0.0, 'exc_kl' : 0.0}
+        metrics = MetricAccumulator()
         data, assignments = shuffler(data, assignments)
 
         for b in range(num_batches):
+            if profiler is not None:
+                profiler.step(step)
+            step += 1
 
+            step_start = time.perf_counter()
             optimizer.zero_grad()
-            x = data[b*batch_size : (b+1)*batch_size].repeat(sample_size, 1, 1, 1)
-            z_true = assignments[b*batch_size : (b+1)*batch_size].repeat(sample_size, 1, 1, 1)
+            with phase("data"):
+                x = data[b*batch_size : (b+1)*batch_size].repeat(sample_size, 1, 1, 1)
+                z_true = assignments[b*batch_size : (b+1)*batch_size].repeat(sample_size, 1, 1, 1)
 
-            if CUDA:
-                x = x.cuda().to(device)
-                z_true = z_true.cuda().to(device)
+                if CUDA:
+                    x = x.cuda().to(device)
+                    z_true = z_true.cuda().to(device)
 
-            trace = objective(models, x, result_flags, **kwargs)
-            loss = trace['loss'].sum()
-            loss.backward()
-            optimizer.step()
+            with phase("forward"):
+                trace = objective(models, x, result_flags, **kwargs)
+            with phase("loss"):
+                loss = trace['loss'].sum()
+            with phase("backward"):
+                loss.backward()
+            with phase("optimizer"):
+                optimizer.step()
+            exporter.record_train_step(x.shape[1], time.perf_counter() - step_start)
 
-            if 'ess' in metrics:
-                metrics['ess'] += trace['ess'][-1].mean()
-            else:
-                metrics['ess'] = trace['ess'][-1].mean()
-
-            if 'density' in metrics:
-                metrics['density'] += trace['density'][-1].mean() 
-            else:
-                metrics['density'] = trace['density'][-1].mean() 
+            metrics.update(ess=trace['ess'][-1].mean(), density=trace['density'][-1].mean())
 
             if kwargs['num_sweeps'] > 1:
-                exc_kl, inc_kl = kls_eta(models, x, z_true)
-
-                if 'inc_kl' in metrics:
-                    metrics['inc_kl'] += inc_kl
-                else:
-                    metrics['inc_kl'] = inc_kl
-
-                if 'exc_kl' in metrics:
-                    metrics['exc_kl'] += exc_kl
-                else:
-                    metrics['exc_kl'] = exc_kl
+                with phase("eval"):
+                    exc_kl, inc_kl = kls_eta(models, x, z_true)
+                metrics.update(inc_kl=inc_kl, exc_kl=exc_kl)
 
-        save_apg_models(models, model_version)
-        metrics_print = ", ".join(['%s=%.4f' % (k, v / num_batches) for k, v in metrics.items()])
+        checkpoint_start = time.perf_counter()
+        with phase("checkpoint"):
+            save_apg_models(models, model_version)
+        exporter.checkpoint_seconds.observe(time.perf_counter() - checkpoint_start)
+        epoch_metrics = metrics.compute()
+        metrics_print = ", ".join(['%s=%.4f' % (k, v) for k, v in epoch_metrics.items()])
         if not os.path.exists('results/'):
             os.makedirs('results/')
         log_file = open('results/log-' + model_version + '.txt', 'a+')
@@ -69,6 +71,10 @@ def train(objective, optimizer, models, data, assignments, num_epochs, sample_si
         print(metrics_print, file=log_file)
         log_file.close()
         print("Epoch=%d / %d (%ds),  " % (epoch+1, num_epochs, time_end - time_start))
+        logger.logkvs({"epoch": epoch + 1, **epoch_metrics})
+        logger.dumpkvs()
+    if profiler is not None:
+        profiler.close()
         
 def shuffler(data, assignments):
     """
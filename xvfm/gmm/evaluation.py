@@ -1,11 +1,8 @@
 import time
 import torch
 import numpy as np
-import pandas as pd
-import matplotlib.pyplot as plt
-import matplotlib.gridspec as gridspec
 
-from matplotlib.patches import Ellipse
+# pandas and matplotlib are only imported by the analysis and plotting functions that use them.
 from xvfm.gmm.resampler import Resampler
 from xvfm.gmm.objectives import apg_objective, bpg_objective, gibbs_objective, hmc_objective
 from xvfm.gmm.hmc import HMC
@@ -55,6 +52,8 @@ def density_all_instances(models, data, sample_size, K, num_sweeps, lf_step_size
         print('method=%s, log joint=%.2f' % (key, densities[key]))
 
 def plot_convergence(densities, fs=6, fs_title=14, lw=3, opacity=0.1, colors = ['#0077BB', '#009988', '#EE7733', '#AA3377', '#555555', '#999933']):
+    import matplotlib.pyplot as plt
+
     fig = plt.figure(figsize=(fs*2.5,fs)) 
     ax = fig.add_subplot(111)
     i = 0
@@ -122,6 +121,8 @@ def budget_analysis(models, blocks, num_sweeps, sample_sizes, data, K, CUDA, dev
     """
     compute the ess and log joint under same budget
     """
+    import pandas as pd
+
     result_flags = {'loss_required' : False, 'ess_required' : True, 'mode_required' : False, 'density_required': True}
 
     ess = []
@@ -160,6 +161,8 @@ def plot_budget_analyais_results(df, fs=8, fs_title=14, lw=3, fontsize=20, color
     """
     plot the results of budget analysis
     """
+    import matplotlib.pyplot as plt
+
     df_decomposed = df.loc[df['block'] == 'decomposed']
     df_joint = df.loc[df['block'] == 'joint']
     ticklabels = []
@@ -192,6 +195,9 @@ def plot_budget_analyais_results(df, fs=8, fs_title=14, lw=3, fontsize=20, color
 #                                               #
 #################################################  
 def plot_cov_ellipse(cov, pos, nstd=2, ax=None, **kwargs):
+    import matplotlib.pyplot as plt
+    from matplotlib.patches import Ellipse
+
     def eigsorted(cov):
         vals, vecs = np.linalg.eigh(cov)
         order = vals.argsort()[::-1]
@@ -227,6 +233,9 @@ def viz_samples(data, trace, num_sweeps, K, viz_interval=3, figure_size=3, title
     """
     visualize the samples along the sweeps
     """
+    import matplotlib.pyplot as plt
+    import matplotlib.gridspec as gridspec
+
     E_tau, E_mu, E_z = trace['E_tau'].cpu(), trace['E_mu'].cpu(), trace['E_z'].cpu()
     num_rows = len(data)
     num_cols = 2 + int((num_sweeps-1) / viz_interval)
@@ -0,0 +1,181 @@
+import os
+import resource
+import torch
+
+from contextlib import contextmanager
+from xvfm.unet import logger
+
+
+def peak_rss_mb():
+    """High-water mark of the process resident set size (Linux reports KB)."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _status_mb(field):
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+
+def current_rss_mb():
+    rss = _status_mb("VmRSS")
+    return peak_rss_mb() if rss is None else rss
+
+
+def rss_peak_mb():
+    """RSS high-water mark since the last reset_rss_peak() (the process lifetime peak if unsupported)."""
+    hwm = _status_mb("VmHWM")
+    return peak_rss_mb() if hwm is None else hwm
+
+
+def reset_rss_peak():
+    """Restart rss_peak_mb() from the current RSS. Linux does so when "5" is written to clear_refs."""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+def available_memory_mb(device):
+    if device.type == "cuda":
+        free, _ = torch.cuda.mem_get_info(device)
+        return free / 2**20
+    with open("/proc/meminfo") as f:
+        for line in f:
+            if line.startswith("MemAvailable:"):
+                return int(line.split()[1]) / 1024
+    raise RuntimeError("Cannot determine available host memory")
+
+
+def local_world_size():
+    """Processes of the distributed job on this host (1 outside distributed runs)."""
+    if not (torch.distributed.is_available() and torch.distributed.is_initialized()):
+        return 1
+    return int(os.environ.get("LOCAL_WORLD_SIZE", torch.distributed.get_world_size()))
+
+
+def reset_peak_memory(device):
+    if device.type == "cuda":
+        torch.cuda.reset_peak_memory_stats(device)
+
+
+def allocator_stats_mb(device):
+    """Current and peak tensor allocator usage. Only CUDA exposes allocator statistics."""
+    if device.type != "cuda":
+        return {}
+    return {
+        "allocated": torch.cuda.memory_allocated(device) / 2**20,
+        "peak_allocated": torch.cuda.max_memory_allocated(device) / 2**20,
+        "peak_reserved": torch.cuda.max_memory_reserved(device) / 2**20,
+    }
+
+
+def _is_oom(e):
+    return isinstance(e, torch.cuda.OutOfMemoryError) or "out of memory" in str(e).lower()
+
+
+def find_microbatch(step_fn, batch_size, device, budget_mb=None):
+    """Find the largest micro-batch whose training step fits in `budget_mb`.
+
+    Calls step_fn(n) for n = 1, 2, 4, ... up to `batch_size` and records the peak RSS and
+    allocator memory of each probe. Both peaks are reset before every probe, so earlier probes
+    and transient peaks (e.g. loading the data) do not hide a probe's own peak. The budget is
+    checked against peak allocated memory on CUDA and against peak RSS otherwise. The default
+    budget is 80% of the available memory, split evenly between the ranks on the host, on top
+    of the current RSS on CPU. Returns the chosen size and the per-probe records.
+    """
+    if budget_mb is None:
+        # Ranks on one host share its memory, or a GPU when there are more ranks than GPUs.
+        ranks = local_world_size()
+        if device.type == "cuda":
+            ranks = -(-ranks // torch.cuda.device_count())
+        budget_mb = 0.8 * available_memory_mb(device) / ranks
+        if device.type != "cuda":
+            budget_mb += current_rss_mb()
+
+    best, records, n = 1, [], 1
+    while True:
+        n = min(n, batch_size)
+        reset_peak_memory(device)
+        reset_rss_peak()
+        try:
+            step_fn(n)
+            fits = True
+        except RuntimeError as e:
+            if not _is_oom(e):
+                raise
+            fits = False
+        record = {"microbatch": n, "peak_rss": rss_peak_mb(), **allocator_stats_mb(device)}
+        peak = record.get("peak_allocated", record["peak_rss"])
+        fits = fits and peak <= budget_mb
+        record["fits"] = fits
+        records.append(record)
+        if device.type == "cuda":
+            torch.cuda.empty_cache()
+        if not fits:
+            break
+        best = n
+        if n == batch_size:
+            break
+        n *= 2
+    return best, records
+
+
+_traced = []
+
+
+def _read_peaks():
+    peaks = {"rss": rss_peak_mb()}
+    if torch.cuda.is_available() and torch.cuda.is_initialized():
+        peaks["cuda"] = torch.cuda.max_memory_allocated() / 2**20
+    return peaks
+
+
+def _reset_peaks():
+    reset_rss_peak()
+    if torch.cuda.is_available() and torch.cuda.is_initialized():
+        torch.cuda.reset_peak_memory_stats()
+
+
+def _fold(scope, peaks):
+    for k, v in peaks.items():
+        scope["peaks"][k] = max(scope["peaks"].get(k, 0), v)
+
+
+@contextmanager
+def trace_memory(name):
+    """Log the peak RSS, and on CUDA the peak allocated memory, of a block, along with how much
+    memory it left allocated, as logger keys mem_peak_<rss|cuda>/<name> and mem_delta_<...>/<name>.
+
+    Peaks are reset on entering a block, so nested blocks report their own peaks and enclosing
+    blocks fold theirs in. Each key keeps the maximum over the logging window. When only some
+    ranks run a block, the others must log its keys too (see profiling.phase_keys), or the
+    distributed logger falls back to gathering every rank's keys.
+    """
+    if _traced:
+        _fold(_traced[-1], _read_peaks())
+    _reset_peaks()
+    cuda = torch.cuda.is_available() and torch.cuda.is_initialized()
+    scope = {"peaks": {}, "rss": current_rss_mb(), "cuda": torch.cuda.memory_allocated() / 2**20 if cuda else None}
+    _traced.append(scope)
+    try:
+        yield
+    finally:
+        _traced.pop()
+        _fold(scope, _read_peaks())
+        if _traced:
+            _fold(_traced[-1], scope["peaks"])
+
+        kvs = logger.getkvs()
+        values = {f"mem_peak_{k}/{name}": v for k, v in scope["peaks"].items()}
+        values[f"mem_delta_rss/{name}"] = current_rss_mb() - scope["rss"]
+        if scope["cuda"] is not None:
+            values[f"mem_delta_cuda/{name}"] = torch.cuda.memory_allocated() / 2**20 - scope["cuda"]
+        for key, value in values.items():
+            logger.logkv(key, max(kvs.get(key, value), value))
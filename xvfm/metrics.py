@@ -0,0 +1,46 @@
+import torch
+
+
+class MetricAccumulator:
+    """Running means of training metrics that stay on the device between log boundaries.
+
+    update() only issues asynchronous device ops on detached tensors, so it never waits on the
+    device; compute() copies every sum to the host in one transfer.
+    """
+
+    def __init__(self):
+        self.sums = {}
+        self.counts = {}
+
+    @torch.no_grad()
+    def update(self, n=1, **metrics):
+        """Add metrics that are each a mean over `n` samples."""
+        for name, value in metrics.items():
+            value = value.detach().float() if torch.is_tensor(value) else torch.tensor(float(value))
+            if name in self.sums:
+                self.sums[name].add_(value.to(self.sums[name].device), alpha=n)
+            else:
+                self.sums[name] = value * n
+            self.counts[name] = self.counts.get(name, 0) + n
+
+    def compute(self):
+        if not self.sums:
+            return {}
+        names = list(self.sums)
+        sums = torch.stack([self.sums[k].reshape(()).to(self.sums[names[0]].device) for k in names]).cpu()
+        return {k: s.item() / self.counts[k] for k, s in zip(names, sums)}
+
+    def reset(self):
+        self.sums.clear()
+        self.counts.clear()
+
+
+def sliced_wasserstein(x, y, num_projections=256, generator=None):
+    """Sliced 2-Wasserstein distance between two equally sized sample sets [N, D]: the root mean
+    square over random directions of the 1D Wasserstein-2 distance of the projections."""
+    x, y = x.flatten(1).float(), y.flatten(1).float().to(x.device)
+    directions = torch.randn(x.shape[1], num_projections, generator=generator).to(x.device)
+    directions = directions / directions.norm(dim=0, keepdim=True)
+    x_proj = (x @ directions).sort(dim=0).values
+    y_proj = (y @ directions).sort(dim=0).values
+    return ((x_proj - y_proj) ** 2).mean().sqrt().item()
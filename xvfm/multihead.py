@@ -0,0 +1,59 @@
+import copy
+import torch
+
+from xvfm.flow import VFM
+from xvfm.variational import GaussianVariationalDist
+
+
+# Variant name (as in main.get_directories) -> (criterion, learned sigma structure or None)
+VARIANTS = {
+    "MSE": ("MSE", None),
+    "Gaussian_fixed": ("Gaussian", None),
+    "Gaussian_learned_scalar": ("Gaussian", "scalar"),
+    "Gaussian_learned_vector": ("Gaussian", "vector"),
+    "Gaussian_learned_matrix": ("Gaussian", "matrix"),
+}
+
+
+class MultiHeadVFM(torch.nn.Module):
+    """Several VFM variants trained on one shared mean network.
+
+    Each variant pairs a criterion with its own sigma head (None for the fixed schedule). A
+    step samples t and x_t once and runs the mean network once, then every variant builds
+    its posterior from that mean and evaluates its criterion; the mean network is trained on
+    the sum of the variant losses. With separate_means=True each variant keeps its own copy
+    of the mean network instead, which reproduces independent runs while still sharing data
+    loading and sampling. Every variant is a regular VFM in `self.variants`.
+    """
+
+    def __init__(self, prior, mean_model, interpolator, heads, separate_means=False):
+        """`heads` maps a variant name to (criterion, sigma_model or None)."""
+        super().__init__()
+        self.separate_means = separate_means
+        self.criteria = {name: criterion for name, (criterion, _) in heads.items()}
+        self.variants = torch.nn.ModuleDict({
+            name: VFM(
+                prior=prior,
+                variational_dist=GaussianVariationalDist(
+                    copy.deepcopy(mean_model) if separate_means else mean_model, sigma_model
+                ),
+                interpolator=interpolator,
+            )
+            for name, (_, sigma_model) in heads.items()
+        })
+
+    def losses(self, x_1):
+        """Loss of every variant on one batch, as a dict of scalar tensors."""
+        variants = list(self.variants.items())
+        t, x_t = variants[0][1].sample_t_and_x_t(x_1)
+        x_1 = x_1.view(x_1.shape[0], -1)
+
+        if not self.separate_means:
+            mu = variants[0][1].variational_dist.mean(x_t, t)
+        losses = {}
+        for name, variant in variants:
+            dist = variant.variational_dist
+            if self.separate_means:
+                mu = dist.mean(x_t, t)
+            losses[name] = self.criteria[name](dist.posterior(mu, t), x_1)
+        return losses
@@ -35,12 +35,7 @@ class MultiGaussianPrior(StandardGaussianPrior):
         centers = torch.tensor(centers) * scale
         noise = self.dist.sample((num_samples,))
         multi = torch.multinomial(torch.ones(8), num_samples, replacement=True)
-        
-        data = []
-        for i in range(num_samples):
-            data.append(centers[multi[i]] + noise[i])
-
-        data = torch.stack(data)
+        data = centers[multi] + noise
 
         return data.float()
     
@@ -0,0 +1,116 @@
+import os
+import torch
+
+from contextlib import contextmanager, nullcontext
+from xvfm.memory import trace_memory
+from xvfm.unet import logger
+
+_enabled = False
+_memory = False
+_scopes = []
+
+
+def enable_phases(enabled=True, memory=False):
+    """Time phases when `enabled`; trace their memory (see trace_memory) when `memory`."""
+    global _enabled, _memory
+    _enabled = enabled
+    _memory = memory
+
+
+@contextmanager
+def _nested_phase(name):
+    _scopes.append(name)
+    key = "/".join(_scopes)
+    try:
+        with logger.profile_kv(key) if _enabled else nullcontext(), trace_memory(key) if _memory else nullcontext():
+            yield
+    finally:
+        _scopes.pop()
+
+
+def phase(name):
+    """Accumulate the wall time of a block into logger key `wait_<outer>/<name>`, and with
+    memory tracing its peak memory into `mem_*/<outer>/<name>`.
+
+    A no-op unless enabled, and inside code traced by torch.compile.
+    """
+    if not (_enabled or _memory) or torch.compiler.is_compiling():
+        return nullcontext()
+    return _nested_phase(name)
+
+
+def _key_phase(key):
+    if key.startswith("wait_"):
+        return key[len("wait_"):]
+    if key.startswith("mem_") and "/" in key:
+        return key.split("/", 1)[1]
+    return None
+
+
+def phase_keys(name):
+    """Logger keys written so far by outermost phase `name` and the phases nested in it."""
+    keys = []
+    for key in logger.getkvs():
+        scope = _key_phase(key)
+        if scope is not None and (scope == name or scope.startswith(name + "/")):
+            keys.append(key)
+    return keys
+
+
+def timed(iterable, name):
+    """Iterate while timing each fetch as phase `name`."""
+    iterator = iter(iterable)
+    while True:
+        with phase(name):
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+        yield item
+
+
+class ProfilerWindow:
+    """Run torch.profiler over steps [start, end) and export a Chrome trace to `path`.
+
+    With memory_report > 0 allocations are profiled too, and the call stacks that allocate the
+    most are written next to the trace.
+    """
+
+    def __init__(self, start, end, path, memory_report=0):
+        self.start = start
+        self.end = end
+        self.path = path
+        self.memory_report = memory_report
+        self.profiler = None
+
+    def step(self, step):
+        if step == self.start and self.profiler is None:
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if torch.cuda.is_available():
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            kwargs = {}
+            if self.memory_report:
+                # Python call stacks are only attached to events in verbose mode.
+                kwargs = dict(profile_memory=True, experimental_config=torch._C._profiler._ExperimentalConfig(verbose=True))
+            self.profiler = torch.profiler.profile(activities=activities, record_shapes=True, with_stack=True, **kwargs)
+            self.profiler.start()
+        elif step == self.end:
+            self.close()
+
+    def close(self):
+        if self.profiler is None:
+            return
+        self.profiler.stop()
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        self.profiler.export_chrome_trace(self.path)
+        logger.log(f"Wrote profiler trace to {self.path}")
+        if self.memory_report:
+            self.write_memory_report(os.path.splitext(self.path)[0] + "_memory.txt")
+        self.profiler = None
+
+    def write_memory_report(self, path):
+        averages = self.profiler.key_averages(group_by_stack_n=self.memory_report)
+        sort_by = "self_cuda_memory_usage" if torch.cuda.is_available() else "self_cpu_memory_usage"
+        with open(path, "w") as f:
+            f.write(averages.table(sort_by=sort_by, row_limit=20, max_src_column_width=100))
+        logger.log(f"Wrote allocation report to {path}")
@@ -0,0 +1,115 @@
+"""Experimental int8 copies of a VFM's mean network for sampling on CPU.
+
+    python -m xvfm.quantize checkpoints/Gaussian_learned_scalar.pt --num_samples 1024 --steps 100
+
+Linear layers (the two_moons MLP, the UNet's time embedding) are quantised dynamically: int8
+weights, with activation scales computed per call. Convolutions are quantised statically:
+every Conv1d/Conv2d is wrapped between a quantise and a dequantise step, and its activation
+ranges are calibrated by integrating a batch of prior samples over the solver's time grid, so
+the observers see the inputs of every time step. The remaining UNet layers (normalisation,
+attention softmax, the time embedding) stay in float32.
+
+The command line compares the int8 copy with the float32 model: sampling throughput and the
+drift between their samples from the same prior draws. So far the int8 copy has been slower
+than float32 (0.66x) and its samples drift by about 4%, so sampling does not use it; it is
+kept here for further experiments.
+"""
+import argparse
+import copy
+import time
+import warnings
+import torch
+
+from torch.ao.quantization import DeQuantStub, QuantStub, convert, get_default_qconfig, prepare, quantize_dynamic
+
+
+class QuantizedConv(torch.nn.Module):
+    """A convolution that runs in int8 between float32 layers."""
+
+    def __init__(self, conv):
+        super().__init__()
+        self.quant = QuantStub()
+        self.conv = conv
+        self.dequant = DeQuantStub()
+
+    def forward(self, x):
+        return self.dequant(self.conv(self.quant(x)))
+
+
+def _wrap_convs(module, qconfig):
+    for name, child in module.named_children():
+        if isinstance(child, (torch.nn.Conv1d, torch.nn.Conv2d)):
+            wrapped = QuantizedConv(child)
+            wrapped.qconfig = qconfig
+            setattr(module, name, wrapped)
+        else:
+            _wrap_convs(child, qconfig)
+
+
+def quantize_vfm(model, calibration_samples=64, steps=100, method='euler', time_grid='uniform'):
+    """An int8 copy of `model` for CPU inference; `model` itself is left unchanged.
+
+    The copy is a snapshot of the current weights: it does not follow later updates to `model`,
+    so quantise again after training or loading new weights. Convolutions are calibrated on `calibration_samples` trajectories of `steps` steps with the
+    given solver settings, which should match the ones used for sampling.
+    """
+    model = copy.deepcopy(model).cpu().eval()
+    dist = model.variational_dist
+    with warnings.catch_warnings():
+        # torch.ao.quantization is deprecated in favour of torchao, which is not a dependency.
+        warnings.simplefilter("ignore")
+        mu_model = dist.posterior_mu_model
+        if any(isinstance(m, (torch.nn.Conv1d, torch.nn.Conv2d)) for m in mu_model.modules()):
+            _wrap_convs(mu_model, get_default_qconfig(torch.backends.quantized.engine))
+            prepare(mu_model, inplace=True)
+            with torch.no_grad():
+                model.generate(
+                    num_samples=calibration_samples, steps=steps, device=torch.device("cpu"),
+                    method=method, time_grid=time_grid,
+                )
+            convert(mu_model, inplace=True)
+        dist.posterior_mu_model = quantize_dynamic(mu_model, {torch.nn.Linear}, dtype=torch.qint8)
+    return model
+
+
+def main():
+    from xvfm.metrics import sliced_wasserstein
+    from xvfm.runtime import load_vfm
+
+    parser = argparse.ArgumentParser(description='Compare int8 and float32 sampling of a trained VFM')
+    parser.add_argument('checkpoint', type=str, help="Checkpoint, state dict or checkpoint directory of a trained VFM")
+    parser.add_argument('--num_samples', default=1024, type=int, help="Samples drawn by each model")
+    parser.add_argument('--steps', default=100, type=int, help="Number of Euler integration steps")
+    parser.add_argument('--calibration_samples', default=64, type=int, help="Trajectories used to calibrate the convolutions")
+    parser.add_argument('--repeats', default=3, type=int, help="Timed generate calls per model; the fastest is reported")
+    parser.add_argument('--seed', default=0, type=int, help="Seed of the prior samples shared by both models")
+    args = parser.parse_args()
+
+    model = load_vfm(args.checkpoint)
+    start = time.perf_counter()
+    int8_model = quantize_vfm(model, args.calibration_samples, args.steps)
+    print(f"Quantised in {time.perf_counter() - start:.2f}s")
+
+    results = {}
+    for name, m in (("float32", model), ("int8", int8_model)):
+        seconds = []
+        for _ in range(args.repeats):
+            torch.manual_seed(args.seed)
+            start = time.perf_counter()
+            with torch.inference_mode():
+                samples = m.generate(num_samples=args.num_samples, steps=args.steps, device=torch.device("cpu"))[-2]
+            seconds.append(time.perf_counter() - start)
+        results[name] = (samples.flatten(1), min(seconds))
+        print(f"{name:8s} {min(seconds):8.3f}s {args.num_samples * (args.steps - 1) / min(seconds):12.1f} sample-steps/s")
+
+    reference, fp32_seconds = results["float32"]
+    samples, int8_seconds = results["int8"]
+    drift = (samples - reference).norm(dim=1)
+    print(f"Speed-up {fp32_seconds / int8_seconds:.2f}x")
+    print(f"Drift from float32 samples: mean L2 {drift.mean():.4f}, max L2 {drift.max():.4f}, "
+          f"relative {drift.mean() / reference.norm(dim=1).mean():.4f}, "
+          f"sliced Wasserstein {sliced_wasserstein(samples, reference, generator=torch.Generator().manual_seed(0)):.4f}")
+
+
+if __name__ == "__main__":
+    main()
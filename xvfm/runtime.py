@@ -0,0 +1,126 @@
+"""Load a trained VFM and sample from it with nothing heavier than torch imported.
+
+    python -m xvfm.runtime checkpoints/Gaussian_learned_scalar.pt --num_samples 1024 --out samples.pt
+
+Accepts the periodic checkpoints written by main.py, the plain state dicts written with
+--save_model and checkpoint directories from xvfm.checkpoint, whose weights are memory-mapped
+rather than read. The architecture is read off the state dict; the interpolator sigma comes
+from the checkpoint's arguments when present and from --sigma otherwise.
+"""
+import argparse
+import os
+import time
+import torch
+
+from xvfm.flow import TIME_GRIDS, VFM
+from xvfm.models import MLP
+from xvfm.prior import StandardGaussianPrior, MultiGaussianPrior
+from xvfm.variational import GaussianVariationalDist
+from xvfm.interpolator import OTInterpolator
+from xvfm.checkpoint import load_checkpoint
+from xvfm.autotune import DEFAULT_PROFILE, load_settings, model_key, set_threads
+
+MU_PREFIX = "variational_dist.posterior_mu_model."
+SIGMA_PREFIX = "variational_dist.posterior_logsigma_model."
+
+
+def build_vfm(state_dict, sigma=0.1, assign=False):
+    """Construct the VFM whose parameters are in `state_dict` and load them.
+
+    With `assign` the model takes the tensors of the state dict as its parameters instead of
+    copying them, which keeps memory-mapped weights mapped.
+    """
+    if MU_PREFIX + "net.0.weight" in state_dict:
+        dim = state_dict[MU_PREFIX + "net.0.weight"].shape[1] - 1
+        mu_model = MLP(dim=dim)
+        prior = MultiGaussianPrior(dim)
+    else:
+        from xvfm.unet import UNetModel
+
+        mu_model = UNetModel(dim=(1, 28, 28), num_channels=32, num_res_blocks=1, num_classes=10)
+        prior = StandardGaussianPrior(28**2)
+
+    sigma_model = None
+    if SIGMA_PREFIX + "net.6.weight" in state_dict:
+        sigma_model = MLP(dim=0, out_dim=state_dict[SIGMA_PREFIX + "net.6.weight"].shape[0])
+
+    model = VFM(
+        prior=prior,
+        variational_dist=GaussianVariationalDist(mu_model, sigma_model),
+        interpolator=OTInterpolator(sigma_min=sigma),
+    )
+    model.load_state_dict(state_dict, assign=assign)
+    return model.eval()
+
+
+def load_vfm(path, device="cpu", sigma=None):
+    if os.path.isdir(path):
+        # Reduced precision exports are computed in float32; casting materialises the weights.
+        checkpoint = load_checkpoint(path)
+        state_dict = {
+            k: v.float() if v.is_floating_point() and v.dtype != torch.float32 else v
+            for k, v in checkpoint["model"].items()
+        }
+    else:
+        checkpoint = torch.load(path, map_location=device)
+        state_dict = checkpoint.get("model", checkpoint)
+    if sigma is None:
+        sigma = (checkpoint.get("args") or {}).get("sigma", 0.1)
+    return build_vfm(state_dict, sigma, assign=True).to(device)
+
+
+def profile_key(model):
+    """Autotune profile key of a model built by build_vfm."""
+    dist = model.variational_dist
+    if isinstance(dist.posterior_mu_model, MLP):
+        dataset, dim = "two_moons", dist.posterior_mu_model.net[0].in_features - 1
+    else:
+        dataset, dim = "mnist", 28**2
+    if not hasattr(dist, "posterior_logsigma_model"):
+        return model_key(dataset, learn_sigma=False)
+    out_dim = dist.posterior_logsigma_model.net[-1].out_features
+    return model_key(dataset, True, {1: "scalar", dim: "vector", dim**2: "matrix"}[out_dim])
+
+
+@torch.inference_mode()
+def sample(model, num_samples, steps=100, device="cpu", batch_size=None, time_grid='uniform'):
+    """Final Euler samples of FlowModel.generate, drawn `batch_size` at a time."""
+    batch_size = batch_size or num_samples
+    return torch.cat([
+        model.generate(num_samples=min(batch_size, num_samples - i), steps=steps, device=torch.device(device), method='euler', time_grid=time_grid)[-2]
+        for i in range(0, num_samples, batch_size)
+    ])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Sample from a trained VFM')
+    parser.add_argument('checkpoint', type=str, help="Checkpoint or state dict written by main.py")
+    parser.add_argument('--num_samples', default=1024, type=int, help="Number of samples to draw")
+    parser.add_argument('--steps', default=100, type=int, help="Number of Euler integration steps")
+    parser.add_argument('--time_grid', default='uniform', choices=list(TIME_GRIDS), help="Time grid of the Euler steps")
+    parser.add_argument('--sigma', default=None, type=float, help="Interpolator sigma if the checkpoint does not record it")
+    parser.add_argument('--device', default='cpu', type=str, help="Device to sample on")
+    parser.add_argument('--seed', default=None, type=int, help="Random seed for the prior samples")
+    parser.add_argument('--out', default='samples.pt', type=str, help="File to save the samples to")
+    parser.add_argument('--batch_size', default=None, type=int, help="Samples integrated at once (default: from the autotune profile, else all)")
+    parser.add_argument('--velocity_graph', default=None, choices=['script', 'export'], help="Integrate with ahead-of-time graphs of the velocity field (see xvfm.compiled.CompiledVelocity)")
+    parser.add_argument('--autotune_profile', default=DEFAULT_PROFILE, type=str, help="Profile written by python -m xvfm.autotune")
+    args = parser.parse_args()
+
+    if args.seed is not None:
+        torch.manual_seed(args.seed)
+    start = time.perf_counter()
+    model = load_vfm(args.checkpoint, args.device, args.sigma)
+    tuned = load_settings("sample", profile_key(model), args.autotune_profile)
+    set_threads(tuned.get("num_threads"), tuned.get("num_interop_threads"))
+    if tuned.get("channels_last") and not isinstance(model.variational_dist.posterior_mu_model, MLP):
+        model.to(memory_format=torch.channels_last)
+    if args.velocity_graph:
+        model.compile_velocity(args.velocity_graph)
+    samples = sample(model, args.num_samples, args.steps, args.device, args.batch_size or tuned.get("batch_size"), args.time_grid)
+    torch.save(samples.cpu(), args.out)
+    print(f"Saved {tuple(samples.shape)} samples to {args.out} in {time.perf_counter() - start:.2f}s")
+
+
+if __name__ == "__main__":
+    main()
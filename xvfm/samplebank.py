@@ -0,0 +1,94 @@
+"""On-disk cache of generated samples, addressed by model content and sampler settings.
+
+    bank = SampleBank("results/sample_bank", max_mb=2048)
+    key = bank.key(model_digest(model), method="euler", steps=100, time_grid="uniform", seed=0, num_samples=1024)
+    trajectory = bank.get_or_generate(key, lambda: model.generate(...))
+
+The key hashes the model weights (model_digest) together with the sampler settings, so a
+retrained or edited checkpoint never hits a stale entry, and copies of one checkpoint share
+entries. Entries are tensor files in the xvfm.checkpoint layout and are read memory-mapped.
+Reads refresh an entry's modification time; once the bank exceeds max_mb, the entries used
+least recently are deleted.
+"""
+import hashlib
+import json
+import os
+import torch
+
+from xvfm.checkpoint import TensorFile, save_tensors
+
+# Part of every key; bump it when the samplers change, so older entries are no longer used.
+SAMPLER_VERSION = 2
+
+
+def model_digest(model):
+    """Hash of a model's state dict: names, dtypes, shapes and values."""
+    h = hashlib.sha1()
+    for name, tensor in sorted(model.state_dict().items()):
+        tensor = tensor.detach().cpu().contiguous()
+        h.update(f"{name}:{tensor.dtype}:{tuple(tensor.shape)}".encode())
+        if tensor.numel() > 0:
+            h.update(tensor.reshape(-1).view(torch.uint8).numpy().data)
+    return h.hexdigest()
+
+
+class SampleBank:
+    def __init__(self, root, max_mb=2048):
+        self.root = root
+        self.max_bytes = max_mb * 2**20
+        os.makedirs(root, exist_ok=True)
+
+    @staticmethod
+    def key(digest, **settings):
+        """Entry name for samples of the model with `digest`, drawn with `settings` (method,
+        steps, time grid, seed, number of samples, ...)."""
+        return hashlib.sha1(json.dumps([digest, SAMPLER_VERSION, settings], sort_keys=True).encode()).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.root, key + ".safetensors")
+
+    def get(self, key, name="samples"):
+        """The cached tensor as a copy-on-write view of the memory-mapped entry, or None."""
+        path = self.path(key)
+        try:
+            tensors = TensorFile(path)
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return tensors[name]
+
+    def put(self, key, tensor, name="samples", **metadata):
+        save_tensors(self.path(key), {name: tensor}, metadata)
+        self.evict()
+
+    def get_or_generate(self, key, generate, name="samples"):
+        tensor = self.get(key, name)
+        if tensor is None:
+            tensor = generate()
+            self.put(key, tensor, name)
+        return tensor
+
+    def entries(self):
+        """(path, size, last use) of every entry, least recently used first."""
+        entries = []
+        for filename in os.listdir(self.root):
+            if filename.endswith(".safetensors"):
+                path = os.path.join(self.root, filename)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((path, stat.st_size, stat.st_mtime))
+        return sorted(entries, key=lambda e: e[2])
+
+    def evict(self):
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        for path, size, _ in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
@@ -0,0 +1,341 @@
+"""A local sampling service that merges concurrent requests into shared ODE solves.
+
+    python -m xvfm.serving checkpoints/Gaussian_learned_scalar.pt --port 8100 --max_batch 1024 --max_wait_ms 5
+    curl -N -d '{"num_samples": 256, "steps": 50, "seed": 0}' http://127.0.0.1:8100/sample
+
+Requests are integrated with the Euler scheme of FlowModel.generate, but all requests in flight
+share one batch: every solver step is a single velocity evaluation over the rows of all of
+them, each row at its own time and step size. Rows leave the batch once their request's step
+count is reached and queued rows take their place at the next step (continuous batching), so a
+short request is not held up by a long one. When the service is idle, the first request waits
+up to --max_wait_ms for others to join it, or until --max_batch rows are queued. Requests with
+more rows than are free join in parts; every part is streamed back as soon as it is done, as a
+JSON line {"offset", "samples"}, and a final {"done": true, ...} line carries the request's
+timings. A request with a seed returns, up to rounding, the samples of generate(...)[-2] after
+torch.manual_seed(seed).
+
+Requests for more than --max_request_samples samples are rejected, since their prior samples
+are drawn up front.
+
+GET /metrics serves the xvfm.exporter metrics, including histograms of the request latency,
+the time spent queued and the time to the first streamed samples.
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import time
+import torch
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from xvfm import exporter
+from xvfm.flow import TIME_GRIDS
+
+
+class SampleRequest:
+    """A request in the service; iterate over it (async for) to receive its (offset, samples) parts."""
+
+    def __init__(self, num_samples, steps, seed=None, time_grid="uniform"):
+        self.num_samples = num_samples
+        self.steps = steps
+        self.seed = seed
+        self.time_grid = time_grid
+        self.arrival = time.perf_counter()
+        self.queue_seconds = None
+        self.first_chunk_seconds = None
+        self.latency = None
+        self.x_0 = None
+        self.admitted_rows = 0
+        self.returned_rows = 0
+        self.cancelled = False
+        self.parts = asyncio.Queue()
+
+    def cancel(self):
+        """Drop the request's rows from the batch, e.g. after the client went away."""
+        self.cancelled = True
+
+    async def __aiter__(self):
+        received = 0
+        while received < self.num_samples:
+            part = await self.parts.get()
+            if isinstance(part, Exception):
+                raise part
+            received += len(part[1])
+            yield part
+
+
+class _Rows:
+    """Consecutive rows of one request that joined the batch together, and so share a time."""
+
+    def __init__(self, request, offset, x, time_steps, delta_t):
+        self.request = request
+        self.offset = offset
+        self.x = x
+        self.time_steps = time_steps
+        self.delta_t = delta_t
+        self.k = 0
+
+    @property
+    def done(self):
+        return self.k == len(self.time_steps) - 1
+
+
+class SamplingService:
+    def __init__(self, model, device="cpu", max_batch=1024, max_wait_ms=5.0):
+        self.model = model
+        self.device = torch.device(device)
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000
+        self.velocity_field = model.__dict__.get("_compiled_velocity") or model.velocity_field
+        self.waiting = deque()
+        self.active = []
+        self.arrived = asyncio.Event()
+        self.time_grids = {}
+        # One thread runs every model call, so the batch and the RNG are never used concurrently.
+        self.executor = ThreadPoolExecutor(1, thread_name_prefix="sampler")
+
+    def prior_samples(self, num_samples, seed):
+        with torch.random.fork_rng(devices=[]) if seed is not None else contextlib.nullcontext():
+            if seed is not None:
+                torch.manual_seed(seed)
+            x_0 = self.model.prior.sample(num_samples)
+        if x_0.shape[1] > 2:
+            x_0 = x_0.view(-1, 1, 28, 28)
+        return x_0.to(self.device)
+
+    def time_grid(self, steps, time_grid):
+        """Times and step sizes of generate's Euler loop for `steps` steps over `time_grid`."""
+        key = (steps, time_grid)
+        if key not in self.time_grids:
+            time_steps = TIME_GRIDS[time_grid](torch.linspace(0, 1, steps, device=self.device))
+            self.time_grids[key] = (time_steps, time_steps.diff())
+        return self.time_grids[key]
+
+    async def submit(self, num_samples, steps=100, seed=None, time_grid="uniform"):
+        request = SampleRequest(num_samples, steps, seed, time_grid)
+        loop = asyncio.get_running_loop()
+        request.x_0 = await loop.run_in_executor(self.executor, self.prior_samples, num_samples, seed)
+        self.waiting.append(request)
+        self.arrived.set()
+        return request
+
+    def queued_rows(self):
+        return sum(r.num_samples - r.admitted_rows for r in self.waiting if not r.cancelled)
+
+    def admit(self):
+        free = self.max_batch - sum(len(rows.x) for rows in self.active)
+        now = time.perf_counter()
+        while self.waiting and free > 0:
+            request = self.waiting[0]
+            if request.cancelled:
+                self.waiting.popleft()
+                continue
+            n = min(free, request.num_samples - request.admitted_rows)
+            if request.queue_seconds is None:
+                request.queue_seconds = now - request.arrival
+                exporter.sampling_queue_seconds.observe(request.queue_seconds)
+            x = request.x_0[request.admitted_rows:request.admitted_rows + n]
+            self.active.append(_Rows(request, request.admitted_rows, x, *self.time_grid(request.steps, request.time_grid)))
+            request.admitted_rows += n
+            free -= n
+            if request.admitted_rows == request.num_samples:
+                self.waiting.popleft()
+                request.x_0 = None
+
+    @torch.inference_mode()
+    def step(self, batch):
+        """One Euler step of every row in the batch, each at its own time."""
+        x = torch.cat([rows.x for rows in batch])
+        sizes = [len(rows.x) for rows in batch]
+        t = torch.cat([rows.time_steps[rows.k].expand(n, 1) for rows, n in zip(batch, sizes)])
+        delta_t = torch.cat([rows.delta_t[rows.k].expand(n) for rows, n in zip(batch, sizes)])
+        x = x + self.velocity_field(x, t) * delta_t.view(-1, *([1] * (x.dim() - 1)))
+        for rows, x_rows in zip(batch, x.split(sizes)):
+            rows.x = x_rows
+            rows.k += 1
+
+    def retire(self):
+        """Stream back the rows that reached their final time and remove them from the batch."""
+        now = time.perf_counter()
+        active = []
+        for rows in self.active:
+            if not rows.done:
+                active.append(rows)
+                continue
+            request = rows.request
+            request.parts.put_nowait((rows.offset, rows.x.cpu()))
+            request.returned_rows += len(rows.x)
+            if request.first_chunk_seconds is None:
+                request.first_chunk_seconds = now - request.arrival
+                exporter.sampling_first_chunk_seconds.observe(request.first_chunk_seconds)
+            if request.returned_rows == request.num_samples:
+                request.latency = now - request.arrival
+                exporter.sampling_request_seconds.observe(request.latency)
+                exporter.sampling_requests.inc()
+                exporter.generated_samples.inc(request.num_samples)
+        self.active = active
+
+    async def run(self):
+        """The scheduler: admits queued rows, steps the batch and retires finished rows, forever."""
+        loop = asyncio.get_running_loop()
+        while True:
+            self.active = [rows for rows in self.active if not rows.request.cancelled]
+            if not self.active:
+                while not self.queued_rows():
+                    self.waiting.clear()
+                    self.arrived.clear()
+                    await self.arrived.wait()
+                # Idle: give concurrent requests a moment to arrive and share the first steps.
+                deadline = self.waiting[0].arrival + self.max_wait
+                while self.queued_rows() < self.max_batch and time.perf_counter() < deadline:
+                    self.arrived.clear()
+                    with contextlib.suppress(asyncio.TimeoutError):
+                        await asyncio.wait_for(self.arrived.wait(), deadline - time.perf_counter())
+            self.admit()
+            rows = sum(len(r.x) for r in self.active)
+            exporter.sampling_active_rows.set(rows)
+            exporter.sampling_queued_rows.set(self.queued_rows())
+            exporter.sampling_batch_rows.observe(rows)
+            try:
+                await loop.run_in_executor(self.executor, self.step, self.active)
+            except Exception as e:
+                for request in {id(r.request): r.request for r in self.active}.values():
+                    request.parts.put_nowait(e)
+                    request.cancel()
+                continue
+            self.retire()
+
+
+def parse_request(body, default_steps, max_samples=None):
+    params = json.loads(body or b"{}")
+    num_samples = int(params.get("num_samples", 1))
+    steps = int(params.get("steps", default_steps))
+    seed = params.get("seed")
+    time_grid = params.get("time_grid", "uniform")
+    if num_samples < 1:
+        raise ValueError("num_samples must be positive")
+    if max_samples is not None and num_samples > max_samples:
+        raise ValueError(f"num_samples must be at most {max_samples}")
+    if steps < 2:
+        raise ValueError("steps must be at least 2")
+    if time_grid not in TIME_GRIDS:
+        raise ValueError(f"time_grid must be one of {', '.join(TIME_GRIDS)}")
+    return {"num_samples": num_samples, "steps": steps, "seed": None if seed is None else int(seed), "time_grid": time_grid}
+
+
+async def _respond(writer, status, reason, body, content_type="text/plain; charset=utf-8"):
+    writer.write(
+        f"HTTP/1.1 {status} {reason}\r\nContent-Type: {content_type}\r\n"
+        f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body
+    )
+    await writer.drain()
+
+
+def _chunk(message):
+    data = (json.dumps(message) + "\n").encode()
+    return f"{len(data):x}\r\n".encode() + data + b"\r\n"
+
+
+async def handle(service, reader, writer, default_steps, max_samples=None):
+    request = None
+    try:
+        method, path, _ = (await reader.readline()).decode().split(" ", 2)
+        headers = {}
+        while (line := await reader.readline()) not in (b"\r\n", b"\n", b""):
+            name, _, value = line.decode().partition(":")
+            headers[name.strip().lower()] = value.strip()
+        body = await reader.readexactly(int(headers.get("content-length", 0)))
+        path = path.split("?")[0]
+
+        if method == "GET" and path in ("/", "/metrics"):
+            await _respond(writer, 200, "OK", exporter.render().encode(), "text/plain; version=0.0.4; charset=utf-8")
+            return
+        if method != "POST" or path != "/sample":
+            await _respond(writer, 404, "Not Found", b"POST /sample or GET /metrics\n")
+            return
+        try:
+            params = parse_request(body, default_steps, max_samples)
+        except (ValueError, TypeError, AttributeError) as e:
+            await _respond(writer, 400, "Bad Request", f"{e}\n".encode())
+            return
+
+        request = await service.submit(**params)
+        writer.write(
+            b"HTTP/1.1 200 OK\r\nContent-Type: application/x-ndjson\r\n"
+            b"Transfer-Encoding: chunked\r\nConnection: close\r\n\r\n"
+        )
+        try:
+            async for offset, samples in request:
+                writer.write(_chunk({"offset": offset, "samples": samples.tolist()}))
+                await writer.drain()
+        except ConnectionError:
+            raise
+        except Exception as e:
+            writer.write(_chunk({"done": True, "error": repr(e)}) + b"0\r\n\r\n")
+            await writer.drain()
+            return
+        writer.write(_chunk({
+            "done": True, "num_samples": request.num_samples, "steps": request.steps,
+            "latency_seconds": request.latency, "queue_seconds": request.queue_seconds,
+            "first_chunk_seconds": request.first_chunk_seconds,
+        }) + b"0\r\n\r\n")
+        await writer.drain()
+    except (ConnectionError, ValueError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        # Also reached when the handler task is cancelled, e.g. on shutdown.
+        if request is not None and request.returned_rows < request.num_samples:
+            request.cancel()
+        writer.close()
+
+
+def stream_samples(url, num_samples, steps=100, seed=None, time_grid="uniform"):
+    """Yield the (offset, samples) parts of a request to a running service as they arrive."""
+    import urllib.request
+
+    body = json.dumps({"num_samples": num_samples, "steps": steps, "seed": seed, "time_grid": time_grid}).encode()
+    with urllib.request.urlopen(urllib.request.Request(url.rstrip("/") + "/sample", body)) as response:
+        for line in response:
+            message = json.loads(line)
+            if "error" in message:
+                raise RuntimeError(message["error"])
+            if message.get("done"):
+                return
+            yield message["offset"], torch.tensor(message["samples"])
+
+
+async def serve(service, host, port, default_steps, max_samples=None):
+    server = await asyncio.start_server(lambda r, w: handle(service, r, w, default_steps, max_samples), host, port)
+    scheduler = asyncio.create_task(service.run())
+    print(f"Serving samples on http://{host}:{port}/sample", flush=True)
+    async with server:
+        await asyncio.gather(server.serve_forever(), scheduler)
+
+
+def main():
+    from xvfm.runtime import load_vfm
+
+    parser = argparse.ArgumentParser(description='Serve samples of a trained VFM, batching concurrent requests')
+    parser.add_argument('checkpoint', type=str, help="Checkpoint, state dict or checkpoint directory of a trained VFM")
+    parser.add_argument('--host', default='127.0.0.1', type=str, help="Address to listen on")
+    parser.add_argument('--port', default=8100, type=int, help="Port to listen on")
+    parser.add_argument('--max_batch', default=1024, type=int, help="Most rows integrated in one velocity evaluation")
+    parser.add_argument('--max_wait_ms', default=5.0, type=float, help="How long an idle service waits for more requests before starting a batch")
+    parser.add_argument('--steps', default=100, type=int, help="Euler steps of requests that do not set them")
+    parser.add_argument('--max_request_samples', default=65536, type=int, help="Largest num_samples a request may ask for; larger requests are rejected with 400")
+    parser.add_argument('--sigma', default=None, type=float, help="Interpolator sigma if the checkpoint does not record it")
+    parser.add_argument('--device', default='cpu', type=str, help="Device to sample on")
+    parser.add_argument('--velocity_graph', default=None, choices=['script', 'export'], help="Integrate with ahead-of-time graphs of the velocity field (see xvfm.compiled.CompiledVelocity)")
+    args = parser.parse_args()
+
+    model = load_vfm(args.checkpoint, args.device, args.sigma)
+    if args.velocity_graph:
+        model.compile_velocity(args.velocity_graph)
+    service = SamplingService(model, args.device, args.max_batch, args.max_wait_ms)
+    asyncio.run(serve(service, args.host, args.port, args.steps, args.max_request_samples))
+
+
+if __name__ == "__main__":
+    main()
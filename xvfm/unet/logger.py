@@ -3,15 +3,22 @@
 https://github.com/openai/baselines/blob/ea25b9e8b234e6ee1bca43083f8f3cf974143998/baselines/logger.py
 """
 
+import atexit
 import datetime
 import json
 import os
 import os.path as osp
+import queue
 import shutil
+import signal
+import struct
 import sys
 import tempfile
+import threading
 import time
 import warnings
+import weakref
+import zlib
 from collections import defaultdict
 from contextlib import contextmanager
 
@@ -24,14 +31,24 @@ DISABLED = 50
 
 
 class KVWriter:
+    autoflush = True  # flush after every write; background sinks turn this off and batch flushes
+
     def writekvs(self, kvs):
         raise NotImplementedError
 
+    def flush(self):
+        pass
+
 
 class SeqWriter:
+    autoflush = True
+
     def writeseq(self, seq):
         raise NotImplementedError
 
+    def flush(self):
+        pass
+
 
 class HumanOutputFormat(KVWriter, SeqWriter):
     def __init__(self, filename_or_file):
@@ -75,7 +92,8 @@ class HumanOutputFormat(KVWriter, SeqWriter):
         self.file.write("\n".join(lines) + "\n")
 
         # Flush the output to the file
-        self.file.flush()
+        if self.autoflush:
+            self.file.flush()
 
     def _truncate(self, s):
         maxlen = 30
@@ -88,6 +106,10 @@ class HumanOutputFormat(KVWriter, SeqWriter):
             if i < len(seq) - 1:  # add space unless this is the last one
                 self.file.write(" ")
         self.file.write("\n")
+        if self.autoflush:
+            self.file.flush()
+
+    def flush(self):
         self.file.flush()
 
     def close(self):
@@ -104,6 +126,10 @@ class JSONOutputFormat(KVWriter):
             if hasattr(v, "dtype"):
                 kvs[k] = float(v)
         self.file.write(json.dumps(kvs) + "\n")
+        if self.autoflush:
+            self.file.flush()
+
+    def flush(self):
         self.file.flush()
 
     def close(self):
@@ -141,12 +167,137 @@ class CSVOutputFormat(KVWriter):
             if v is not None:
                 self.file.write(str(v))
         self.file.write("\n")
+        if self.autoflush:
+            self.file.flush()
+
+    def flush(self):
         self.file.flush()
 
     def close(self):
         self.file.close()
 
 
+class ColumnarOutputFormat(KVWriter):
+    """Append-only binary metrics log with a key dictionary.
+
+    Unlike CSVOutputFormat, new keys never rewrite earlier rows: the first time a key
+    appears a key record assigns it an id, and every dump appends one row record of
+    (key id, float64) pairs. Non-numeric values are skipped. Read with read_columnar().
+
+    Layout after the KVLOG_MAGIC header:
+        b"K" <u4 key id> <u2 name length> <utf-8 name>
+        b"R" <u4 pair count> (<u4 key id> <f8 value>) * count
+    """
+
+    def __init__(self, filename):
+        self.key2id = {}
+        if osp.exists(filename) and osp.getsize(filename) > 0:
+            with open(filename, "rb") as f:
+                id2key, _, end = _scan_columnar(f.read())
+            self.key2id = {k: i for i, k in id2key.items()}
+            self.file = open(filename, "r+b")
+            # Drop a partial record left by a killed run, so appended records stay readable.
+            self.file.truncate(end)
+            self.file.seek(end)
+        else:
+            self.file = open(filename, "wb")
+            self.file.write(KVLOG_MAGIC)
+
+    def writekvs(self, kvs):
+        chunks, pairs = [], []
+        for k, v in kvs.items():
+            try:
+                v = float(v)
+            except (TypeError, ValueError):
+                continue
+            if k not in self.key2id:
+                self.key2id[k] = len(self.key2id)
+                name = k.encode("utf-8")
+                chunks.append(b"K" + struct.pack("<IH", self.key2id[k], len(name)) + name)
+            pairs.append(struct.pack("<Id", self.key2id[k], v))
+        chunks.append(b"R" + struct.pack("<I", len(pairs)) + b"".join(pairs))
+        self.file.write(b"".join(chunks))
+        if self.autoflush:
+            self.file.flush()
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+KVLOG_MAGIC = b"KVLOG1\n"
+
+
+def _scan_columnar(buf):
+    """Key names by id, (offset, pair count) of every row record and the end of the last
+    complete record; a truncated trailing record is ignored."""
+    assert buf[: len(KVLOG_MAGIC)] == KVLOG_MAGIC, "not a columnar metrics log"
+    id2key, rows = {}, []
+    pos, end = len(KVLOG_MAGIC), len(buf)
+    while pos < end:
+        tag = buf[pos : pos + 1]
+        if tag == b"K":
+            if pos + 7 > end:
+                break
+            key_id, length = struct.unpack_from("<IH", buf, pos + 1)
+            if pos + 7 + length > end:
+                break
+            id2key[key_id] = bytes(buf[pos + 7 : pos + 7 + length]).decode("utf-8")
+            pos += 7 + length
+        elif tag == b"R":
+            if pos + 5 > end:
+                break
+            (count,) = struct.unpack_from("<I", buf, pos + 1)
+            if pos + 5 + 12 * count > end:
+                break
+            rows.append((pos + 5, count))
+            pos += 5 + 12 * count
+        else:
+            raise ValueError(f"corrupt columnar metrics log at byte {pos}")
+    return id2key, rows, pos
+
+
+def read_columnar(filename, keys=None):
+    """Load a log written by ColumnarOutputFormat as {key: float64 array over rows}.
+
+    Rows where a key was not logged hold NaN. Only `keys` are materialised if given.
+    """
+    import numpy as np
+
+    pair_dtype = np.dtype([("id", "<u4"), ("value", "<f8")])
+    with open(filename, "rb") as f:
+        buf = f.read()
+    id2key, rows, _ = _scan_columnar(buf)
+
+    wanted = set(id2key.values()) if keys is None else set(keys)
+    columns = {k: np.full(len(rows), np.nan) for k in id2key.values() if k in wanted}
+    if not rows or not columns:
+        return columns
+    # Pairs are fixed-width, so all of them are gathered from the buffer in one go.
+    offsets, counts = np.array(rows, dtype=np.int64).T
+    row = np.repeat(np.arange(len(rows)), counts)
+    first = np.cumsum(counts) - counts
+    starts = np.repeat(offsets, counts) + 12 * (np.arange(counts.sum()) - np.repeat(first, counts))
+    raw = np.frombuffer(buf, dtype=np.uint8)[starts[:, None] + np.arange(12)]
+    pairs = raw.view(pair_dtype).reshape(-1)
+    for key_id, k in id2key.items():
+        if k in columns:
+            mask = pairs["id"] == key_id
+            columns[k][row[mask]] = pairs["value"][mask]
+    return columns
+
+
+def read_columnar_runs(filenames, keys=None):
+    """read_columnar() over many runs, keyed by filename; files are read concurrently."""
+    from concurrent.futures import ThreadPoolExecutor
+
+    filenames = list(filenames)
+    with ThreadPoolExecutor(min(8, len(filenames)) or 1) as pool:
+        return dict(zip(filenames, pool.map(lambda filename: read_columnar(filename, keys), filenames)))
+
+
 class TensorBoardOutputFormat(KVWriter):
     """Dumps key/value pairs into TensorBoard's numeric format."""
 
@@ -184,7 +335,187 @@ class TensorBoardOutputFormat(KVWriter):
             self.writer = None
 
 
-def make_output_format(format, ev_dir, log_suffix=""):
+class WandbOfflineOutputFormat(KVWriter):
+    """Writes a run directory laid out like a wandb run's files/ folder, without wandb.
+
+    Each dump becomes one row of wandb-history.jsonl with wandb's `_step`, `_runtime` and
+    `_timestamp` fields; wandb-summary.json holds the latest value of every key. Use
+    replay_to_wandb() to upload the run once a network is available.
+    """
+
+    def __init__(self, dir, config=None):
+        os.makedirs(dir, exist_ok=True)
+        self.dir = dir
+        self.step = 0
+        self.start = time.time()
+        self.summary = {}
+        self.file = open(osp.join(dir, "wandb-history.jsonl"), "a")
+        if config is not None:
+            with open(osp.join(dir, "config.json"), "w") as f:
+                json.dump(config, f, default=str)
+
+    def writekvs(self, kvs):
+        now = time.time()
+        row = {k: float(v) if hasattr(v, "dtype") else v for k, v in kvs.items()}
+        row.update({"_step": self.step, "_runtime": now - self.start, "_timestamp": now})
+        self.summary.update(row)
+        self.file.write(json.dumps(row, default=str) + "\n")
+        self.step += 1
+        if self.autoflush:
+            self.flush()
+
+    def flush(self):
+        self.file.flush()
+        with open(osp.join(self.dir, "wandb-summary.json"), "w") as f:
+            json.dump(self.summary, f, default=str)
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+
+def replay_to_wandb(dir, **init_kwargs):
+    """Upload a run written by WandbOfflineOutputFormat through the wandb client."""
+    import wandb
+
+    config_path = osp.join(dir, "config.json")
+    if osp.exists(config_path):
+        with open(config_path) as f:
+            init_kwargs.setdefault("config", json.load(f))
+    run = wandb.init(**init_kwargs)
+    with open(osp.join(dir, "wandb-history.jsonl")) as f:
+        for line in f:
+            row = json.loads(line)
+            step = row.pop("_step")
+            run.log({k: v for k, v in row.items() if not k.startswith("_")}, step=step)
+    run.finish()
+
+
+_STOP = object()
+_async_formats = weakref.WeakSet()
+_signal_handlers_installed = False
+
+
+class AsyncOutputFormat(KVWriter, SeqWriter):
+    """Moves the writes of `output_formats` onto a background thread.
+
+    Records go through a bounded queue. When it is full, policy "block" applies backpressure
+    to the training thread and policy "drop" discards the record and counts it in `dropped`.
+    The worker drains up to `batch_size` records at a time and flushes the wrapped formats
+    once per batch. Pending records are flushed at interpreter exit and on SIGTERM/SIGINT.
+    """
+
+    def __init__(self, output_formats, maxsize=1024, policy="block", batch_size=64):
+        assert policy in ("block", "drop"), f"Unknown queue policy: {policy}"
+        self.output_formats = list(output_formats)
+        for fmt in self.output_formats:
+            fmt.autoflush = False
+        self.queue = queue.Queue(maxsize)
+        self.policy = policy
+        self.batch_size = batch_size
+        self.dropped = 0
+        self.closed = False
+        self.thread = threading.Thread(target=self._run, name="logger-sink", daemon=True)
+        self.thread.start()
+        _async_formats.add(self)
+        _install_signal_handlers()
+
+    def writekvs(self, kvs):
+        # The logger clears its dict after dumping, so the record has to be copied.
+        self._put(("kvs", dict(kvs)))
+
+    def writeseq(self, seq):
+        self._put(("seq", list(seq)))
+
+    def _put(self, item):
+        if self.policy == "block":
+            self.queue.put(item)
+            return
+        try:
+            self.queue.put_nowait(item)
+        except queue.Full:
+            self.dropped += 1
+
+    def _run(self):
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            stop = False
+            for item in batch:
+                if item is _STOP:
+                    stop = True
+                    continue
+                kind, payload = item
+                for fmt in self.output_formats:
+                    if kind == "kvs" and isinstance(fmt, KVWriter):
+                        fmt.writekvs(dict(payload))
+                    elif kind == "seq" and isinstance(fmt, SeqWriter):
+                        fmt.writeseq(payload)
+            for fmt in self.output_formats:
+                fmt.flush()
+            for _ in batch:
+                self.queue.task_done()
+            if stop:
+                return
+
+    def flush(self, timeout=None):
+        """Wait until every queued record has been written and flushed."""
+        # Polled rather than queue.join() so that it is safe to call from a signal handler.
+        deadline = None if timeout is None else time.time() + timeout
+        while self.queue.unfinished_tasks and self.thread.is_alive():
+            if deadline is not None and time.time() > deadline:
+                return
+            time.sleep(0.01)
+
+    def close(self):
+        if self.closed:
+            return
+        self.queue.put(_STOP)
+        self.thread.join()
+        self.closed = True
+        for fmt in self.output_formats:
+            fmt.close()
+        if self.dropped:
+            warnings.warn(f"Logger sink dropped {self.dropped} records because its queue was full")
+
+
+def _flush_async_formats(timeout=None):
+    for fmt in list(_async_formats):
+        fmt.flush(timeout)
+
+
+def _close_async_formats():
+    for fmt in list(_async_formats):
+        fmt.close()
+
+
+def _install_signal_handlers():
+    global _signal_handlers_installed
+    if _signal_handlers_installed or threading.current_thread() is not threading.main_thread():
+        return
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        previous = signal.getsignal(sig)
+
+        def handler(signum, frame, previous=previous):
+            _flush_async_formats(timeout=10)
+            if callable(previous):
+                previous(signum, frame)
+            elif previous != signal.SIG_IGN:
+                signal.signal(signum, signal.SIG_DFL)
+                os.kill(os.getpid(), signum)
+
+        signal.signal(sig, handler)
+    _signal_handlers_installed = True
+
+
+atexit.register(_close_async_formats)
+
+
+def make_output_format(format, ev_dir, log_suffix="", config=None):
     os.makedirs(ev_dir, exist_ok=True)
     if format == "stdout":
         return HumanOutputFormat(sys.stdout)
@@ -194,8 +525,12 @@ def make_output_format(format, ev_dir, log_suffix=""):
         return JSONOutputFormat(osp.join(ev_dir, "progress%s.json" % log_suffix))
     elif format == "csv":
         return CSVOutputFormat(osp.join(ev_dir, "progress%s.csv" % log_suffix))
+    elif format == "columnar":
+        return ColumnarOutputFormat(osp.join(ev_dir, "progress%s.kvlog" % log_suffix))
     elif format == "tensorboard":
         return TensorBoardOutputFormat(osp.join(ev_dir, "tb%s" % log_suffix))
+    elif format == "wandb":
+        return WandbOfflineOutputFormat(osp.join(ev_dir, "wandb%s" % log_suffix), config=config)
     else:
         raise ValueError(f"Unknown format specified: {format}")
 
@@ -340,7 +675,8 @@ class Logger:
         if self.comm is None:
             d = self.name2val
         else:
-            d = mpi_weighted_mean(
+            weighted_mean = torch_weighted_mean if isinstance(self.comm, TorchDistComm) else mpi_weighted_mean
+            d = weighted_mean(
                 self.comm,
                 {name: (val, self.name2cnt.get(name, 1)) for (name, val) in self.name2val.items()},
             )
@@ -384,7 +720,8 @@ class Logger:
 def get_rank_without_mpi_import():
     # check environment variables here instead of importing mpi4py
     # to avoid calling MPI_Init() when this module is imported
-    for varname in ["PMI_RANK", "OMPI_COMM_WORLD_RANK"]:
+    # RANK is set by torchrun and torch.distributed launchers, SLURM_PROCID by srun.
+    for varname in ["PMI_RANK", "OMPI_COMM_WORLD_RANK", "RANK", "SLURM_PROCID"]:
         if varname in os.environ:
             return int(os.environ[varname])
     return 0
@@ -416,8 +753,93 @@ def mpi_weighted_mean(comm, local_name2valcount):
         return {}
 
 
-def configure(dir=None, format_strs=None, comm=None, log_suffix=""):
-    """If comm is provided, average all numerical stats across that comm."""
+class TorchDistComm:
+    """Lets Logger average over a torch.distributed process group instead of an MPI comm.
+
+    Dumps with more than `max_keys` keys fall back to a slower object gather.
+    """
+
+    def __init__(self, group=None, max_keys=256):
+        import torch.distributed as dist
+
+        assert dist.is_initialized(), "torch.distributed must be initialised first"
+        self.dist = dist
+        self.group = group
+        self.max_keys = max_keys
+
+    @property
+    def rank(self):
+        return self.dist.get_rank(self.group)
+
+    @property
+    def size(self):
+        return self.dist.get_world_size(self.group)
+
+
+def _key_fingerprints(names):
+    # Two independent 16-bit hashes: small enough that sums of squares stay exact in float64.
+    joined = "\0".join(names).encode("utf-8")
+    return float(zlib.crc32(joined) & 0xFFFF), float(zlib.adler32(joined) & 0xFFFF)
+
+
+def torch_weighted_mean(comm, local_name2valcount):
+    """
+    Weighted average over the ranks of a TorchDistComm, returned on every rank.
+    Input: local_name2valcount: dict mapping key -> (value, count)
+    Returns: key -> mean
+
+    The (value * count, count) pairs of the sorted keys are packed into a float64 tensor of fixed
+    size (comm.max_keys slots) and summed with a single all-reduce. The tensor also carries
+    fingerprints of each rank's key list and their squares: all ranks logged the same keys iff
+    sum(f)^2 == size * sum(f^2), which every rank evaluates identically. Otherwise, or if a rank
+    overflowed the slots, all ranks fall back to gathering the dicts as objects.
+    """
+    import torch
+
+    name2valcount = {}
+    for name, (val, count) in local_name2valcount.items():
+        try:
+            name2valcount[name] = (float(val), float(count))
+        except (TypeError, ValueError):
+            warnings.warn(f"WARNING: tried to compute mean on non-float {name}={val}")
+    names = sorted(name2valcount)
+    fingerprints = _key_fingerprints(names)
+
+    device = "cpu"
+    if comm.dist.get_backend(comm.group) == "nccl":
+        device = torch.device("cuda", torch.cuda.current_device())
+    overflow = len(names) > comm.max_keys
+    buf = torch.zeros(5 + 2 * comm.max_keys, dtype=torch.float64)
+    buf[:5] = torch.tensor([f for fp in fingerprints for f in (fp, fp * fp)] + [float(overflow)])
+    if not overflow:
+        buf[5 : 5 + len(names)] = torch.tensor([name2valcount[n][0] * name2valcount[n][1] for n in names])
+        buf[5 + comm.max_keys : 5 + comm.max_keys + len(names)] = torch.tensor([name2valcount[n][1] for n in names])
+    buf = buf.to(device)
+    comm.dist.all_reduce(buf, group=comm.group)
+    buf = buf.tolist()
+
+    if buf[4] == 0 and all(buf[i] ** 2 == comm.size * buf[i + 1] for i in (0, 2)):
+        sums, counts = buf[5 : 5 + len(names)], buf[5 + comm.max_keys : 5 + comm.max_keys + len(names)]
+        return {name: s / c for name, s, c in zip(names, sums, counts)}
+
+    gathered = [None] * comm.size
+    comm.dist.all_gather_object(gathered, name2valcount, group=comm.group)
+    name2sum = defaultdict(float)
+    name2count = defaultdict(float)
+    for n2vc in gathered:
+        for name, (val, count) in n2vc.items():
+            name2sum[name] += val * count
+            name2count[name] += count
+    return {name: name2sum[name] / name2count[name] for name in name2sum}
+
+
+def configure(
+    dir=None, format_strs=None, comm=None, log_suffix="", async_queue_size=None, async_policy="block", config=None
+):
+    """If comm is provided, average all numerical stats across that comm.
+
+    If async_queue_size is given, the output formats are written from a background thread
+    through a queue of that size (see AsyncOutputFormat). `config` is recorded by the wandb format."""
     if dir is None:
         dir = os.getenv("OPENAI_LOGDIR")
     if dir is None:
@@ -439,7 +861,9 @@ def configure(dir=None, format_strs=None, comm=None, log_suffix=""):
         else:
             format_strs = os.getenv("OPENAI_LOG_FORMAT_MPI", "log").split(",")
     format_strs = filter(None, format_strs)
-    output_formats = [make_output_format(f, dir, log_suffix) for f in format_strs]
+    output_formats = [make_output_format(f, dir, log_suffix, config=config) for f in format_strs]
+    if output_formats and async_queue_size is not None:
+        output_formats = [AsyncOutputFormat(output_formats, maxsize=async_queue_size, policy=async_policy)]
 
     Logger.CURRENT = Logger(dir=dir, output_formats=output_formats, comm=comm)
     if output_formats: